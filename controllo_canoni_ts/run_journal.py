@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Giornale di esecuzione del robot canoni, salvato accanto a config_canoni.json.
+
+Per ogni OdA registra l'avanzamento (cercato, scaricato, spostato) con il
+percorso del file scaricato, lo SHA-256 e la data di modifica del file
+trasferito. Se un giro si interrompe, il giro successivo con la stessa
+configurazione (data, fornitore, cartella di destinazione) salta gli OdA già
+spostati e ancora intatti, ritrasferisce quelli scaricati ma non spostati e
+riparte dal punto di errore. Un giro concluso
+senza errori chiude il giornale: il giro seguente riparte da zero.
+"""
+
+import os
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from share_mover import sha256_file
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+# Oltre questa età un giro interrotto non viene più ripreso (i dati sul portale potrebbero essere cambiati)
+RIPRESA_MAX_ORE = 12
+
+STATO_CERCATO = "cercato"
+STATO_SCARICATO = "scaricato"
+STATO_SPOSTATO = "spostato"
+STATO_ERRORE = "errore"
+
+
+def chiave_ordine(numero, posizione):
+    return f"{numero}/{posizione}"
+
+
+class RunJournal:
+    """Stato per OdA del giro corrente, persistito in JSON a ogni cambiamento."""
+
+    def __init__(self, path, identita):
+        self.path = Path(path)
+        self.identita = identita
+        self.ordini = {}
+        self.avviato = datetime.now()
+        self._lock = threading.Lock()
+
+    def riprendi(self):
+        """Carica il giornale di un giro interrotto compatibile; altrimenti ne inizia uno nuovo."""
+        payload = None
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    payload = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                logger.warning("Giornale di esecuzione illeggibile: si riparte da zero.")
+
+        if payload and payload.get("versione") == JOURNAL_VERSION and not payload.get("completato") \
+                and payload.get("identita") == self.identita:
+            avviato = datetime.fromisoformat(payload["avviato"])
+            if datetime.now() - avviato <= timedelta(hours=RIPRESA_MAX_ORE):
+                self.avviato = avviato
+                self.ordini = payload.get("ordini", {})
+                spostati = sum(1 for o in self.ordini.values() if o.get("stato") == STATO_SPOSTATO)
+                logger.info(f"Ripresa del giro del {avviato:%d/%m/%Y %H:%M}: {spostati} OdA già completati.")
+                return self
+
+        self.ordini = {}
+        self.avviato = datetime.now()
+        self._scrivi(completato=False)
+        return self
+
+    def _scrivi(self, completato):
+        payload = {
+            "versione": JOURNAL_VERSION,
+            "identita": self.identita,
+            "avviato": self.avviato.isoformat(timespec="seconds"),
+            "completato": completato,
+            "ordini": self.ordini,
+        }
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def aggiorna(self, chiave, stato, **campi):
+        """Registra il nuovo stato dell'OdA. Chiamabile da più thread (browser e trasferimento)."""
+        with self._lock:
+            voce = self.ordini.setdefault(chiave, {})
+            voce.update(campi)
+            voce["stato"] = stato
+            voce["aggiornato"] = datetime.now().isoformat(timespec="seconds")
+            self._scrivi(completato=False)
+
+    def stato(self, chiave):
+        return self.ordini.get(chiave, {}).get("stato")
+
+    def voce(self, chiave):
+        return self.ordini.get(chiave, {})
+
+    def gia_spostato(self, chiave, destinazione):
+        """
+        Vero se l'OdA risulta spostato e il file di destinazione è ancora quello registrato: stessa
+        dimensione e stessa data di modifica o, se la data non è registrata, stesso SHA-256.
+        """
+        voce = self.ordini.get(chiave, {})
+        if voce.get("stato") != STATO_SPOSTATO:
+            return False
+        try:
+            stat = Path(destinazione).stat()
+            if stat.st_size != voce.get("byte"):
+                return False
+            if voce.get("mtime_ns") is not None:
+                return stat.st_mtime_ns == voce["mtime_ns"]
+            return bool(voce.get("sha256")) and sha256_file(destinazione) == voce["sha256"]
+        except OSError:
+            return False
+
+    def file_da_ritrasferire(self, chiave):
+        """Percorso del file scaricato in un giro precedente e non ancora spostato, se esiste ancora."""
+        voce = self.ordini.get(chiave, {})
+        if voce.get("stato") in (STATO_SCARICATO, STATO_ERRORE) and voce.get("file"):
+            path = Path(voce["file"])
+            if path.exists():
+                return path
+        return None
+
+    def chiudi(self, successo):
+        """Un giro riuscito chiude il giornale; uno fallito lo lascia aperto per la ripresa."""
+        with self._lock:
+            self._scrivi(completato=successo)
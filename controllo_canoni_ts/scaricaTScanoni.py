@@ -1,269 +1,595 @@
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.common.action_chains import ActionChains
 import time
 import traceback
 import sys
 import os
 from pathlib import Path
-import shutil
 import gc
 import logging
 import json
+import queue
+import threading
+import argparse
+from datetime import datetime
 
-# --- CONFIGURAZIONE LOGGING (Standard Output per la GUI) ---
-logging.basicConfig(
-    level=logging.INFO, 
-    format="%(asctime)s - %(message)s", 
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
 logger = logging.getLogger(__name__)
 
-# Forza l'output non bufferizzato per la comunicazione con la GUI
-sys.stdout.reconfigure(line_buffering=True)
-
 try:
     import win32com.client
     PYWIN32_AVAILABLE = True
 except ImportError:
     PYWIN32_AVAILABLE = False
 
-def attendi_scomparsa_overlay(driver, timeout_secondi=45):
-    try:
-        overlay_wait = WebDriverWait(driver, timeout_secondi)
-        xpath_mask = "//div[contains(@class, 'x-mask-msg') or contains(@class, 'x-mask')][not(contains(@style,'display: none'))]"
-        xpath_text = "//div[text()='Caricamento...']"
-        overlay_wait.until(EC.invisibility_of_element_located((By.XPATH, f"{xpath_mask} | {xpath_text}")))
-        logger.info(" -> Overlay scomparso.")
-        return True
-    except Exception:
-        return False
+# La libreria condivisa dei robot (portale_isab) si trova nella cartella principale del progetto
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from selenium.common.exceptions import WebDriverException
+
+from portale_isab import PortalSession, DownloadError, normalizza_profilo
+from portale_isab.retry import PoliticaRetry, BudgetRetry, esegui_con_retry, carica_politiche
+from portale_isab.downloads import crea_cartella_download
+from portale_isab.http_export import HttpExportClient, ExportError
+from portale_isab.telemetry import Telemetria, ESITO_OK, ESITO_ERRORE
+
+from share_mover import ShareMover
+from run_journal import RunJournal, chiave_ordine, STATO_CERCATO, STATO_SCARICATO, STATO_SPOSTATO, STATO_ERRORE
+from ts_manifest import ManifestTS, impronta_file
 
-# --- CARICAMENTO CONFIG ---
+# --- FILE DI CONFIGURAZIONE E DI STATO ---
 SCRIPT_DIR = Path(__file__).resolve().parent
-CONFIG_FILE = SCRIPT_DIR / "config_canoni.json"
-
-if not CONFIG_FILE.exists():
-    logger.error("ERRORE: config_canoni.json non trovato!")
-    sys.exit(1)
-
-with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-    config = json.load(f)
-
-# Variabili
-USERNAME = config.get("username")
-PASSWORD = config.get("password")
-DOWNLOAD_DIR = config.get("download_dir")
-MOVE_DIR = config.get("move_dir")
-LOGIN_URL = config.get("login_url", "https://portalefornitori.isab.com/Ui/")
-PROVIDER = config.get("provider", "KK10608 - COEMI S.R.L.")
-DATE_TO_INSERT = config.get("date_to_insert", "01.01.2025")
-MACRO_PATH = config.get("macro_file_path")
-RUN_MACRO = config.get("run_macro", False)
-ORDERS = config.get("orders", [])
-
-logger.info("--- AVVIO ROBOT SELENIUM ---")
-
-driver = None
-try:
-    chrome_options = webdriver.ChromeOptions()
-    prefs = {
-        "download.default_directory": str(Path(DOWNLOAD_DIR).absolute()),
-        "download.prompt_for_download": False,
-        "download.directory_upgrade": True,
-        "safebrowsing.enabled": True, 
-        "safebrowsing.disable_download_protection": True,
-        "profile.default_content_settings.popups": 0,
-        "profile.content_settings.exceptions.automatic_downloads.*.setting": 1
+# CANONI_CONFIG permette di puntare a un'altra configurazione (es. il banco di prova con il portale simulato);
+# journal e telemetria stanno accanto al file di configurazione usato.
+CONFIG_FILE = Path(os.environ.get("CANONI_CONFIG") or SCRIPT_DIR / "config_canoni.json")
+JOURNAL_FILENAME = "journal_canoni.json"
+MANIFEST_FILENAME = "manifest_ts.json"
+TELEMETRIA_DIRNAME = "telemetria"
+
+# --- EVENTI DI AVANZAMENTO (progress_callback, o JSON-lines su stdout con --eventi-json) ---
+# Gli eventi di un OdA riportano sempre 'chiave' (numero/posizione, come nel giornale).
+EVENTO_AVVIO = "run_started"
+EVENTO_ORDINE_AVVIATO = "order_started"
+EVENTO_DOWNLOAD_COMPLETATO = "download_completed"
+EVENTO_SPOSTATO = "moved"
+EVENTO_INVARIATO = "unchanged"
+EVENTO_ERRORE = "error"
+EVENTO_TEMPI = "timing"
+EVENTO_FINE = "run_finished"
+
+# Un solo login alla volta, anche tra giri lanciati nello stesso processo
+LOGIN_LOCK = threading.Lock()
+
+# --- RIPETIZIONI (sovrascrivibili con la sezione "retry" di config_canoni.json) ---
+# "sessione" riguarda il riavvio del browser dopo un errore imprevisto (es. Chrome chiuso).
+POLITICHE_RETRY = {
+    "cerca": PoliticaRetry(tentativi=3, attesa_iniziale=2, attesa_massima=20),
+    "download": PoliticaRetry(tentativi=3, attesa_iniziale=2, attesa_massima=20),
+    "spostamento": PoliticaRetry(tentativi=5, attesa_iniziale=0.5, attesa_massima=8),
+    "sessione": PoliticaRetry(tentativi=2, attesa_iniziale=5, attesa_massima=30),
+}
+# Tempo massimo del giro speso in ripetizioni e attese
+BUDGET_RETRY_SECONDI = 600
+# Volte in cui un OdA non riuscito torna in fondo alla coda prima di essere dato per fallito
+RIACCODAMENTI_MAX = 1
+
+# Config "ts_cache_minuti": un OdA verificato invariato sul portale da meno di questi minuti non viene
+# riscaricato. Disattivato per default: una modifica fatta sul portale in quell'intervallo (es. canoni
+# corretti a fine mese tra un giro e l'altro) non verrebbe vista. Con 0 il TS si scarica sempre e si
+# saltano solo lo spostamento e il comparatore quando le righe sono invariate.
+TS_CACHE_MINUTI = 0
+
+
+def leggi_config(path=None):
+    """Legge config_canoni.json (o il file indicato)."""
+    with open(path or CONFIG_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def evento_json(evento, dati):
+    """Riga JSON di un evento di avanzamento: {"evento": ..., "ts": ..., <dati>}."""
+    return json.dumps({"evento": evento, "ts": datetime.now().isoformat(timespec="milliseconds"), **dati},
+                      ensure_ascii=False, default=str)
+
+
+def segna_confrontati(chiavi, cartella_stato=None):
+    """Da chiamare dopo un aggiornamento riuscito del comparatore con le chiavi 'da_confrontare' del riepilogo."""
+    ManifestTS(Path(cartella_stato or SCRIPT_DIR) / MANIFEST_FILENAME, None).carica().segna_confrontati(chiavi)
+
+
+def parametri_sessione(config):
+    """
+    Argomenti di PortalSession (escluso il nome del profilo) per la configurazione indicata.
+    Usati anche dalla GUI per preparare i browser pronti: devono coincidere con quelli del giro.
+    """
+    return {
+        "login_url": config.get("login_url", "https://portalefornitori.isab.com/Ui/"),
+        "username": config.get("username"),
+        "password": config.get("password"),
+        "download_dir": config.get("download_dir"),
+        "screenshot_dir": SCRIPT_DIR,
+        # Riuso dei cookie della sessione del portale tra un lancio e l'altro (false = login completo ogni volta)
+        "cache_sessione": config.get("session_cache", True),
+        # Profilo del browser: "visibile" (default) o "prestazioni" (headless, senza immagini/font, per i giri notturni)
+        "profilo": normalizza_profilo(config.get("browser_profile", "visibile")),
     }
-    chrome_options.add_experimental_option("prefs", prefs)
-    
-    # Argomenti per disabilitare le nuove feature di sicurezza di Chrome (Bubble, Warnings)
-    chrome_options.add_argument("--disable-features=InsecureDownloadWarnings")
-    chrome_options.add_argument("--disable-features=DownloadBubble,DownloadBubbleV2")
-    
-    # Altri argomenti permissivi
-    chrome_options.add_argument("--start-maximized")
-    chrome_options.add_argument("--log-level=3")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--ignore-certificate-errors")
-    chrome_options.add_argument("--allow-running-insecure-content")
-    chrome_options.add_argument("--disable-web-security")
-    chrome_options.add_argument(f"--unsafely-treat-insecure-origin-as-secure={LOGIN_URL}")
-
-    driver = webdriver.Chrome(options=chrome_options)
-    wait = WebDriverWait(driver, 20)
-
-    logger.info(f"Navigazione a: {LOGIN_URL}")
-    driver.get(LOGIN_URL)
-
-    logger.info("Login in corso...")
-    wait.until(EC.presence_of_element_located((By.NAME, "Username"))).send_keys(USERNAME)
-    wait.until(EC.presence_of_element_located((By.NAME, "Password"))).send_keys(PASSWORD)
-    wait.until(EC.element_to_be_clickable((By.ID, "round_button-1017-btnInnerEl"))).click()
-    
-    attendi_scomparsa_overlay(driver, 60)
-
-    # Gestione Popup "Sessione attiva"
-    try:
-        wait_popup = WebDriverWait(driver, 5)
-        if len(driver.find_elements(By.ID, "messagebox-1001-msg")) > 0 and driver.find_element(By.ID, "messagebox-1001-msg").is_displayed():
-             logger.info("Rilevata sessione attiva. Clicco su 'Si'...")
-             wait_popup.until(EC.element_to_be_clickable((By.ID, "button-1006-btnInnerEl"))).click()
-             attendi_scomparsa_overlay(driver, 60)
-    except Exception as e:
-        # Ignora errori se il popup non c'è, è opzionale
-        pass
-
-    try:
-        wait_ok = WebDriverWait(driver, 5)
-        wait_ok.until(EC.element_to_be_clickable((By.XPATH, "//span[text()='OK']"))).click()
-        logger.info("Pop-up OK gestito.")
-    except:
-        pass
-
-    logger.info("Navigazione: Report -> Timesheet")
-    wait.until(EC.element_to_be_clickable((By.XPATH, "//*[normalize-space(text())='Report']"))).click()
-    attendi_scomparsa_overlay(driver)
-    
-    btn_ts = "//span[contains(@id, 'generic_menu_button')][.//span[text()='Timesheet']]"
-    wait.until(EC.element_to_be_clickable((By.XPATH, btn_ts))).click()
-    attendi_scomparsa_overlay(driver)
-
-    logger.info(f"Selezione Fornitore: {PROVIDER}")
-    # Utilizzo un XPath più specifico per il trigger del fornitore, simile a scaricaTimbratureIsab
-    fornitore_trigger_xpath = "//input[@name='CodiceFornitore']/ancestor::div[contains(@class, 'x-form-trigger-wrap')]//div[contains(@class, 'x-form-arrow-trigger')]"
-    
-    try:
-        # Attendo che il trigger sia visibile e cliccabile
-        trigger = wait.until(EC.element_to_be_clickable((By.XPATH, fornitore_trigger_xpath)))
-        ActionChains(driver).move_to_element(trigger).click().perform()
-        logger.info(" -> Trigger fornitore cliccato.")
-    except Exception:
-        logger.warning(" -> Trigger specifico non trovato, provo quello generico...")
-        wait.until(EC.element_to_be_clickable((By.XPATH, "//div[contains(@class, 'x-form-arrow-trigger')]"))).click()
-
-    attendi_scomparsa_overlay(driver)
-    
-    # Selezione dell'opzione dalla lista
-    opt_xpath = f"//li[normalize-space(text())='{PROVIDER}']"
-    opt = WebDriverWait(driver, 15).until(EC.presence_of_element_located((By.XPATH, opt_xpath)))
-    driver.execute_script("arguments[0].scrollIntoView({block: 'center'}); arguments[0].click();", opt)
-    
-    logger.info(f" -> Fornitore '{PROVIDER}' selezionato.")
-    attendi_scomparsa_overlay(driver)
-
-    # Verifica se il campo è stato effettivamente popolato (opzionale ma utile)
-    try:
-        valore_input = driver.find_element(By.NAME, "CodiceFornitore").get_attribute("value")
-        if not valore_input:
-            logger.warning(" -> ATTENZIONE: Il campo Fornitore risulta ancora vuoto! Provo inserimento manuale...")
-            campo_f = driver.find_element(By.NAME, "CodiceFornitore")
-            campo_f.send_keys(PROVIDER)
-            time.sleep(1)
-            driver.execute_script("arguments[0].dispatchEvent(new Event('change', {bubbles:true}));", campo_f)
-    except:
-        pass
-
-    logger.info(f"Impostazione Data: {DATE_TO_INSERT}")
-    campo_d = wait.until(EC.visibility_of_element_located((By.NAME, "DataTimesheetDa")))
-    campo_d.clear()
-    campo_d.send_keys(DATE_TO_INSERT)
-
-    js_ev = "var e=new Event('change',{bubbles:true}); arguments[0].dispatchEvent(e);"
-
-    all_downloads_ok = True
-
-    # Loop
-    for o in ORDERS:
-        n, p = o.get("numero"), o.get("posizione", "")
-        if not n: continue
 
+
+class GiroCanoni:
+    """
+    Un giro di scarico dei Timesheet degli OdA configurati. Tutto lo stato del giro
+    (giornale, telemetria, trasferimenti, sessioni) vive nell'istanza, così più giri
+    possono essere lanciati dallo stesso processo (es. dalla GUI) senza reimportare nulla.
+    """
+
+    def __init__(self, config, progress_callback=None, cancel_event=None, cartella_stato=None, pool=None):
+        # Variabili
+        self.username = config.get("username")
+        self.password = config.get("password")
+        self.download_dir = config.get("download_dir")
+        self.move_dir = config.get("move_dir")
+        self.login_url = config.get("login_url", "https://portalefornitori.isab.com/Ui/")
+        self.provider = config.get("provider", "KK10608 - COEMI S.R.L.")
+        self.date_to_insert = config.get("date_to_insert", "01.01.2025")
+        self.orders = config.get("orders", [])
+        # Numero di browser che scaricano gli OdA in parallelo (1 = comportamento sequenziale classico)
+        self.parallel_workers = max(1, int(config.get("parallel_workers", 1) or 1))
+        # Export diretto via HTTP (attivo solo se portale_isab/endpoints_export.json esiste); Selenium resta il ripiego
+        self.http_export = config.get("http_export", True)
+        self.parametri_sessione = parametri_sessione(config)
+        # Browser già avviati (es. dalla GUI) da usare al posto di nuovi avvii di Chrome
+        self.pool = pool
+        config_retry = config.get("retry") or {}
+        self.politiche, budget_secondi = carica_politiche(config_retry, POLITICHE_RETRY)
+        self.budget_secondi = budget_secondi if budget_secondi is not None else BUDGET_RETRY_SECONDI
+        self.riaccodamenti_max = int(config_retry.get("riaccodamenti", RIACCODAMENTI_MAX))
+        self.ts_cache_minuti = config.get("ts_cache_minuti", TS_CACHE_MINUTI)
+
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event or threading.Event()
+        cartella_stato = Path(cartella_stato or SCRIPT_DIR)
+        self.journal_file = cartella_stato / JOURNAL_FILENAME
+        self.telemetria_dir = cartella_stato / TELEMETRIA_DIRNAME
+        self.manifest_file = cartella_stato / MANIFEST_FILENAME
+
+        # Stato del giro, creato in esegui()
+        self.telemetria = None
+        self.journal = None
+        self.manifest = None
+        self.budget = None
+        self.sessioni = []
+        self.passaggi = {}  # chiave OdA -> passaggi non riusciti
+        self.riaccodati = 0
+        self.falliti = []
+        self.invariati = []
+        self.impronte = {}  # chiave OdA -> impronta del file in trasferimento
+        self._lock_ordini = threading.Lock()
+
+    # --- Avanzamento e interruzione ---
+    def notifica(self, evento, **dati):
+        """Inoltra un evento di avanzamento al chiamante; un errore del callback non ferma il giro."""
+        if self.progress_callback is None:
+            return
+        try:
+            self.progress_callback(evento, dati)
+        except Exception as e:
+            logger.warning(f"Callback di avanzamento non riuscito ({evento}): {e}")
+
+    def fermati(self):
+        """Vero dopo una richiesta di annullamento del chiamante."""
+        return self.cancel_event.is_set()
+
+    def riprova(self, passo, funzione, **opzioni):
+        """esegui_con_retry con la politica del passo e il budget del giro."""
+        return esegui_con_retry(funzione, self.politiche[passo], passo, self.budget, annulla=self.cancel_event,
+                                telemetria=self.telemetria, **opzioni)
+
+    def riaccoda(self, coda, n, p, motivo):
+        """
+        Rimette in fondo alla coda un OdA non riuscito, finché restano passaggi e budget;
+        altrimenti lo dà per fallito e il giro prosegue con gli altri OdA.
+        """
+        chiave = chiave_ordine(n, p)
+        with self._lock_ordini:
+            passaggi = self.passaggi[chiave] = self.passaggi.get(chiave, 0) + 1
+            riaccoda = passaggi <= self.riaccodamenti_max and not self.budget.esaurito() and not self.fermati()
+            if riaccoda:
+                self.riaccodati += 1
+            else:
+                self.falliti.append(chiave)
+        self.journal.aggiorna(chiave, STATO_ERRORE, errore=motivo)
+        self.notifica(EVENTO_ERRORE, chiave=chiave, oda=n, posizione=p, errore=motivo, riaccodato=riaccoda)
+        if riaccoda:
+            logger.warning(f" -> OdA {n} non riuscito ({motivo}): rimesso in coda per un nuovo passaggio a fine giro.")
+            coda.put((n, p))
+        else:
+            logger.error(f" -> ERRORE: OdA {n} non scaricato ({motivo}). Proseguo con gli altri OdA.")
+
+    # --- Passi ---
+    def prepara_sessione(self, sessione):
+        """
+        Avvia il browser, esegue il login e prepara la maschera Report -> Timesheet.
+        Restituisce False se il giro è stato annullato nel frattempo.
+        """
+        # L'avvio di Chrome e la preparazione della maschera procedono in parallelo tra i browser
+        sessione.avvia()
+        # I login invece sono serializzati: accessi simultanei dello stesso utente rendono imprevedibile il popup 'sessione attiva'.
+        # Con la cache attiva il primo browser salva la sessione e i successivi la riusano senza login.
+        with LOGIN_LOCK:
+            if self.fermati():
+                return False
+            sessione.login()
+        sessione.apri_report("Timesheet")
+
+        logger.info(f"Selezione Fornitore: {self.provider}")
+        sessione.seleziona_fornitore(self.provider)
+
+        logger.info(f"Impostazione Data: {self.date_to_insert}")
+        sessione.imposta_testo("DataTimesheetDa", self.date_to_insert)
+        return True
+
+    def scarica_ordine(self, sessione, n, p):
+        """
+        Cerca l'OdA e ne scarica l'export, ripetendo ricerca e download secondo le politiche.
+        Restituisce il percorso del file o None (l'OdA va riaccodato dal chiamante).
+        """
         logger.info(f"Elaborazione OdA {n} (Pos: {p})...")
-        c_n = wait.until(EC.presence_of_element_located((By.NAME, "NumeroOda")))
-        driver.execute_script(f"arguments[0].value='{n}';", c_n)
-        driver.execute_script(js_ev, c_n)
-
-        c_p = wait.until(EC.presence_of_element_located((By.NAME, "PosizioneOda")))
-        driver.execute_script(f"arguments[0].value='{p}';", c_p)
-        driver.execute_script(js_ev, c_p)
-
-        wait.until(EC.element_to_be_clickable((By.XPATH, "//span[text()='Cerca']"))).click()
-        attendi_scomparsa_overlay(driver, 90)
-
-        # Download
-        p_dl = Path(DOWNLOAD_DIR)
-        start_files = set(p_dl.iterdir())
-        
-        btn_dl_xpath = "//div[contains(@class, 'x-tool')]//div[contains(@style, 'FontAwesome')]"
-        btn_dl_elem = wait.until(EC.element_to_be_clickable((By.XPATH, btn_dl_xpath)))
-        
-        # Uso JS click per evitare ElementClickInterceptedException se ci sono overlay/pulsanti sopra
-        driver.execute_script("arguments[0].click();", btn_dl_elem)
-        
-        found = None
-        for _ in range(60):
-            current = set(p_dl.iterdir())
-            diff = current - start_files
-            files = [f for f in diff if f.suffix.lower() == '.xlsx' and not f.name.endswith('.tmp')]
-            if files:
-                found = max(files, key=lambda f: f.stat().st_mtime)
+        self.notifica(EVENTO_ORDINE_AVVIATO, chiave=chiave_ordine(n, p), oda=n, posizione=p)
+
+        def cerca():
+            sessione.imposta_valore("NumeroOda", n)
+            sessione.imposta_valore("PosizioneOda", p)
+            return sessione.cerca(90)
+
+        # Una griglia ancora occupata dopo le ripetizioni non blocca: ci pensa il download a fallire
+        self.riprova("cerca", cerca, eccezioni=(WebDriverException,), riuscito=bool)
+        self.journal.aggiorna(chiave_ordine(n, p), STATO_CERCATO)
+        try:
+            found = self.riprova("download", lambda: sessione.scarica_excel(30), eccezioni=(DownloadError, WebDriverException))
+        except (DownloadError, WebDriverException):
+            return None
+        self.journal.aggiorna(chiave_ordine(n, p), STATO_SCARICATO, file=str(found))
+        self.notifica(EVENTO_DOWNLOAD_COMPLETATO, chiave=chiave_ordine(n, p), oda=n, posizione=p, file=found.name)
+        return found
+
+    def scarica_via_http(self, client, coda, mover):
+        """
+        Prova a scaricare gli OdA in coda con l'export HTTP. Restituisce la coda degli OdA
+        rimasti per Selenium: al primo errore l'export diretto viene abbandonato per il giro.
+        """
+        cartella = crea_cartella_download(self.download_dir)
+        rimasti = queue.Queue()
+        attivo = True
+        while not coda.empty():
+            n, p = coda.get_nowait()
+            if attivo and not self.fermati():
+                self.notifica(EVENTO_ORDINE_AVVIATO, chiave=chiave_ordine(n, p), oda=n, posizione=p, via="http")
+                try:
+                    with self.telemetria.passo("export_http", oda=n):
+                        found = client.esporta("Timesheet", {"fornitore": self.provider, "data_da": self.date_to_insert,
+                                                             "numero_oda": n, "posizione_oda": p}, cartella)
+                    self.journal.aggiorna(chiave_ordine(n, p), STATO_SCARICATO, file=str(found))
+                    self.notifica(EVENTO_DOWNLOAD_COMPLETATO, chiave=chiave_ordine(n, p), oda=n, posizione=p, file=found.name, via="http")
+                    self.consegna(mover, found, n, p)
+                    continue
+                except ExportError as e:
+                    logger.warning(f"Export HTTP non riuscito per OdA {n} ({e}): si prosegue con il browser.")
+                    attivo = False
+            rimasti.put((n, p))
+        return rimasti, cartella
+
+    def consegna(self, mover, found, n, p):
+        """Avvia il trasferimento del TS scaricato, salvo che sia invariato rispetto all'ultimo trasferito."""
+        chiave = chiave_ordine(n, p)
+        destinazione = Path(self.move_dir) / f"{n}.xlsx"
+        impronta = impronta_file(found)
+        if self.manifest.invariato(chiave, destinazione, impronta):
+            logger.info(f" -> OdA {n}: Timesheet invariato rispetto all'ultimo trasferito, spostamento saltato.")
+            try:
+                os.remove(found)
+            except OSError:
+                pass
+            self.manifest.conferma(chiave)
+            self.segna_invariato(chiave, "contenuto")
+            return
+        with self._lock_ordini:
+            self.impronte[chiave] = impronta
+        # Rinomina solo con ODC (numero OdA) come richiesto
+        mover.invia(found, f"{n}.xlsx", chiave)
+
+    def segna_invariato(self, chiave, motivo):
+        """OdA concluso senza trasferimento: per il giornale conta come già spostato."""
+        voce = self.manifest.ordini[chiave]
+        self.journal.aggiorna(chiave, STATO_SPOSTATO, sha256=voce.get("sha256"), byte=voce["byte"],
+                              mtime_ns=voce.get("mtime_ns"), file=None, invariato=True)
+        with self._lock_ordini:
+            self.invariati.append(chiave)
+        self.notifica(EVENTO_INVARIATO, chiave=chiave, motivo=motivo)
+
+    def registra_trasferimento(self, esito):
+        """Callback del ShareMover: aggiorna giornale e manifest con l'esito dello spostamento."""
+        self.telemetria.registra_passo("spostamento", time.time() - esito.secondi, esito.secondi,
+                                       esito=ESITO_OK if esito.ok else ESITO_ERRORE, oda=esito.riferimento,
+                                       byte=esito.byte, tentativi=esito.tentativi)
+        if esito.ok:
+            try:
+                mtime_ns = Path(esito.destinazione).stat().st_mtime_ns
+            except OSError:
+                mtime_ns = None  # gia_spostato confronterà lo SHA-256
+            self.journal.aggiorna(esito.riferimento, STATO_SPOSTATO, sha256=esito.sha256, byte=esito.byte,
+                                  mtime_ns=mtime_ns, file=None)
+            with self._lock_ordini:
+                impronta = self.impronte.pop(esito.riferimento, None)
+            try:
+                # File ritrasferito da un giro precedente: l'impronta si calcola sulla copia
+                self.manifest.registra(esito.riferimento, esito.destinazione, impronta or impronta_file(esito.destinazione))
+            except OSError as e:
+                logger.warning(f" -> Manifest non aggiornato per {esito.nome}: {e}")
+            self.notifica(EVENTO_SPOSTATO, chiave=esito.riferimento, destinazione=str(esito.destinazione),
+                          secondi=round(esito.secondi, 2))
+        else:
+            self.journal.aggiorna(esito.riferimento, STATO_ERRORE, errore=esito.errore)
+            self.notifica(EVENTO_ERRORE, chiave=esito.riferimento, errore=esito.errore)
+
+    def worker_ordini(self, indice, coda, mover):
+        """
+        Un browser autenticato che preleva OdA dalla coda condivisa finché non è vuota.
+        Ogni browser scarica nella propria cartella temporanea (dentro download_dir).
+        Ogni file scaricato passa subito al trasferimento in background verso move_dir.
+        Un OdA non riuscito torna in fondo alla coda (vedi riaccoda); dopo un errore imprevisto
+        il browser viene riavviato secondo la politica "sessione". Un annullamento del
+        chiamante viene rispettato tra un OdA e l'altro.
+        """
+        politica = self.politiche["sessione"]
+        for avvio in range(1, politica.tentativi + 1):
+            if self.fermati() or coda.empty():
+                return
+            # Il browser pronto del pool vale solo per il primo avvio
+            sessione = self.pool.preleva(indice, self.parametri_sessione) if self.pool is not None and avvio == 1 else None
+            if sessione is not None:
+                sessione.collega_telemetria(self.telemetria)
+            else:
+                sessione = PortalSession(**self.parametri_sessione, nome_profilo=f"canoni_{indice}", telemetria=self.telemetria)
+            self.sessioni.append(sessione)
+            ordine_corrente = []
+            try:
+                if self.fermati() or not self.prepara_sessione(sessione):
+                    return
+                self.elabora_coda(sessione, indice, coda, mover, ordine_corrente)
+                return
+            except Exception as e:
+                logger.error("ERRORE DURANTE L'ESECUZIONE:")
+                logger.error(traceback.format_exc())
+                motivo = f"{type(e).__name__}: {e}"
+                if ordine_corrente:
+                    self.riaccoda(coda, *ordine_corrente, motivo)
+                else:
+                    self.notifica(EVENTO_ERRORE, chiave=None, errore=motivo)
+            finally:
+                sessione.chiudi()
+
+            attesa = politica.attesa(avvio)
+            if avvio >= politica.tentativi or self.budget.residuo() < attesa:
+                logger.error(f"Browser {indice}: nessun altro riavvio disponibile, gli OdA in coda restano agli altri browser o al prossimo giro.")
+                return
+            logger.warning(f"Riavvio del browser {indice} tra {attesa:.0f}s ({avvio}/{politica.tentativi})...")
+            self.telemetria.evento("retry", passo_ripetuto="sessione", tentativo=avvio, attesa_s=round(attesa, 2), browser=indice)
+            if self.cancel_event.wait(attesa):
+                return
+            self.budget.registra("sessione", attesa, ripetizione=True)
+
+    def elabora_coda(self, sessione, indice, coda, mover, ordine_corrente):
+        """Scarica gli OdA in coda con una sessione pronta; `ordine_corrente` contiene (n, p) durante l'elaborazione."""
+        while not self.fermati():
+            try:
+                n, p = coda.get_nowait()
+            except queue.Empty:
                 break
-            time.sleep(0.5)
-
-        if found:
-            # Rinomina solo con ODC (numero OdA) come richiesto
-            name = f"{n}.xlsx"
-            dest = Path(MOVE_DIR)
-            dest.mkdir(parents=True, exist_ok=True)
-            
-            f_path = dest / name
-            
-            # Logica robusta di spostamento con retry e sovrascrittura
-            moved_ok = False
-            for attempt in range(5):
+            ordine_corrente[:] = [n, p]
+            inizio_ordine = time.perf_counter()
+            with self.telemetria.contesto(oda=n):
+                found = self.scarica_ordine(sessione, n, p)
+            self.notifica(EVENTO_TEMPI, chiave=chiave_ordine(n, p), secondi=round(time.perf_counter() - inizio_ordine, 2),
+                          browser=indice)
+            if found:
+                self.consegna(mover, found, n, p)
+            else:
+                self.riaccoda(coda, n, p, "download non riuscito")
+            ordine_corrente.clear()
+
+    # --- Giro completo ---
+    def esegui(self):
+        """
+        Esegue il giro. Restituisce il riepilogo {'ok', 'annullato', 'ordini', 'spostati', 'invariati',
+        'da_confrontare', 'falliti', 'riaccodati', 'ripetizioni', 'secondi_ripetizioni', 'secondi', 'errore'}.
+        'da_confrontare' elenca gli OdA con un TS non ancora elaborato dal comparatore (vedi segna_confrontati).
+        Un errore imprevisto viene rilanciato dopo aver chiuso il giro ed emesso EVENTO_FINE con ok=False.
+        """
+        logger.info("--- AVVIO ROBOT SELENIUM ---")
+
+        self.telemetria = Telemetria("canoni", self.telemetria_dir)
+        self.budget = BudgetRetry(self.budget_secondi)
+        inizio_giro, t_giro = time.time(), time.perf_counter()
+
+        # Giornale del giro: un giro interrotto con la stessa configurazione riprende dal punto di errore
+        self.journal = RunJournal(self.journal_file, {"provider": self.provider, "date_to_insert": self.date_to_insert,
+                                                      "move_dir": self.move_dir}).riprendi()
+        self.manifest = ManifestTS(self.manifest_file, {"provider": self.provider, "date_to_insert": self.date_to_insert}).carica()
+        mover = ShareMover(self.move_dir, al_completamento=self.registra_trasferimento,
+                           politica=self.politiche["spostamento"], budget=self.budget)
+
+        coda_ordini = queue.Queue()
+        altre_cartelle_download = set()
+        chiavi = []
+        n_worker = 0
+        errore = None
+        # Qualsiasi errore imprevisto chiude comunque trasferimenti, giornale e telemetria e notifica la fine del giro
+        try:
+            da_ritrasferire_n = 0
+            gia_verificati = []
+            for o in self.orders:
+                n, p = o.get("numero"), o.get("posizione", "")
+                if not n: continue
+                chiave = chiave_ordine(n, p)
+                chiavi.append(chiave)
+                if self.journal.gia_spostato(chiave, Path(self.move_dir) / f"{n}.xlsx"):
+                    logger.info(f"OdA {n} (Pos: {p}) già completato nel giro precedente: saltato.")
+                    continue
+                if self.manifest.ancora_valido(chiave, Path(self.move_dir) / f"{n}.xlsx", self.ts_cache_minuti):
+                    logger.info(f"OdA {n} (Pos: {p}) verificato invariato negli ultimi {self.ts_cache_minuti} minuti: download saltato.")
+                    gia_verificati.append(chiave)
+                    continue
+                da_ritrasferire = self.journal.file_da_ritrasferire(chiave)
+                if da_ritrasferire:
+                    # Scaricato ma non spostato: basta ripetere il trasferimento
+                    logger.info(f"OdA {n} (Pos: {p}) già scaricato: ripeto solo lo spostamento.")
+                    mover.invia(da_ritrasferire, f"{n}.xlsx", chiave)
+                    altre_cartelle_download.add(da_ritrasferire.parent)
+                    da_ritrasferire_n += 1
+                    continue
+                coda_ordini.put((n, p))
+            self.notifica(EVENTO_AVVIO, ordini=len(self.orders), da_scaricare=coda_ordini.qsize(), da_spostare=da_ritrasferire_n,
+                          invariati=len(gia_verificati), browser=min(self.parallel_workers, coda_ordini.qsize()))
+            for chiave in gia_verificati:
+                self.segna_invariato(chiave, "manifest")
+
+            client_http = HttpExportClient.da_configurazione(self.login_url, self.username, self.password) if self.http_export else None
+            if client_http and not coda_ordini.empty():
+                logger.info(f"Export HTTP diretto per {coda_ordini.qsize()} OdA...")
+                coda_ordini, cartella_http = self.scarica_via_http(client_http, coda_ordini, mover)
+                altre_cartelle_download.add(cartella_http)
+                client_http.chiudi()
+
+            n_worker = 0 if self.fermati() else min(self.parallel_workers, coda_ordini.qsize())
+
+            if n_worker == 0:
+                logger.info("Nessun OdA da scaricare.")
+            elif n_worker == 1:
+                self.worker_ordini(1, coda_ordini, mover)
+            else:
+                logger.info(f"Modalità parallela: {n_worker} browser per {coda_ordini.qsize()} OdA.")
+                # Nel log ogni riga indica il browser che l'ha prodotta (formato ripristinato a fine giro)
+                formati = [(handler, handler.formatter) for handler in logging.getLogger().handlers]
+                for handler, _ in formati:
+                    handler.setFormatter(logging.Formatter("%(asctime)s - [%(threadName)s] %(message)s"))
+                threads = []
+                for i in range(n_worker):
+                    t = threading.Thread(target=self.worker_ordini, name=f"Browser-{i + 1}",
+                                         args=(i + 1, coda_ordini, mover), daemon=True)
+                    t.start()
+                    threads.append(t)
                 try:
-                    # Attesa iniziale/tra i tentativi per permettere il rilascio del file da parte di Chrome/Antivirus
-                    time.sleep(2) 
-                    
-                    # Se il file esiste già, provo a rimuoverlo per permettere la sovrascrittura
-                    if f_path.exists():
-                        try:
-                            os.remove(f_path)
-                            logger.info(f" -> File esistente rimosso per sovrascrittura: {name}")
-                        except:
-                            # Se fallisce la rimozione (es file aperto), shutil.move proverà comunque a sovrascrivere
-                            pass
-
-                    shutil.move(str(found), str(f_path))
-                    logger.info(f" -> File salvato: {f_path.name}")
-                    moved_ok = True
-                    break
-                except (PermissionError, OSError) as e:
-                    logger.warning(f" -> File bloccato o errore spostamento ({e}). Riprovo ({attempt+1}/5)...")
-            
-            if not moved_ok:
-                logger.error(f" -> ERRORE: Impossibile spostare il file {found.name} dopo 5 tentativi.")
+                    for t in threads:
+                        t.join()
+                finally:
+                    for handler, formato in formati:
+                        handler.setFormatter(formato)
+
+        except Exception as e:
+            errore = f"{type(e).__name__}: {e}"
+            logger.error("ERRORE IMPREVISTO DURANTE IL GIRO:")
+            logger.error(traceback.format_exc())
+            raise
+        finally:
+            annullato = self.cancel_event.is_set()
+            if annullato:
+                logger.warning(f"Giro annullato su richiesta: {coda_ordini.qsize()} OdA non elaborati (ripresi al prossimo avvio).")
+            all_downloads_ok = errore is None and not (self.fermati() or not coda_ordini.empty() or self.falliti)
+
+            # Attende i trasferimenti ancora in corso verso la cartella condivisa
+            esiti = mover.chiudi()
+            if not all(esito.ok for esito in esiti):
                 all_downloads_ok = False
-                break
-        else:
-            logger.error(f" -> ERRORE: Download non riuscito per OdA {n}. Interrompo l'elaborazione.")
-            all_downloads_ok = False
-            break
-
-    logger.info("--- OPERAZIONI WEB COMPLETATE ---")
 
-except Exception:
-    logger.error("ERRORE DURANTE L'ESECUZIONE:")
-    logger.error(traceback.format_exc())
-    all_downloads_ok = False
-finally:
-    if driver:
-        driver.quit()
-
-logger.info("Fine Script.")
+            self.journal.chiudi(all_downloads_ok)
+            durata_giro = time.perf_counter() - t_giro
+            self.telemetria.registra_passo("giro", inizio_giro, durata_giro,
+                                           esito=ESITO_OK if all_downloads_ok else ESITO_ERRORE, ordini=len(self.orders),
+                                           browser=n_worker, annullato=annullato, ripetizioni=self.budget.ripetizioni,
+                                           secondi_ripetizioni=round(self.budget.speso, 2), riaccodati=self.riaccodati)
+
+            # Le cartelle temporanee di download non servono più, salvo che contengano file non spostati
+            for sessione in self.sessioni:
+                if any(sessione.download_dir.glob("*.xlsx")):
+                    logger.warning(f"File non spostati lasciati in: {sessione.download_dir}")
+                else:
+                    sessione.rimuovi_cartella_download()
+            for cartella in altre_cartelle_download:
+                try:
+                    cartella.rmdir()
+                except OSError:
+                    pass
+
+            logger.info("--- OPERAZIONI WEB COMPLETATE ---")
+            for sessione in self.sessioni:
+                sessione.log_statistiche()
+            for riga in mover.riepilogo():
+                logger.info(riga)
+            for riga in self.budget.riepilogo():
+                logger.info(riga)
+            if self.invariati:
+                logger.info(f"  Timesheet invariati (spostamento saltato): {len(self.invariati)}")
+            if self.riaccodati or self.falliti:
+                logger.info(f"  OdA rimessi in coda: {self.riaccodati}; non scaricati: {', '.join(self.falliti) or 'nessuno'}")
+
+            # Tempi per passo di tutti i browser del giro
+            passi = {}
+            for sessione in self.sessioni:
+                for passo, valori in sessione.stats.durate.items():
+                    voce = passi.setdefault(passo, {"n": 0, "totale_s": 0.0})
+                    voce["n"] += len(valori)
+                    voce["totale_s"] = round(voce["totale_s"] + sum(valori), 2)
+            self.notifica(EVENTO_TEMPI, passi=passi, secondi=round(durata_giro, 2))
+
+            riepilogo = {"ok": all_downloads_ok, "annullato": annullato, "ordini": len(self.orders),
+                         "spostati": sum(1 for esito in esiti if esito.ok), "invariati": len(self.invariati),
+                         "da_confrontare": self.manifest.da_confrontare(chiavi), "falliti": list(self.falliti),
+                         "riaccodati": self.riaccodati, "ripetizioni": self.budget.ripetizioni,
+                         "secondi_ripetizioni": round(self.budget.speso, 2), "secondi": round(durata_giro, 2), "errore": errore}
+            self.notifica(EVENTO_FINE, **riepilogo)
+        return riepilogo
+
+
+def run(config, progress_callback=None, cancel_event=None, cartella_stato=None, pool=None):
+    """
+    Esegue un giro di scarico con la configurazione indicata (stesso contenuto di config_canoni.json).
+
+    progress_callback(evento, dati) riceve gli eventi di avanzamento (EVENTO_*), anche da thread
+    diversi in modalità parallela. cancel_event (threading.Event) chiede l'interruzione: l'OdA in
+    corso viene completato, i rimanenti restano nel giornale per il giro successivo. Giornale e
+    telemetria stanno in cartella_stato (default: la cartella dello script). Con un BrowserPool
+    creato con parametri_sessione(config) e prefisso "canoni" i browser già pronti vengono riusati.
+    """
+    return GiroCanoni(config, progress_callback, cancel_event, cartella_stato, pool).esegui()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scarico dei Timesheet dei canoni dal Portale Fornitori.")
+    parser.add_argument("--eventi-json", action="store_true",
+                        help="Scrive gli eventi di avanzamento come JSON-lines su stdout; il log leggibile passa su stderr.")
+    args = parser.parse_args()
+
+    # --- CONFIGURAZIONE LOGGING (Standard Output, o stderr se stdout trasporta gli eventi) ---
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(message)s",
+        handlers=[logging.StreamHandler(sys.stderr if args.eventi_json else sys.stdout)]
+    )
+    # Forza l'output non bufferizzato per chi legge lo stdout del processo
+    sys.stdout.reconfigure(line_buffering=True)
+
+    progress_callback = None
+    if args.eventi_json:
+        lock_stdout = threading.Lock()
+
+        def progress_callback(evento, dati):
+            riga = evento_json(evento, dati)
+            with lock_stdout:
+                print(riga, flush=True)
+
+    if not CONFIG_FILE.exists():
+        logger.error(f"ERRORE: {CONFIG_FILE.name} non trovato!")
+        return 1
+    riepilogo = run(leggi_config(CONFIG_FILE), progress_callback, cartella_stato=CONFIG_FILE.parent)
+    logger.info("Fine Script.")
+    return 0 if riepilogo["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
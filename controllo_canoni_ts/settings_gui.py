@@ -2,15 +2,16 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import json
 import os
-import subprocess
 import threading
+import logging
 import queue
-import sys
 import re
 import glob
 from datetime import datetime, timedelta
 import openpyxl
 
+from run_journal import chiave_ordine
+
 # Gestione importazione win32com e pythoncom per i thread
 try:
     import win32com.client
@@ -21,6 +22,17 @@ except ImportError:
 
 CONFIG_FILE = "config_canoni.json"
 
+class GuiLogHandler(logging.Handler):
+    """Inoltra alla console della GUI i messaggi del robot, eseguito nello stesso processo."""
+    def __init__(self, log):
+        super().__init__()
+        self._log = log
+        self.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+
+    def emit(self, record):
+        try: self._log(self.format(record))
+        except Exception: self.handleError(record)
+
 class SettingsGUI:
     def __init__(self, root):
         self.root = root
@@ -29,6 +41,8 @@ class SettingsGUI:
         
         self.config = self.load_config()
         self.log_queue = queue.Queue()
+        self.eventi_queue = queue.Queue()  # Eventi di avanzamento del robot (dal thread del giro)
+        self.avanzamento = None  # Stato del giro in corso per barra, righe OdA e tempo stimato
         
         # Variables
         self.selected_month = tk.StringVar()
@@ -36,7 +50,9 @@ class SettingsGUI:
         self.account_var = tk.StringVar()
         self.progress_var = tk.DoubleVar()
         self.status_message = tk.StringVar(value="Pronto")
-        self.process = None  # Processo script scaricamento
+        self.cancel_event = None  # Richiesta di stop del giro di scaricamento in corso
+        self.robot = None  # Modulo scaricaTScanoni, importato in background una sola volta
+        self.browser_pool = None  # Browser già avviati per il prossimo giro (config "warm_browser")
         
         style = ttk.Style()
         style.theme_use('clam')
@@ -47,6 +63,7 @@ class SettingsGUI:
         
         self.root.after(100, self.update_console)
         self.root.after(800, self.startup_sequence)
+        self.root.protocol("WM_DELETE_WINDOW", self.chiudi)
 
     def load_config(self):
         if os.path.exists(CONFIG_FILE):
@@ -80,6 +97,8 @@ class SettingsGUI:
         })
         with open(CONFIG_FILE, "w", encoding="utf-8") as f:
             json.dump(self.config, f, indent=4)
+        # I browser pronti creati con dati ormai diversi (utente, cartelle, URL) vengono riciclati
+        if self.browser_pool: self.browser_pool.configura(self.robot.parametri_sessione(self.config), self.config.get("parallel_workers", 1))
         if show_msg: messagebox.showinfo("Successo", "Configurazione salvata!")
 
     def setup_autosave(self):
@@ -98,6 +117,25 @@ class SettingsGUI:
     def startup_sequence(self):
         self.log(">>> Avvio sequenza automatica...")
         self.import_from_giornaliera()
+        if self.config.get("warm_browser", True):
+            threading.Thread(target=self.prepara_browser_pool, daemon=True).start()
+
+    def prepara_browser_pool(self):
+        """Importa il robot e avvia i browser in background, mentre l'utente controlla la configurazione."""
+        try:
+            import scaricaTScanoni
+            from portale_isab import BrowserPool
+            self.robot = scaricaTScanoni
+            self.browser_pool = BrowserPool(scaricaTScanoni.parametri_sessione(self.config), self.config.get("parallel_workers", 1),
+                                            prefisso_profilo="canoni").avvia()
+            self.log(">>> Browser in preparazione per lo scarico...")
+        except Exception as e:
+            self.log(f">>> Browser pronto non disponibile (verrà avviato allo scarico): {e}")
+
+    def chiudi(self):
+        if self.cancel_event: self.cancel_event.set()
+        if self.browser_pool: self.browser_pool.chiudi()
+        self.root.destroy()
 
     def import_from_giornaliera(self):
         threading.Thread(target=self.import_from_giornaliera_thread, args=(False,), daemon=True).start()
@@ -340,6 +378,7 @@ class SettingsGUI:
         for c in range(3): f_grid.columnconfigure(c, weight=1)
 
         self.order_entries = []
+        self.order_status_labels = []
         for i in range(15):
             r, c = i // 3, i % 3
             # Frame principale per ogni ordine
@@ -362,6 +401,11 @@ class SettingsGUI:
             
             self.order_entries.append((e_n, e_p, l_name))
 
+            # Stato dell'OdA durante lo scarico (in corso, spostato, errore...)
+            l_stato = ttk.Label(f_main, text="", font=("Arial", 7))
+            l_stato.pack(side=tk.TOP, fill=tk.X)
+            self.order_status_labels.append(l_stato)
+
         self.console_text = tk.Text(self.log_tab, bg="#1e1e1e", fg="#00ff00", font=("Consolas", 10))
         self.console_text.pack(fill=tk.BOTH, expand=True)
         
@@ -373,7 +417,7 @@ class SettingsGUI:
         self.btn_stop = ttk.Button(bot, text="STOP", command=self.stop_process, state=tk.DISABLED)
         self.btn_stop.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
 
-        ttk.Button(bot, text="Esci", command=self.root.destroy).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(bot, text="Esci", command=self.chiudi).pack(side=tk.RIGHT, padx=5)
 
     def on_account_change(self, event=None):
         acc = self.account_var.get()
@@ -433,13 +477,71 @@ class SettingsGUI:
             msg = self.log_queue.get()
             self.console_text.insert(tk.END, msg + "\n")
             self.console_text.see(tk.END)
+        while not self.eventi_queue.empty():
+            self.gestisci_evento(*self.eventi_queue.get())
         self.root.after(100, self.update_console)
 
+    def gestisci_evento(self, evento, dati):
+        """Aggiorna barra di avanzamento, stato delle righe OdA e tempo stimato (thread della GUI)."""
+        if evento == "run_started":
+            righe = {}
+            for (e_n, e_p, _), l_stato in zip(self.order_entries, self.order_status_labels):
+                l_stato.config(text="", foreground="black")
+                if e_n.get().strip(): righe[chiave_ordine(e_n.get().strip(), e_p.get().strip())] = l_stato
+            self.avanzamento = {"totale": dati.get("da_scaricare", 0) + dati.get("da_spostare", 0) + dati.get("invariati", 0), "conclusi": set(),
+                                "errori": 0, "durate": [], "browser": max(1, dati.get("browser") or 1), "righe": righe}
+            self.progress_var.set(0)
+        if not self.avanzamento: return
+        a = self.avanzamento
+        riga = a["righe"].get(dati.get("chiave"))
+        if evento == "order_started" and riga:
+            riga.config(text="in corso...", foreground="#b36b00")
+        elif evento == "download_completed" and riga:
+            riga.config(text="scaricato, in spostamento", foreground="#005a9e")
+        elif evento == "moved":
+            if riga: riga.config(text="spostato", foreground="green")
+            a["conclusi"].add(dati.get("chiave"))
+        elif evento == "unchanged":
+            if riga: riga.config(text="invariato", foreground="green")
+            a["conclusi"].add(dati.get("chiave"))
+        elif evento == "error" and dati.get("riaccodato"):
+            # L'OdA verrà ritentato a fine coda: non è ancora concluso
+            if riga: riga.config(text="errore, nuovo tentativo a fine giro", foreground="#b36b00")
+        elif evento == "error":
+            if riga: riga.config(text=f"errore: {dati.get('errore', '')}", foreground="red")
+            if dati.get("chiave"):
+                a["conclusi"].add(dati["chiave"]); a["errori"] += 1
+        elif evento == "timing" and dati.get("chiave"):
+            a["durate"].append(dati.get("secondi", 0))
+        elif evento == "run_finished":
+            for l_stato in a["righe"].values():
+                if l_stato.cget("text") in ("in corso...", "scaricato, in spostamento", "errore, nuovo tentativo a fine giro"): l_stato.config(text="non completato", foreground="red")
+            self.progress_var.set(100)
+            esito = "annullato" if dati.get("annullato") else ("completato" if dati.get("ok") else "completato con errori")
+            testo = f"Scarico {esito}: {dati.get('spostati', 0)} file spostati in {dati.get('secondi', 0):.0f}s."
+            if dati.get("invariati"): testo += f" Invariati: {dati['invariati']}."
+            if dati.get("ripetizioni"): testo += f" Ripetizioni: {dati['ripetizioni']} ({dati.get('secondi_ripetizioni', 0):.0f}s)."
+            self.status_message.set(testo)
+            self.avanzamento = None
+            return
+
+        fatti = len(a["conclusi"])
+        if a["totale"]: self.progress_var.set(min(100, fatti / a["totale"] * 100))
+        testo = f"Scarico: {fatti}/{a['totale']} OdA"
+        if a["errori"]: testo += f" - {a['errori']} errori"
+        rimanenti = a["totale"] - fatti
+        if a["durate"] and rimanenti > 0:
+            # Stima: durata media di un OdA per gli OdA rimanenti, divisi tra i browser in parallelo
+            secondi = sum(a["durate"]) / len(a["durate"]) * rimanenti / a["browser"]
+            testo += f" - fine stimata tra {int(secondi // 60)}m{int(secondi % 60):02d}s"
+        self.status_message.set(testo)
+
     def run_script_threaded(self):
         self.save_config(False); self.notebook.select(self.log_tab); self.console_text.delete("1.0", tk.END)
         self.btn_run.config(state=tk.DISABLED)
         self.btn_stop.config(state=tk.NORMAL)
         self.log(">>> AVVIO SCARICO...\n")
+        self.cancel_event = threading.Event()
         threading.Thread(target=self.execute_workflow, daemon=True).start()
 
     def _search_network_consuntivo(self, year, month, keyword, check_second=False):
@@ -529,6 +631,7 @@ class SettingsGUI:
         self.log(">>> Scansione completata.\n")
 
     def update_macro_excel(self):
+        """Aggiorna i parametri del comparatore e lancia 'elaboraTutto'. True se la macro è stata eseguita."""
         if not PYWIN32_AVAILABLE:
             self.log(">>> Modulo win32com non disponibile. Impossibile aggiornare Macro.")
             return
@@ -598,6 +701,7 @@ class SettingsGUI:
                 
                 # Imposto una variabile per evitare la chiusura nel finally
                 success_keep_open = True
+                return True
                 
             finally:
                 # Chiudiamo solo se non abbiamo avuto successo (success_keep_open non definita o False)
@@ -616,28 +720,32 @@ class SettingsGUI:
     def execute_workflow(self):
         # Inizializza COM per questo thread
         if PYWIN32_AVAILABLE: pythoncom.CoInitialize()
+        handler = GuiLogHandler(self.log)
+        root_logger = logging.getLogger()
+        root_logger.addHandler(handler)
+        root_logger.setLevel(logging.INFO)
         try:
-            with open(CONFIG_FILE, "w", encoding="utf-8") as f: json.dump(self.config, f, indent=4)
-            si = subprocess.STARTUPINFO()
-            si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            si.wShowWindow = 0
-            self.process = subprocess.Popen(["python", "-u", "scaricaTScanoni.py"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, creationflags=0x08000000, startupinfo=si)
-            
-            for line in self.process.stdout: 
-                self.log(line.strip())
+            # Il robot gira in questo processo: l'import (Selenium compreso) si paga solo al primo avvio
+            import scaricaTScanoni
+            cartella_stato = os.path.dirname(os.path.abspath(CONFIG_FILE))
+            riepilogo = scaricaTScanoni.run(dict(self.config), lambda evento, dati: self.eventi_queue.put((evento, dati)),
+                                            self.cancel_event, cartella_stato, pool=self.browser_pool)
+            esito = "ANNULLATO" if riepilogo["annullato"] else ("OK" if riepilogo["ok"] else "CON ERRORI")
+            self.log(f"\n>>> TERMINATO ({esito})\n")
             
-            self.process.wait()
-            ret_code = self.process.returncode
-            self.log(f"\n>>> TERMINATO ({ret_code})\n")
-            
-            # Esegui Macro Update se richiesto e se lo script è terminato ok (0)
-            # Se è stato killato (-15 o 1 su win), non esegue macro
-            if ret_code == 0 and self.run_macro_var.get():
-                self.update_macro_excel()
+            # Esegui Macro Update se richiesto e se il giro non è stato fermato dall'utente
+            if not riepilogo["annullato"] and self.run_macro_var.get():
+                if not riepilogo["da_confrontare"]:
+                    self.log(">>> Nessun Timesheet cambiato dall'ultimo aggiornamento: macro del comparatore saltata.")
+                elif self.update_macro_excel():
+                    scaricaTScanoni.segna_confrontati(riepilogo["da_confrontare"], cartella_stato)
                 
         except Exception as e: self.log(f"\n>>> ERRORE: {e}\n")
         finally: 
-            self.process = None
+            root_logger.removeHandler(handler)
+            self.cancel_event = None
+            # Il pool prepara già i browser per il giro successivo
+            if self.browser_pool: self.browser_pool.riprendi()
             if PYWIN32_AVAILABLE: pythoncom.CoUninitialize()
             self.root.after(0, self.reset_buttons)
 
@@ -646,17 +754,11 @@ class SettingsGUI:
         self.btn_stop.config(state=tk.DISABLED)
 
     def stop_process(self):
-        if self.process:
-            self.log("\n>>> RICHIESTA DI STOP INVIATA...")
-            try:
-                # Su Windows usiamo taskkill /T per chiudere l'albero dei processi (incluso chromedriver)
-                if sys.platform == "win32":
-                    subprocess.run(["taskkill", "/F", "/T", "/PID", str(self.process.pid)], 
-                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                else:
-                    self.process.terminate()
-            except Exception as e:
-                self.log(f">>> Errore durante lo stop: {e}")
+        if self.cancel_event:
+            # Stop cooperativo: il robot completa l'OdA in corso, chiude i browser e salva il giornale
+            self.cancel_event.set()
+            self.btn_stop.config(state=tk.DISABLED)
+            self.log("\n>>> RICHIESTA DI STOP INVIATA: il giro si ferma dopo l'OdA in corso...")
 
 if __name__ == "__main__":
     root = tk.Tk(); app = SettingsGUI(root); root.mainloop()
\ No newline at end of file
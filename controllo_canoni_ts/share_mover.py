@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Coda di trasferimento in background verso la cartella condivisa (MOVE_DIR).
+
+Il robot consegna ogni file appena scaricato e prosegue subito con l'OdA
+successivo; un thread dedicato copia il file sulla share con un nome
+temporaneo, ne verifica dimensione e SHA-256 rileggendolo dalla share e lo
+rinomina atomicamente nel nome finale. In caso di errore (file aperto in
+Excel, share momentaneamente irraggiungibile) ritenta con attesa esponenziale,
+oppure secondo la PoliticaRetry (portale_isab.retry) e il budget del giro.
+"""
+
+import os
+import time
+import queue
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BLOCCO_COPIA = 1024 * 1024
+SUFFISSO_TEMPORANEO = ".partial"
+
+
+@dataclass
+class EsitoTrasferimento:
+    nome: str
+    sorgente: Path
+    destinazione: Path
+    ok: bool = False
+    byte: int = 0
+    secondi: float = 0.0
+    tentativi: int = 0
+    sha256: str = ""
+    errore: str = ""
+    # Dato libero del chiamante (es. la chiave dell'OdA nel giornale di esecuzione)
+    riferimento: object = None
+
+
+def sha256_file(path):
+    """SHA-256 del file letto a blocchi: unica impronta usata da spostamenti, manifest e giornale."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for blocco in iter(lambda: f.read(BLOCCO_COPIA), b""):
+            h.update(blocco)
+    return h.hexdigest()
+
+
+def _copia_con_hash(sorgente, destinazione):
+    """Copia a blocchi calcolando lo SHA-256 della sorgente. Restituisce (byte copiati, hash)."""
+    h = hashlib.sha256()
+    copiati = 0
+    with open(sorgente, "rb") as f_in, open(destinazione, "wb") as f_out:
+        for blocco in iter(lambda: f_in.read(BLOCCO_COPIA), b""):
+            h.update(blocco)
+            f_out.write(blocco)
+            copiati += len(blocco)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    return copiati, h.hexdigest()
+
+
+class ShareMover:
+    """Thread di trasferimento con copia verificata e rename atomico sulla share."""
+
+    def __init__(self, dest_dir, tentativi=5, attesa_iniziale=0.5, attesa_massima=8.0, al_completamento=None,
+                 politica=None, budget=None):
+        self.dest_dir = Path(dest_dir)
+        self.tentativi = politica.tentativi if politica is not None else tentativi
+        self.attesa_iniziale = attesa_iniziale
+        self.attesa_massima = attesa_massima
+        # Con una PoliticaRetry le attese seguono la politica (con jitter); il BudgetRetry del giro
+        # somma il tempo speso in ripetizioni e, se esaurito, ferma i tentativi
+        self.politica = politica
+        self.budget = budget
+        # Richiamata (dal thread di trasferimento) con l'EsitoTrasferimento di ogni file
+        self.al_completamento = al_completamento
+        self.esiti = []
+        self._coda = queue.Queue()
+        self._thread = threading.Thread(target=self._esegui, name="Trasferimento-SMB", daemon=True)
+        self._thread.start()
+
+    def invia(self, sorgente, nome_destinazione, riferimento=None):
+        """Accoda il file: ritorna subito, il trasferimento avviene in background."""
+        self._coda.put((Path(sorgente), nome_destinazione, riferimento))
+
+    def chiudi(self):
+        """Attende la fine dei trasferimenti in coda e restituisce gli esiti."""
+        self._coda.put(None)
+        self._thread.join()
+        return self.esiti
+
+    def _esegui(self):
+        while True:
+            lavoro = self._coda.get()
+            if lavoro is None:
+                break
+            esito = self._trasferisci(*lavoro)
+            self.esiti.append(esito)
+            if self.al_completamento:
+                try:
+                    self.al_completamento(esito)
+                except Exception as e:
+                    logger.warning(f" -> Errore nella notifica del trasferimento di {esito.nome}: {e}")
+
+    def _trasferisci(self, sorgente, nome, riferimento):
+        destinazione = self.dest_dir / nome
+        temporaneo = self.dest_dir / (nome + SUFFISSO_TEMPORANEO)
+        esito = EsitoTrasferimento(nome=nome, sorgente=sorgente, destinazione=destinazione, riferimento=riferimento)
+        inizio = time.perf_counter()
+
+        for tentativo in range(1, self.tentativi + 1):
+            esito.tentativi = tentativo
+            try:
+                self.dest_dir.mkdir(parents=True, exist_ok=True)
+                copiati, hash_sorgente = _copia_con_hash(sorgente, temporaneo)
+                # Verifica sulla share: dimensione e contenuto devono coincidere con l'originale
+                if temporaneo.stat().st_size != copiati or sha256_file(temporaneo) != hash_sorgente:
+                    raise OSError("verifica fallita: la copia sulla share non corrisponde al file scaricato")
+                os.replace(temporaneo, destinazione)
+                esito.ok, esito.byte, esito.sha256 = True, copiati, hash_sorgente
+                break
+            except OSError as e:
+                esito.errore = str(e)
+                try:
+                    temporaneo.unlink()
+                except OSError:
+                    pass
+                if tentativo >= self.tentativi:
+                    break
+                attesa = self._attesa(tentativo)
+                if self.budget is not None and self.budget.residuo() < attesa:
+                    logger.warning(f" -> Budget delle ripetizioni esaurito: trasferimento di {nome} non ripetuto.")
+                    break
+                logger.warning(f" -> Trasferimento di {nome} non riuscito ({e}). Riprovo tra {attesa:.1f}s ({tentativo}/{self.tentativi})...")
+                time.sleep(attesa)
+                if self.budget is not None:
+                    self.budget.registra("spostamento", attesa, ripetizione=True)
+
+        esito.secondi = time.perf_counter() - inizio
+        if self.budget is not None and esito.tentativi > 1:
+            self.budget.esito("spostamento", recuperato=esito.ok)
+        if esito.ok:
+            try:
+                os.remove(sorgente)
+            except OSError:
+                pass
+            logger.info(f" -> File salvato: {nome}")
+        else:
+            logger.error(f" -> ERRORE: Impossibile trasferire {nome} dopo {esito.tentativi} tentativi: {esito.errore}")
+        return esito
+
+    def _attesa(self, tentativo):
+        if self.politica is not None:
+            return self.politica.attesa(tentativo)
+        return min(self.attesa_massima, self.attesa_iniziale * 2 ** (tentativo - 1))
+
+    def riepilogo(self):
+        """Righe di riepilogo: throughput complessivo e tentativi per file."""
+        if not self.esiti:
+            return []
+        riusciti = [e for e in self.esiti if e.ok]
+        byte_totali = sum(e.byte for e in riusciti)
+        secondi_totali = sum(e.secondi for e in riusciti)
+        throughput = (byte_totali / 1024 / 1024) / secondi_totali if secondi_totali > 0 else 0.0
+        righe = [f"  Trasferimenti: {len(riusciti)}/{len(self.esiti)} riusciti, {byte_totali / 1024:.0f} KB in {secondi_totali:.2f}s ({throughput:.2f} MB/s)"]
+        for e in self.esiti:
+            stato = "OK" if e.ok else "FALLITO"
+            righe.append(f"    {e.nome:<20} {stato:<8} tentativi={e.tentativi}  {e.byte / 1024:8.0f} KB  {e.secondi:6.2f}s")
+        return righe
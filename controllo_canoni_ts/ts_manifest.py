@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Manifest dei Timesheet scaricati, salvato accanto a config_canoni.json.
+
+Per ogni OdA conserva l'impronta dell'ultimo export trasferito: SHA-256 del
+file e digest delle righe normalizzate (l'xlsx del portale cambia a ogni
+export per i metadati interni, le righe no). Se un TS appena scaricato ha le
+stesse righe e il file sulla cartella condivisa è ancora quello registrato,
+il robot non lo trasferisce e il comparatore non va rielaborato. Un OdA
+verificato da poco (entro la validità configurata, disattivata per default)
+non viene nemmeno riscaricato: è una scadenza, non una prova che il TS sul
+portale sia ancora quello, e le modifiche fatte nel frattempo sfuggono.
+A differenza del giornale di esecuzione, il manifest sopravvive ai giri
+conclusi.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime, date, timedelta
+from pathlib import Path
+
+from share_mover import sha256_file
+
+logger = logging.getLogger(__name__)
+
+try:
+    import openpyxl
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    OPENPYXL_AVAILABLE = False
+
+MANIFEST_VERSION = 1
+
+
+def _normalizza_cella(valore):
+    if valore is None:
+        return ""
+    if isinstance(valore, (datetime, date)):
+        return valore.isoformat()
+    if isinstance(valore, float):
+        return str(int(valore)) if valore.is_integer() else repr(round(valore, 6))
+    return str(valore).strip()
+
+
+def digest_righe(path):
+    """
+    Digest SHA-256 delle righe non vuote di tutti i fogli, con celle normalizzate
+    (spazi, numeri interi, date). None se openpyxl manca o il file non si legge.
+    """
+    if not OPENPYXL_AVAILABLE:
+        return None
+    h = hashlib.sha256()
+    try:
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    except Exception as e:
+        logger.warning(f"Digest delle righe non calcolabile per {Path(path).name}: {e}")
+        return None
+    try:
+        for ws in wb.worksheets:
+            h.update(f"[{ws.title}]\n".encode("utf-8"))
+            for riga in ws.iter_rows(values_only=True):
+                celle = [_normalizza_cella(v) for v in riga]
+                while celle and not celle[-1]:
+                    celle.pop()
+                if celle:
+                    h.update(("\x1f".join(celle) + "\n").encode("utf-8"))
+    finally:
+        wb.close()
+    return h.hexdigest()
+
+
+def impronta_file(path):
+    """{'sha256', 'digest_righe', 'byte'} del file scaricato."""
+    return {"sha256": sha256_file(path), "digest_righe": digest_righe(path), "byte": Path(path).stat().st_size}
+
+
+class ManifestTS:
+    """Impronte per OdA dell'ultimo TS trasferito, persistite in JSON a ogni cambiamento (thread-safe)."""
+
+    def __init__(self, path, identita):
+        self.path = Path(path)
+        # Parametri che determinano il contenuto del TS (fornitore, data): se cambiano le voci non valgono più
+        self.identita = identita
+        self.ordini = {}
+        self._lock = threading.Lock()
+
+    def carica(self):
+        payload = None
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    payload = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                logger.warning("Manifest dei Timesheet illeggibile: tutti gli OdA verranno riscaricati.")
+        if payload and payload.get("versione") == MANIFEST_VERSION:
+            self.ordini = payload.get("ordini", {})
+        return self
+
+    def _scrivi(self):
+        payload = {"versione": MANIFEST_VERSION, "ordini": self.ordini}
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _voce_valida(self, chiave, destinazione):
+        """La voce dell'OdA se è della stessa identità e il file di destinazione non è stato toccato."""
+        voce = self.ordini.get(chiave)
+        if not voce or voce.get("identita") != self.identita or voce.get("destinazione") != str(destinazione):
+            return None
+        try:
+            stat = Path(destinazione).stat()
+        except OSError:
+            return None
+        if stat.st_size != voce.get("byte") or stat.st_mtime_ns != voce.get("mtime_ns"):
+            return None
+        return voce
+
+    def ancora_valido(self, chiave, destinazione, validita_minuti):
+        """Vero se l'OdA è stato verificato sul portale da meno di `validita_minuti` e la destinazione è intatta."""
+        if not validita_minuti:
+            return False
+        voce = self._voce_valida(chiave, destinazione)
+        if voce is None:
+            return False
+        verificato = datetime.fromisoformat(voce["verificato"])
+        return datetime.now() - verificato <= timedelta(minutes=validita_minuti)
+
+    def invariato(self, chiave, destinazione, impronta):
+        """Vero se il TS appena scaricato ha le stesse righe (o lo stesso file) dell'ultimo trasferito."""
+        voce = self._voce_valida(chiave, destinazione)
+        if voce is None:
+            return False
+        if impronta.get("digest_righe") and voce.get("digest_righe"):
+            return impronta["digest_righe"] == voce["digest_righe"]
+        return impronta["sha256"] == voce.get("sha256")
+
+    def conferma(self, chiave):
+        """Registra che il portale è stato ricontrollato ora e il TS non è cambiato."""
+        with self._lock:
+            self.ordini[chiave]["verificato"] = datetime.now().isoformat(timespec="seconds")
+            self._scrivi()
+
+    def registra(self, chiave, destinazione, impronta):
+        """Nuovo TS trasferito in `destinazione`: da rielaborare nel comparatore."""
+        stat = Path(destinazione).stat()
+        adesso = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            self.ordini[chiave] = {"identita": self.identita, "destinazione": str(destinazione),
+                                   "sha256": impronta["sha256"], "digest_righe": impronta.get("digest_righe"),
+                                   "byte": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                   "scaricato": adesso, "verificato": adesso, "confrontato": False}
+            self._scrivi()
+
+    def da_confrontare(self, chiavi):
+        """Chiavi tra quelle indicate senza voce o con un TS non ancora elaborato dal comparatore."""
+        return [c for c in chiavi if not self.ordini.get(c, {}).get("confrontato")]
+
+    def segna_confrontati(self, chiavi):
+        """Da chiamare dopo un aggiornamento del comparatore riuscito."""
+        with self._lock:
+            for chiave in chiavi:
+                if chiave in self.ordini:
+                    self.ordini[chiave]["confrontato"] = True
+            self._scrivi()
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""
+Libreria condivisa dai robot Selenium del Portale Fornitori ISAB
+(controllo_canoni_ts/scaricaTScanoni.py e timbrature_isab/scaricaTimbratureIsab.py).
+"""
+
+from .session import (PortalSession, LatencyStats, LoginError, DownloadError, crea_opzioni_chrome,
+                      normalizza_profilo, PROFILO_VISIBILE, PROFILO_PRESTAZIONI)
+from .downloads import DownloadWatcher, WATCHDOG_AVAILABLE
+from .session_cache import SessionCache
+from .browser_pool import BrowserPool
+from .retry import PoliticaRetry, BudgetRetry, esegui_con_retry, carica_politiche
+
+__all__ = ["PortalSession", "LatencyStats", "LoginError", "DownloadError", "crea_opzioni_chrome",
+           "normalizza_profilo", "PROFILO_VISIBILE", "PROFILO_PRESTAZIONI",
+           "DownloadWatcher", "WATCHDOG_AVAILABLE", "SessionCache", "BrowserPool",
+           "PoliticaRetry", "BudgetRetry", "esegui_con_retry", "carica_politiche"]
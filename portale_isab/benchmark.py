@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Banco di prova dei robot sul portale simulato.
+
+Avvia portale_isab.mock_portal, prepara per ogni giro una configurazione
+usa-e-getta (cartelle, parametri, database vuoto) e lancia i robot veri come
+sottoprocessi, ognuno con la propria telemetria. Al termine stampa il tempo
+end-to-end di ogni giro e il report p50/p95 per passo di
+portale_isab.telemetry. Con --cartella i risultati restano su disco e i giri
+successivi vengono confrontati con i precedenti (regressioni), così l'effetto
+di una modifica alle attese si misura invece di stimarlo:
+
+    python -m portale_isab.benchmark --robot canoni timbrature --ripetizioni 3 --cartella bench
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import openpyxl
+
+from .mock_portal import avvia_in_background, aggiungi_argomenti_latenza, opzioni_da_argomenti, FORNITORI, INTESTAZIONE_TIMBRATURE
+from .telemetry import leggi_eventi, genera_report, percentile, SOGLIA_REGRESSIONE
+
+logger = logging.getLogger(__name__)
+
+RADICE_PROGETTO = Path(__file__).resolve().parent.parent
+SCRIPT_CANONI = RADICE_PROGETTO / "controllo_canoni_ts" / "scaricaTScanoni.py"
+SCRIPT_TIMBRATURE = RADICE_PROGETTO / "timbrature_isab" / "scaricaTimbratureIsab.py"
+CREDENZIALI_MOCK = ("benchmark", "benchmark")
+
+
+def prepara_canoni(cartella, login_url, args):
+    """Scrive config_canoni.json per un giro; restituisce (comando, variabili d'ambiente)."""
+    (cartella / "download").mkdir(parents=True)
+    (cartella / "spostati").mkdir()
+    config = {
+        "login_url": login_url,
+        "username": CREDENZIALI_MOCK[0],
+        "password": CREDENZIALI_MOCK[1],
+        "download_dir": str(cartella / "download"),
+        "move_dir": str(cartella / "spostati"),
+        "run_macro": False,
+        "provider": FORNITORI[0],
+        "date_to_insert": datetime.now().replace(day=1).strftime("%d.%m.%Y"),
+        "orders": [{"numero": str(5400000000 + i), "posizione": "10", "nome": f"CANONE BENCHMARK {i + 1}"} for i in range(args.ordini)],
+        "parallel_workers": args.browser,
+        "session_cache": args.cache_sessione,
+        "http_export": False,
+        "browser_profile": args.profilo,
+    }
+    config_path = cartella / "config_canoni.json"
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=4, ensure_ascii=False)
+    return [sys.executable, "-u", str(SCRIPT_CANONI)], {"CANONI_CONFIG": str(config_path)}
+
+
+def prepara_timbrature(cartella, login_url, args):
+    """Crea parametri e database vuoto per un giro; restituisce (comando, variabili d'ambiente)."""
+    (cartella / "download").mkdir(parents=True)
+    parametri_path = cartella / "parametriScaricoTS.xlsm"
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "parametri"
+    ws["A3"], ws["B3"] = CREDENZIALI_MOCK
+    ws["E2"] = str(cartella / "download")
+    ws["E6"] = args.profilo
+    wb.save(parametri_path)
+
+    database_path = cartella / "database_timbrature_isab.xlsm"
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Dati"
+    ws.append(INTESTAZIONE_TIMBRATURE)
+    wb.save(database_path)
+
+    ieri = datetime.now().date() - timedelta(days=1)
+    comando = [sys.executable, "-u", str(SCRIPT_TIMBRATURE),
+               "--login-url", login_url, "--parametri", str(parametri_path), "--database", str(database_path),
+               "--dal", f"{ieri - timedelta(days=args.giorni - 1):%d.%m.%Y}", "--al", f"{ieri:%d.%m.%Y}",
+               "--finestra", str(args.finestra), "--solo-browser"]
+    if not args.cache_sessione:
+        comando.append("--senza-cache-sessione")
+    return comando, {}
+
+
+PREPARAZIONE = {"canoni": prepara_canoni, "timbrature": prepara_timbrature}
+
+
+def esegui_giro(robot, cartella, login_url, args):
+    """Lancia un giro del robot; restituisce (secondi end-to-end, codice di uscita)."""
+    comando, ambiente = PREPARAZIONE[robot](cartella, login_url, args)
+    log_path = cartella / "robot.log"
+    inizio = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        processo = subprocess.run(comando, cwd=Path(comando[2]).parent, env={**os.environ, **ambiente},
+                                  stdout=log, stderr=subprocess.STDOUT, timeout=args.timeout)
+    return time.perf_counter() - inizio, processo.returncode
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dei robot sul Portale Fornitori simulato.")
+    parser.add_argument("--robot", nargs="+", choices=sorted(PREPARAZIONE), default=sorted(PREPARAZIONE))
+    parser.add_argument("--ripetizioni", type=int, default=3, help="Giri per robot.")
+    parser.add_argument("--cartella", help="Cartella dei risultati da conservare (default: temporanea, eliminata alla fine).")
+    parser.add_argument("--profilo", choices=["visibile", "prestazioni"], default="prestazioni", help="Profilo del browser dei robot.")
+    parser.add_argument("--cache-sessione", action="store_true", help="Lascia attiva la cache della sessione (dal secondo giro il login viene saltato).")
+    parser.add_argument("--ordini", type=int, default=5, help="Canoni: OdA da scaricare per giro.")
+    parser.add_argument("--browser", type=int, default=1, help="Canoni: browser in parallelo.")
+    parser.add_argument("--giorni", type=int, default=3, help="Timbrature: giorni del periodo scaricato (fino a ieri).")
+    parser.add_argument("--finestra", type=int, default=0, help="Timbrature: giorni per singola ricerca (0 = unica ricerca).")
+    parser.add_argument("--timeout", type=int, default=900, help="Secondi massimi per un giro.")
+    parser.add_argument("--soglia", type=float, default=SOGLIA_REGRESSIONE, help="Fattore oltre il quale segnalare una regressione.")
+    aggiungi_argomenti_latenza(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    radice = Path(args.cartella).resolve() if args.cartella else Path(tempfile.mkdtemp(prefix="benchmark_portale_"))
+    server, login_url = avvia_in_background(opzioni_da_argomenti(args))
+    logger.info(f"Portale simulato su {login_url}; risultati in {radice}")
+
+    durate = {robot: [] for robot in args.robot}
+    falliti = 0
+    try:
+        for robot in args.robot:
+            for ripetizione in range(1, args.ripetizioni + 1):
+                # Nome ordinabile nel tempo: il report considera "ultimo giro" quello più recente
+                cartella = radice / robot / f"{datetime.now():%Y%m%d_%H%M%S}_{ripetizione:02d}"
+                try:
+                    secondi, codice = esegui_giro(robot, cartella, login_url, args)
+                except subprocess.TimeoutExpired:
+                    secondi, codice = float(args.timeout), "timeout"
+                durate[robot].append(secondi)
+                if codice != 0:
+                    falliti += 1
+                logger.info(f"{robot} giro {ripetizione}/{args.ripetizioni}: {secondi:.1f}s (uscita {codice}, log: {cartella / 'robot.log'})")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print("\nEnd-to-end per robot (processo completo, avvio di Python e del browser inclusi):")
+    for robot, valori in durate.items():
+        if valori:
+            print(f"  {robot:<12} giri {len(valori):>3}  p50 {percentile(valori, 50):7.1f}s  p95 {percentile(valori, 95):7.1f}s  max {max(valori):7.1f}s")
+
+    eventi = []
+    for robot in args.robot:
+        for telemetria in sorted((radice / robot).glob("*/telemetria")):
+            eventi.extend(leggi_eventi(telemetria, robot))
+    regressioni = []
+    if eventi:
+        righe, regressioni = genera_report(eventi, args.soglia)
+        print("\nPassi (telemetria di tutti i giri nella cartella dei risultati):")
+        print("\n".join(righe))
+    else:
+        print("\nNessun evento di telemetria: controllare i robot.log dei giri.")
+
+    if not args.cartella:
+        if falliti:
+            logger.info(f"Giri non riusciti: i log restano in {radice}")
+        else:
+            shutil.rmtree(radice, ignore_errors=True)
+    return 1 if falliti or regressioni else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Browser pronti ("caldi") per il prossimo giro di un robot.
+
+L'avvio di Chrome e chromedriver costa diversi secondi: il pool li lancia in
+background (es. all'apertura della GUI, mentre l'utente controlla la
+configurazione), carica facoltativamente la pagina di login e li tiene pronti.
+Al via il robot preleva il browser già avviato invece di crearne uno nuovo.
+Un controllo periodico ricicla i browser che non rispondono più, quelli
+rimasti inattivi oltre il limite e quelli creati con parametri ormai diversi
+da quelli correnti (es. utente o cartella di download cambiati).
+"""
+
+import time
+import logging
+import threading
+
+from selenium.common.exceptions import WebDriverException
+
+from .session import PortalSession, PROFILO_VISIBILE
+
+logger = logging.getLogger(__name__)
+
+# Oltre questo tempo senza essere usato un browser pronto viene chiuso e rilanciato
+INATTIVITA_MAX_SECONDI = 15 * 60
+INTERVALLO_CONTROLLO_SECONDI = 20
+# Dopo questi avvii falliti di fila il pool smette di riprovare fino a configura()/riprendi()
+ERRORI_MAX_CONSECUTIVI = 3
+
+
+class BrowserPool:
+    """
+    Tiene pronti `dimensione` browser del portale, uno per indice (1..dimensione), creati con
+    PortalSession(**parametri, nome_profilo=f"{prefisso_profilo}_{indice}") come farebbe il robot.
+
+    preleva() sospende i rifornimenti (i profili Chrome non si possono condividere con i browser
+    creati dal robot); chi gestisce il pool chiama riprendi() a fine giro.
+    """
+
+    def __init__(self, parametri, dimensione=1, prefisso_profilo="default", precarica_login=True,
+                 inattivita_max=INATTIVITA_MAX_SECONDI, intervallo_controllo=INTERVALLO_CONTROLLO_SECONDI):
+        self._parametri = dict(parametri)
+        self.dimensione = max(1, int(dimensione))
+        self.prefisso_profilo = prefisso_profilo
+        self.precarica_login = precarica_login
+        self.inattivita_max = inattivita_max
+        self.intervallo_controllo = intervallo_controllo
+        self._pronte = {}  # indice -> (sessione, pronta_dal, parametri usati)
+        self._errori = 0
+        self._lock = threading.Lock()
+        self._creazione = threading.Lock()
+        self._sospeso = threading.Event()
+        self._chiuso = threading.Event()
+        self._sveglia = threading.Event()
+        self._thread = None
+
+    # --- Controllo dall'esterno ---
+    def avvia(self):
+        self._thread = threading.Thread(target=self._ciclo, name="BrowserPool", daemon=True)
+        self._thread.start()
+        return self
+
+    def configura(self, parametri, dimensione=None):
+        """Aggiorna i parametri correnti: i browser creati con parametri diversi vengono riciclati."""
+        with self._lock:
+            self._parametri = dict(parametri)
+            if dimensione:
+                self.dimensione = max(1, int(dimensione))
+            self._errori = 0
+        self._sveglia.set()
+
+    def sospendi(self):
+        """Blocca i rifornimenti; se un browser è in fase di avvio attende che abbia finito."""
+        self._sospeso.set()
+        with self._creazione:
+            pass
+
+    def riprendi(self):
+        with self._lock:
+            self._errori = 0
+        self._sospeso.clear()
+        self._sveglia.set()
+
+    def preleva(self, indice, parametri):
+        """
+        Consegna il browser pronto per l'indice se è stato creato con gli stessi parametri e
+        risponde ancora; altrimenti lo chiude e restituisce None (il chiamante ne crea uno nuovo).
+        """
+        self.sospendi()
+        with self._lock:
+            voce = self._pronte.pop(indice, None)
+        if voce is None:
+            return None
+        sessione, pronta_dal, parametri_voce = voce
+        if parametri_voce != dict(parametri):
+            self._scarta(sessione, "parametri cambiati")
+            return None
+        if not sessione.attiva():
+            self._scarta(sessione, "browser non più attivo")
+            return None
+        if sessione.profilo == PROFILO_VISIBILE:
+            try:
+                sessione.driver.maximize_window()
+            except WebDriverException:
+                pass
+        logger.info(f"Browser pronto consegnato (avviato {time.monotonic() - pronta_dal:.0f}s fa): avvio di Chrome saltato.")
+        return sessione
+
+    def chiudi(self):
+        """Ferma il controllo periodico e chiude i browser ancora in attesa."""
+        self._chiuso.set()
+        self._sveglia.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+        with self._lock:
+            voci, self._pronte = list(self._pronte.values()), {}
+        for sessione, _, _ in voci:
+            self._scarta(sessione, None)
+
+    # --- Ciclo in background ---
+    def _ciclo(self):
+        while not self._chiuso.is_set():
+            if not self._sospeso.is_set():
+                self._controlla()
+                self._rifornisci()
+            self._sveglia.wait(self.intervallo_controllo)
+            self._sveglia.clear()
+
+    def _controlla(self):
+        """Ricicla i browser non più coerenti, inattivi da troppo o che non rispondono."""
+        adesso = time.monotonic()
+        with self._lock:
+            parametri, voci = self._parametri, list(self._pronte.items())
+        for indice, (sessione, pronta_dal, parametri_voce) in voci:
+            if parametri_voce != parametri:
+                motivo = "parametri cambiati"
+            elif adesso - pronta_dal > self.inattivita_max:
+                motivo = "inattivo da troppo tempo"
+            elif not sessione.attiva():
+                motivo = "browser non più attivo"
+            else:
+                continue
+            with self._lock:
+                # Potrebbe essere stato prelevato nel frattempo
+                if self._pronte.get(indice, (None,))[0] is not sessione:
+                    continue
+                del self._pronte[indice]
+            self._scarta(sessione, motivo)
+
+    def _rifornisci(self):
+        with self._creazione:
+            for indice in range(1, self.dimensione + 1):
+                if self._sospeso.is_set() or self._chiuso.is_set():
+                    return
+                with self._lock:
+                    if indice in self._pronte or indice > self.dimensione or self._errori >= ERRORI_MAX_CONSECUTIVI:
+                        continue
+                    parametri = self._parametri
+                sessione = self._crea(indice, parametri)
+                with self._lock:
+                    if sessione is None:
+                        self._errori += 1
+                        continue
+                    self._errori = 0
+                    self._pronte[indice] = (sessione, time.monotonic(), parametri)
+
+    def _crea(self, indice, parametri):
+        sessione = PortalSession(**parametri, nome_profilo=f"{self.prefisso_profilo}_{indice}")
+        try:
+            sessione.avvia()
+            if self.precarica_login:
+                sessione.driver.get(sessione.login_url)
+            if sessione.profilo == PROFILO_VISIBILE:
+                # In attesa del via la finestra resta ridotta a icona
+                sessione.driver.minimize_window()
+        except Exception as e:
+            logger.warning(f"Avvio del browser pronto {indice} non riuscito: {e}")
+            self._scarta(sessione, None)
+            return None
+        logger.info(f"Browser {indice} pronto per il prossimo giro.")
+        return sessione
+
+    def _scarta(self, sessione, motivo):
+        if motivo:
+            logger.info(f"Browser pronto riciclato: {motivo}.")
+        sessione.chiudi()
+        sessione.rimuovi_cartella_download()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Cartella di download privata per ogni sessione e rilevamento del file completato.
+
+Chrome scrive il download come `.crdownload` e lo rinomina con il nome finale
+solo quando il file è chiuso: la comparsa di un `.xlsx` nella cartella privata
+della sessione è quindi il segnale di completamento. Con `watchdog` installato
+l'attesa si sblocca sull'evento del filesystem (inotify/ReadDirectoryChangesW);
+altrimenti si interroga la cartella, che contiene solo i file della sessione.
+"""
+
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
+    FileSystemEventHandler = object
+
+logger = logging.getLogger(__name__)
+
+PREFISSO_CARTELLA = "portale_isab_"
+ESTENSIONI_PARZIALI = ('.crdownload', '.tmp', '.part')
+# Intervallo del polling di riserva: la cartella è privata, quindi ogni controllo costa pochi file
+POLL_SECONDI = 0.05
+
+
+def crea_cartella_download(base_dir=None):
+    """Crea una cartella di download temporanea dentro `base_dir` (se esiste) o nella temp di sistema."""
+    base_dir = Path(base_dir) if base_dir else None
+    if base_dir is not None and not base_dir.is_dir():
+        base_dir = None
+    return Path(tempfile.mkdtemp(prefix=PREFISSO_CARTELLA, dir=base_dir)).absolute()
+
+
+def rimuovi_cartella_download(cartella):
+    shutil.rmtree(cartella, ignore_errors=True)
+
+
+def _e_completato(path, estensione):
+    return path.suffix.lower() == estensione and not path.name.endswith(ESTENSIONI_PARZIALI)
+
+
+class _GestoreEventi(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher._segnala(Path(event.src_path))
+
+    def on_moved(self, event):
+        # Il rename .crdownload -> .xlsx di Chrome
+        if not event.is_directory:
+            self.watcher._segnala(Path(event.dest_path))
+
+
+class DownloadWatcher:
+    """
+    Osserva la cartella di download in attesa di un nuovo file completato.
+
+        watcher = DownloadWatcher(cartella).avvia()   # prima del click
+        ...click...
+        percorso = watcher.attendi(timeout)            # None se scade il tempo
+    """
+
+    def __init__(self, cartella, estensione=".xlsx"):
+        self.cartella = Path(cartella)
+        self.estensione = estensione
+        self._presenti = set()
+        self._evento = threading.Event()
+        self._trovato = None
+        self._observer = None
+
+    def avvia(self):
+        self._presenti = set(self.cartella.iterdir())
+        if WATCHDOG_AVAILABLE:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_GestoreEventi(self), str(self.cartella), recursive=False)
+                self._observer.start()
+            except Exception as e:
+                logger.debug(f"Watchdog non avviabile su '{self.cartella}', uso il polling: {e}")
+                self._observer = None
+        return self
+
+    def _segnala(self, path):
+        if path not in self._presenti and _e_completato(path, self.estensione):
+            self._trovato = path
+            self._evento.set()
+
+    def _controlla_cartella(self):
+        for path in self.cartella.iterdir():
+            self._segnala(path)
+
+    def attendi(self, timeout_secondi):
+        scadenza = time.monotonic() + timeout_secondi
+        try:
+            # Un controllo iniziale copre il file arrivato prima dell'avvio dell'observer
+            self._controlla_cartella()
+            while not self._evento.is_set():
+                residuo = scadenza - time.monotonic()
+                if residuo <= 0:
+                    return None
+                if self._observer is not None:
+                    # Con l'observer attivo il controllo della cartella è solo una rete di sicurezza
+                    self._evento.wait(min(residuo, 1.0))
+                else:
+                    self._evento.wait(min(residuo, POLL_SECONDI))
+                self._controlla_cartella()
+            return self._trovato
+        finally:
+            self.ferma()
+
+    def ferma(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=2)
+            self._observer = None
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Export diretto dei report del portale via HTTP, senza browser.
+
+Le griglie Ext JS dei report Timesheet e Timbrature sono alimentate da chiamate
+XHR: questo client le riproduce con una sessione `requests` (connessioni
+riutilizzate) e scrive l'xlsx direttamente su disco in streaming. Le chiamate
+non sono codificate qui ma descritte in un file JSON (vedi
+endpoints_export.esempio.json), ricavato da una registrazione HAR degli
+strumenti per sviluppatori di Chrome: finché il file non esiste il client non
+è attivo e i robot usano Selenium. Ogni errore (ExportError) fa ripiegare il
+robot sul browser per quel solo report.
+
+Per provare il client offline: `python -m portale_isab.replay_server registrazione.har`.
+"""
+
+import os
+import json
+import time
+import logging
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    REQUESTS_AVAILABLE = True
+except ImportError:
+    REQUESTS_AVAILABLE = False
+
+from .session_cache import SessionCache
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS_FILENAME = "endpoints_export.json"
+DEFAULT_ENDPOINTS_PATH = Path(__file__).resolve().parent / ENDPOINTS_FILENAME
+BLOCCO_SCRITTURA = 256 * 1024
+# Firma dei file zip (xlsx): una risposta HTML/JSON al posto del file indica sessione scaduta o parametri errati
+FIRMA_XLSX = b"PK\x03\x04"
+
+
+class ExportError(Exception):
+    """L'export HTTP non è riuscito: il chiamante ripiega su Selenium."""
+
+
+def carica_endpoints(path=None):
+    """Legge la descrizione delle chiamate del portale. Restituisce None se il file non esiste."""
+    path = Path(path) if path else DEFAULT_ENDPOINTS_PATH
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _compila(valore, parametri):
+    """Sostituisce i segnaposto {nome} dei campi con i parametri (quelli mancanti diventano stringa vuota)."""
+    if isinstance(valore, str):
+        return valore.format_map(defaultdict(str, parametri))
+    if isinstance(valore, dict):
+        return {k: _compila(v, parametri) for k, v in valore.items()}
+    if isinstance(valore, list):
+        return [_compila(v, parametri) for v in valore]
+    return valore
+
+
+class HttpExportClient:
+    """
+    Client HTTP del portale descritto da un dizionario di endpoint:
+
+        {"login": {"metodo": "POST", "percorso": "...", "campi": {"Username": "{username}", ...}},
+         "sonda": {"metodo": "GET", "percorso": "..."},
+         "report": {"Timesheet": {"metodo": "POST", "percorso": "...", "campi": {...}, "json": false}}}
+
+    I percorsi sono relativi all'origine di `login_url`.
+    """
+
+    def __init__(self, login_url, username, password, endpoints, timeout=60):
+        if not REQUESTS_AVAILABLE:
+            raise ExportError("Il pacchetto 'requests' non è installato.")
+        self.login_url = login_url
+        parti = urlsplit(login_url)
+        self.origine = f"{parti.scheme}://{parti.netloc}/"
+        self.username = username
+        self.password = password
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.autenticato = False
+        self.http = requests.Session()
+        # Poche connessioni persistenti: tutte le chiamate di un giro riusano la stessa connessione TLS
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        # Il portale usa certificati non riconosciuti dalla catena di sistema (vedi --ignore-certificate-errors in Chrome)
+        self.http.verify = endpoints.get("verifica_certificato", False)
+        if not self.http.verify:
+            try:
+                import urllib3
+                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            except ImportError:
+                pass
+
+    @classmethod
+    def da_configurazione(cls, login_url, username, password, endpoints_path=None):
+        """Crea il client se il file degli endpoint esiste e `requests` è installato, altrimenti None."""
+        if not REQUESTS_AVAILABLE:
+            return None
+        try:
+            endpoints = carica_endpoints(endpoints_path)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"File degli endpoint HTTP non leggibile ({e}): export diretto disattivato.")
+            return None
+        if not endpoints:
+            return None
+        client = cls(login_url, username, password, endpoints)
+        # Se un robot ha già una sessione in cache, i suoi cookie evitano anche il login HTTP
+        dati_cache = SessionCache(login_url, username).carica()
+        if dati_cache:
+            client.usa_cookies(dati_cache.get("cookies", []))
+        return client
+
+    def _richiesta(self, definizione, parametri, stream=False):
+        metodo = definizione.get("metodo", "POST").upper()
+        url = urljoin(self.origine, definizione["percorso"].lstrip("/"))
+        campi = _compila(definizione.get("campi", {}), parametri)
+        kwargs = {"timeout": self.timeout, "stream": stream, "headers": definizione.get("header", {})}
+        if metodo == "GET":
+            kwargs["params"] = campi
+        elif definizione.get("json"):
+            kwargs["json"] = campi
+        else:
+            kwargs["data"] = campi
+        try:
+            return self.http.request(metodo, url, **kwargs)
+        except requests.RequestException as e:
+            raise ExportError(f"{metodo} {definizione['percorso']}: {e}") from e
+
+    def usa_cookies(self, cookies):
+        """Riusa i cookie di una sessione Selenium (es. dalla SessionCache) invece di fare login."""
+        for c in cookies:
+            self.http.cookies.set(c["name"], c["value"], domain=c.get("domain", ""), path=c.get("path", "/"))
+
+    def sessione_valida(self):
+        """Sonda leggera: vero se la chiamata 'sonda' risponde 200 senza rimandare al login."""
+        sonda = self.endpoints.get("sonda")
+        if not sonda:
+            return False
+        try:
+            risposta = self._richiesta(sonda, {})
+        except ExportError:
+            return False
+        # Se la sessione è scaduta il portale risponde con la pagina di login
+        return risposta.status_code == 200 and sonda.get("segno_login", "Username") not in risposta.text[:4000]
+
+    def login(self):
+        if self.autenticato or self.sessione_valida():
+            self.autenticato = True
+            return
+        definizione = self.endpoints.get("login")
+        if not definizione:
+            raise ExportError("Endpoint di login non configurato.")
+        inizio = time.perf_counter()
+        risposta = self._richiesta(definizione, {"username": self.username, "password": self.password})
+        if risposta.status_code != 200:
+            raise ExportError(f"Login HTTP fallito: stato {risposta.status_code}.")
+        chiave_esito = definizione.get("esito_json")
+        if chiave_esito:
+            try:
+                ok = bool(risposta.json().get(chiave_esito))
+            except ValueError:
+                ok = False
+            if not ok:
+                raise ExportError("Login HTTP rifiutato dal portale.")
+        self.autenticato = True
+        logger.info(f"Login HTTP eseguito in {time.perf_counter() - inizio:.2f}s.")
+
+    def esporta(self, report, parametri, cartella):
+        """
+        Scarica l'export xlsx del report con i filtri indicati (es. fornitore, data_da, data_a,
+        numero_oda, posizione_oda) nella cartella. Restituisce il percorso del file.
+        """
+        definizione = self.endpoints.get("report", {}).get(report)
+        if not definizione:
+            raise ExportError(f"Report '{report}' non configurato per l'export HTTP.")
+        self.login()
+
+        inizio = time.perf_counter()
+        risposta = self._richiesta(definizione, parametri, stream=True)
+        temporaneo = None
+        try:
+            if risposta.status_code != 200:
+                raise ExportError(f"Export '{report}' fallito: stato {risposta.status_code}.")
+            cartella = Path(cartella)
+            nome = definizione.get("nome_file", f"{report}_{datetime.now():%Y%m%d_%H%M%S%f}.xlsx")
+            destinazione = cartella / _compila(nome, parametri)
+            temporaneo = destinazione.with_name(destinazione.name + ".part")
+            byte = 0
+            with open(temporaneo, "wb") as f:
+                for blocco in risposta.iter_content(BLOCCO_SCRITTURA):
+                    if byte == 0 and not blocco.startswith(FIRMA_XLSX):
+                        raise ExportError(f"Export '{report}': la risposta non è un file xlsx (sessione scaduta o filtri non validi).")
+                    f.write(blocco)
+                    byte += len(blocco)
+            if byte == 0:
+                raise ExportError(f"Export '{report}': risposta vuota.")
+            os.replace(temporaneo, destinazione)
+        except (ExportError, requests.RequestException, OSError) as e:
+            self.autenticato = False
+            if temporaneo is not None:
+                try:
+                    temporaneo.unlink()
+                except OSError:
+                    pass
+            if isinstance(e, ExportError):
+                raise
+            # Connessione caduta durante il download o errore di scrittura: il chiamante ripiega su Selenium
+            raise ExportError(f"Export '{report}' interrotto: {type(e).__name__}: {e}") from e
+        finally:
+            risposta.close()
+        logger.info(f"  Export HTTP '{report}' completato: {destinazione.name} ({byte / 1024:.0f} KB in {time.perf_counter() - inizio:.2f}s).")
+        return destinazione
+
+    def chiudi(self):
+        self.http.close()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Portale Fornitori simulato, per misurare i robot senza il portale reale.
+
+Una pagina statica (mock_portal.html) riproduce gli elementi che i robot
+cercano: form di login, popup 'sessione attiva', menu Report -> Timesheet /
+Timbrature, combo del fornitore (CodiceFornitore), maschere x-mask durante
+le chiamate, pulsante 'Cerca', icona Excel e logout. Un piccolo Ext.Ajax
+finto emette gli stessi eventi del portale, così anche l'attesa basata
+sull'hook Ext JS viene esercitata. Le latenze di ogni chiamata sono
+configurabili e l'export restituisce un xlsx generato al volo (timbrature con
+lo stesso tracciato del portale: una riga per persona e giorno del periodo).
+
+    python -m portale_isab.mock_portal --porta 8766 --latenza-cerca 1500
+
+Poi puntare i robot a http://127.0.0.1:8766/Ui/ (vedi portale_isab.benchmark).
+"""
+
+import io
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http.cookies import SimpleCookie
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+import openpyxl
+
+logger = logging.getLogger(__name__)
+
+PAGINA_PATH = Path(__file__).resolve().parent / "mock_portal.html"
+SEGNAPOSTO_CONFIG = "/*CONFIG*/{}/*FINE*/"
+COOKIE_SESSIONE = "MockPortaleSid"
+FORNITORI = ["KK10608 - COEMI S.R.L.", "KK20001 - ALTRO FORNITORE S.P.A."]
+
+INTESTAZIONE_TIMBRATURE = ("Id Dipendente", "Data Timbratura", "Ora Ingresso", "Ora Uscita", "Fornitore",
+                           "Codice Fornitore RILPRES", "Numero Badge", "Nome Risorsa", "Cognome Risorsa",
+                           "Codice Fiscale", "Codice Qualifica", "Specializzazione", "Società Ospitante",
+                           "Data Ins", "Presente Nei Timesheet", "Sito Timbratura")
+INTESTAZIONE_TIMESHEET = ("Numero OdA", "Posizione OdA", "Data", "Risorsa", "Ore Ordinarie", "Ore Straordinarie")
+NOMI = ["MARIO", "GIUSEPPE", "ANTONIO", "SALVATORE", "FRANCESCO", "GIOVANNI", "ROSARIO", "ANGELO"]
+COGNOMI = ["ROSSI", "RUSSO", "FERRARA", "ESPOSITO", "BIANCHI", "ROMANO", "COLOMBO", "RICCI", "MARINO", "GRECO"]
+SITI = ["Isab Sud", "Isab Nord"]
+
+
+class OpzioniMock:
+    """Latenze (secondi) e comportamento del portale simulato."""
+
+    def __init__(self, latenza_login=0.8, latenza_menu=0.4, latenza_fornitori=0.3, latenza_cerca=1.5,
+                 latenza_export=0.5, avvio_cerca=0.3, sessione_attiva=False, persone=20):
+        self.latenza_login = latenza_login
+        self.latenza_menu = latenza_menu
+        self.latenza_fornitori = latenza_fornitori
+        self.latenza_cerca = latenza_cerca
+        self.latenza_export = latenza_export
+        self.avvio_cerca = avvio_cerca
+        self.sessione_attiva = sessione_attiva
+        self.persone = persone
+
+
+def _data_portale(testo, predefinita):
+    try:
+        return datetime.strptime((testo or "").strip(), "%d.%m.%Y")
+    except ValueError:
+        return predefinita
+
+
+def genera_xlsx_timbrature(data_da, data_a, persone):
+    """Export delle timbrature: una riga per persona e giorno, con il tracciato A..P del portale."""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(INTESTAZIONE_TIMBRATURE)
+    giorno = data_da
+    while giorno <= data_a:
+        for i in range(persone):
+            ingresso = 6 * 60 + (i * 7) % 90
+            uscita = ingresso + 8 * 60 + (i * 13) % 120
+            ws.append((f"{1000000 + i:08d}", giorno, f"{ingresso // 60:02d}:{ingresso % 60:02d}",
+                       f"{uscita // 60:02d}:{uscita % 60:02d}", "KK10608", "756111", f"{20000 + i:010d}",
+                       NOMI[i % len(NOMI)], COGNOMI[i % len(COGNOMI)], f"CF{i:014d}", "000002",
+                       "OS - OPERAIO SPECIALIZZATO", "000001", giorno + timedelta(days=1), None, SITI[i % len(SITI)]))
+        giorno += timedelta(days=1)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def genera_xlsx_timesheet(numero_oda, posizione_oda, data_da, persone):
+    """Export del timesheet di un OdA: una riga per risorsa e giorno del mese di data_da."""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(INTESTAZIONE_TIMESHEET)
+    giorno = data_da.replace(day=1)
+    while giorno.month == data_da.month:
+        for i in range(max(1, persone // 5)):
+            ws.append((numero_oda, posizione_oda, giorno, f"{COGNOMI[i % len(COGNOMI)]} {NOMI[i % len(NOMI)]}", 8, i % 3))
+        giorno += timedelta(days=1)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    opzioni = None
+    sessioni = None
+    contatori = None
+    lock = None
+
+    # --- Utilità ---
+    def _sessione(self):
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        sid = cookie[COOKIE_SESSIONE].value if COOKIE_SESSIONE in cookie else None
+        with self.lock:
+            return sid if sid in self.sessioni else None
+
+    def _corpo_json(self):
+        lunghezza = int(self.headers.get("Content-Length") or 0)
+        if not lunghezza:
+            return {}
+        try:
+            return json.loads(self.rfile.read(lunghezza).decode("utf-8"))
+        except ValueError:
+            return {}
+
+    def _invia(self, stato, corpo, tipo, header=()):
+        self.send_response(stato)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.send_header("Cache-Control", "no-store")
+        for nome, valore in header:
+            self.send_header(nome, valore)
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _json(self, dati, header=()):
+        self._invia(200, json.dumps(dati).encode("utf-8"), "application/json", header)
+
+    def _pagina(self):
+        config = {"loggato": self._sessione() is not None, "avvioCerca": int(self.opzioni.avvio_cerca * 1000)}
+        html = PAGINA_PATH.read_text(encoding="utf-8").replace(SEGNAPOSTO_CONFIG, json.dumps(config))
+        self._invia(200, html.encode("utf-8"), "text/html; charset=utf-8")
+
+    def _conta(self, chiave):
+        with self.lock:
+            self.contatori[chiave] = self.contatori.get(chiave, 0) + 1
+
+    # --- Instradamento ---
+    def do_GET(self):
+        parti = urlsplit(self.path)
+        percorso, parametri = parti.path, {k: v[0] for k, v in parse_qs(parti.query).items()}
+        if percorso in ("/", "/Ui", "/Ui/", "/Ui/Login"):
+            self._pagina()
+        elif percorso == "/Ui/api/pannello":
+            self._api_autenticata(self.opzioni.latenza_menu, lambda: self._json({"success": True, "voce": parametri.get("voce")}))
+        elif percorso == "/Ui/api/fornitori":
+            self._api_autenticata(self.opzioni.latenza_fornitori, lambda: self._json({"success": True, "fornitori": FORNITORI}))
+        elif percorso == "/Ui/api/export":
+            self._export(parametri)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        percorso = urlsplit(self.path).path
+        corpo = self._corpo_json()
+        if percorso == "/Ui/api/login":
+            self._login(corpo)
+        elif percorso == "/Ui/api/sessione":
+            self._api_autenticata(self.opzioni.latenza_login, lambda: self._json({"success": True}))
+        elif percorso == "/Ui/api/cerca":
+            self._api_autenticata(self.opzioni.latenza_cerca, lambda: self._json({"success": True, "righe": self.opzioni.persone}))
+        elif percorso == "/Ui/api/logout":
+            sid = self._sessione()
+            with self.lock:
+                self.sessioni.discard(sid)
+            self._json({"success": True}, [("Set-Cookie", f"{COOKIE_SESSIONE}=; Path=/; Max-Age=0")])
+        else:
+            self.send_error(404)
+
+    def _api_autenticata(self, latenza, rispondi):
+        if self._sessione() is None:
+            self._invia(401, b'{"success": false}', "application/json")
+            return
+        self._conta(urlsplit(self.path).path)
+        time.sleep(latenza)
+        rispondi()
+
+    def _login(self, corpo):
+        self._conta("login")
+        time.sleep(self.opzioni.latenza_login)
+        if not (corpo.get("username") and corpo.get("password")):
+            self._json({"success": False})
+            return
+        sid = uuid.uuid4().hex
+        with self.lock:
+            self.sessioni.add(sid)
+        self._json({"success": True, "sessioneAttiva": self.opzioni.sessione_attiva},
+                   [("Set-Cookie", f"{COOKIE_SESSIONE}={sid}; Path=/; HttpOnly")])
+
+    def _export(self, parametri):
+        if self._sessione() is None:
+            # Come il portale reale: a sessione scaduta risponde con la pagina di login invece del file
+            self._pagina()
+            return
+        self._conta("export")
+        time.sleep(self.opzioni.latenza_export)
+        oggi = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        if parametri.get("voce") == "Timbrature":
+            data_da = _data_portale(parametri.get("DataTsDa"), oggi - timedelta(days=1))
+            data_a = max(_data_portale(parametri.get("DataTsA"), data_da), data_da)
+            corpo, nome = genera_xlsx_timbrature(data_da, data_a, self.opzioni.persone), "Timbrature.xlsx"
+        else:
+            data_da = _data_portale(parametri.get("DataTimesheetDa"), oggi.replace(day=1))
+            corpo = genera_xlsx_timesheet(parametri.get("NumeroOda", ""), parametri.get("PosizioneOda", ""), data_da, self.opzioni.persone)
+            nome = "Timesheet.xlsx"
+        self._invia(200, corpo, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    [("Content-Disposition", f'attachment; filename="{nome}"')])
+
+    def log_message(self, formato, *args):
+        logger.debug("mock: " + formato % args)
+
+
+def crea_server(opzioni=None, host="127.0.0.1", porta=0):
+    """Crea (senza avviarlo) il portale simulato. porta=0 sceglie una porta libera."""
+    handler = type("MockHandler", (_MockHandler,), {
+        "opzioni": opzioni or OpzioniMock(), "sessioni": set(), "contatori": {}, "lock": threading.Lock()})
+    return ThreadingHTTPServer((host, porta), handler)
+
+
+def avvia_in_background(opzioni=None, host="127.0.0.1", porta=0):
+    """Avvia il portale in un thread; restituisce (server, login_url). Chiudere con server.shutdown()."""
+    server = crea_server(opzioni, host, porta)
+    threading.Thread(target=server.serve_forever, name="MockPortal", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/Ui/"
+
+
+def aggiungi_argomenti_latenza(parser):
+    """Opzioni delle latenze, condivise con il runner del benchmark."""
+    predefinite = OpzioniMock()
+    parser.add_argument("--latenza-login", type=float, default=predefinite.latenza_login, help="Secondi di risposta del login.")
+    parser.add_argument("--latenza-menu", type=float, default=predefinite.latenza_menu, help="Secondi di apertura di un report dal menu.")
+    parser.add_argument("--latenza-fornitori", type=float, default=predefinite.latenza_fornitori, help="Secondi di caricamento della combo fornitori.")
+    parser.add_argument("--latenza-cerca", type=float, default=predefinite.latenza_cerca, help="Secondi di caricamento della griglia dopo 'Cerca'.")
+    parser.add_argument("--latenza-export", type=float, default=predefinite.latenza_export, help="Secondi prima dell'invio dell'xlsx.")
+    parser.add_argument("--avvio-cerca", type=float, default=predefinite.avvio_cerca, help="Ritardo tra il click su 'Cerca' e la partenza della chiamata.")
+    parser.add_argument("--sessione-attiva", action="store_true", help="Mostra il popup 'sessione attiva' dopo ogni login.")
+    parser.add_argument("--persone", type=int, default=predefinite.persone, help="Righe per giorno negli export.")
+
+
+def opzioni_da_argomenti(args):
+    return OpzioniMock(args.latenza_login, args.latenza_menu, args.latenza_fornitori, args.latenza_cerca,
+                       args.latenza_export, args.avvio_cerca, args.sessione_attiva, args.persone)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Portale Fornitori simulato per prove e benchmark dei robot.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8766)
+    aggiungi_argomenti_latenza(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    server = crea_server(opzioni_da_argomenti(args), args.host, args.porta)
+    logger.info(f"Portale simulato su http://{args.host}:{server.server_address[1]}/Ui/ (Ctrl+C per uscire)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Rilevamento "interfaccia pronta" basato su Ext JS.
+
+Un piccolo hook iniettato nella pagina conta le richieste Ext.Ajax in corso e,
+tramite un MutationObserver, registra la comparsa delle maschere di
+caricamento (x-mask). L'attesa è una sola chiamata execute_async_script che
+si sblocca nel browser quando non ci sono richieste pendenti né maschere
+visibili da almeno QUIETE_MS, invece di interrogare un XPath da Python a ogni
+giro. Con un "segno" preso prima dell'azione (es. click su Cerca) l'attesa
+distingue anche il caso in cui il caricamento non è ancora partito.
+"""
+
+import logging
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+logger = logging.getLogger(__name__)
+
+# Periodo senza richieste né mutazioni delle maschere dopo cui la pagina è considerata stabile
+QUIETE_MS = 150
+# Margine oltre il timeout lato browser prima che Selenium interrompa lo script asincrono
+MARGINE_SCRIPT_SECONDI = 5
+
+# Installazione idempotente: dopo un caricamento completo della pagina l'hook va reinstallato,
+# e se Ext non era ancora disponibile alla prima installazione i listener Ajax vengono agganciati dopo.
+JS_INSTALLA_HOOK = """
+var h = window.__portaleIsabHook;
+if (!h) {
+    h = window.__portaleIsabHook = {pending: 0, richieste: 0, maschere: 0, ext: false, ultimaAttivita: Date.now()};
+    h.tocca = function () { h.ultimaAttivita = Date.now(); };
+    h.mascheraVisibile = function () {
+        var m = document.querySelectorAll('.x-mask, .x-mask-msg');
+        for (var i = 0; i < m.length; i++) {
+            if (m[i].offsetWidth > 0 || m[i].offsetHeight > 0) return true;
+        }
+        return false;
+    };
+    if (window.MutationObserver && document.body) {
+        new MutationObserver(function (mutazioni) {
+            for (var i = 0; i < mutazioni.length; i++) {
+                var t = mutazioni[i].target;
+                if (t.classList && (t.classList.contains('x-mask') || t.classList.contains('x-mask-msg'))) {
+                    h.tocca();
+                    if (t.offsetWidth > 0 || t.offsetHeight > 0) h.maschere++;
+                }
+                var aggiunti = mutazioni[i].addedNodes || [];
+                for (var j = 0; j < aggiunti.length; j++) {
+                    if (aggiunti[j].classList && aggiunti[j].classList.contains('x-mask')) { h.tocca(); h.maschere++; }
+                }
+            }
+        }).observe(document.body, {subtree: true, childList: true, attributes: true, attributeFilter: ['class', 'style']});
+    }
+}
+if (!h.ext && window.Ext && Ext.Ajax && Ext.Ajax.on) {
+    var fine = function () { h.pending = Math.max(0, h.pending - 1); h.tocca(); };
+    Ext.Ajax.on('beforerequest', function () { h.pending++; h.richieste++; h.tocca(); });
+    Ext.Ajax.on('requestcomplete', fine);
+    Ext.Ajax.on('requestexception', fine);
+    h.ext = true;
+}
+"""
+
+JS_SEGNA = JS_INSTALLA_HOOK + """
+return {richieste: h.richieste, maschere: h.maschere};
+"""
+
+JS_ATTENDI_PRONTO = JS_INSTALLA_HOOK + """
+var timeoutMs = arguments[0], quieteMs = arguments[1], avvioMs = arguments[2], segno = arguments[3];
+var fatto = arguments[arguments.length - 1];
+var inizio = Date.now();
+(function controlla() {
+    var ora = Date.now();
+    var attivita = segno ? (h.richieste > segno.richieste || h.maschere > segno.maschere) : true;
+    var occupata = h.pending > 0 || h.mascheraVisibile();
+    if (!occupata && ora - h.ultimaAttivita >= quieteMs && (attivita || ora - inizio >= avvioMs)) {
+        fatto({ok: true, attivita: attivita, ext: h.ext, ms: ora - inizio});
+    } else if (ora - inizio >= timeoutMs) {
+        fatto({ok: false, attivita: attivita, ext: h.ext, pending: h.pending, ms: ora - inizio});
+    } else {
+        setTimeout(controlla, 50);
+    }
+})();
+"""
+
+
+def segna_attivita(driver):
+    """Fotografa i contatori dell'hook prima di un'azione. Restituisce None se l'hook non è iniettabile."""
+    try:
+        return driver.execute_script(JS_SEGNA)
+    except WebDriverException as e:
+        logger.debug(f"Hook Ext JS non installabile: {e}")
+        return None
+
+
+def attendi_pronto_ext(driver, timeout_secondi, segno=None, attesa_avvio_secondi=0):
+    """
+    Attende nel browser che Ext JS sia inattivo. Restituisce il dizionario di esito
+    ({ok, attivita, ext, ms}) oppure None se lo script non è eseguibile (pagina in
+    navigazione, JavaScript non disponibile): in quel caso il chiamante usa il polling XPath.
+    """
+    try:
+        driver.set_script_timeout(timeout_secondi + MARGINE_SCRIPT_SECONDI)
+        return driver.execute_async_script(
+            JS_ATTENDI_PRONTO, int(timeout_secondi * 1000), QUIETE_MS, int(attesa_avvio_secondi * 1000), segno)
+    except TimeoutException:
+        return {"ok": False, "attivita": False, "ext": None, "ms": int(timeout_secondi * 1000)}
+    except WebDriverException as e:
+        logger.debug(f"Attesa Ext JS non eseguibile: {e}")
+        return None
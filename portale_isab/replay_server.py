@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Server locale che riproduce risposte registrate del portale, per provare
+l'export HTTP offline.
+
+Legge una registrazione HAR (Chrome DevTools > Network > Save all as HAR) e
+risponde a ogni richiesta con la risposta registrata per lo stesso metodo e
+percorso; se lo stesso percorso compare più volte le risposte vengono date
+nell'ordine della registrazione (l'ultima si ripete).
+
+    python -m portale_isab.replay_server registrazione.har --porta 8765
+
+Poi puntare il client a http://127.0.0.1:8765/Ui/ come login_url.
+"""
+
+import sys
+import json
+import base64
+import logging
+import argparse
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Header che dipendono dal trasporto originale e non vanno ripetuti
+HEADER_ESCLUSI = {"content-length", "content-encoding", "transfer-encoding", "connection", "keep-alive"}
+
+
+def carica_har(path):
+    """Restituisce {(metodo, percorso): [risposte]} da un file HAR."""
+    with open(path, "r", encoding="utf-8") as f:
+        har = json.load(f)
+    risposte = defaultdict(list)
+    for voce in har.get("log", {}).get("entries", []):
+        richiesta, risposta = voce["request"], voce["response"]
+        contenuto = risposta.get("content", {})
+        testo = contenuto.get("text", "") or ""
+        corpo = base64.b64decode(testo) if contenuto.get("encoding") == "base64" else testo.encode("utf-8")
+        header = [(h["name"], h["value"]) for h in risposta.get("headers", []) if h["name"].lower() not in HEADER_ESCLUSI]
+        risposte[(richiesta["method"].upper(), urlsplit(richiesta["url"]).path)].append((risposta.get("status", 200), header, corpo))
+    return risposte
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    risposte = {}
+    contatori = None
+    lock = None
+
+    def _rispondi(self):
+        # Il corpo della richiesta va consumato anche se non viene usato
+        lunghezza = int(self.headers.get("Content-Length") or 0)
+        if lunghezza:
+            self.rfile.read(lunghezza)
+        chiave = (self.command, urlsplit(self.path).path)
+        registrate = self.risposte.get(chiave)
+        if not registrate:
+            logger.warning(f"Nessuna risposta registrata per {chiave[0]} {chiave[1]}")
+            self.send_error(404, "Risposta non registrata")
+            return
+        with self.lock:
+            indice = min(self.contatori[chiave], len(registrate) - 1)
+            self.contatori[chiave] += 1
+        stato, header, corpo = registrate[indice]
+        self.send_response(stato)
+        for nome, valore in header:
+            self.send_header(nome, valore)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    do_GET = do_POST = do_PUT = _rispondi
+
+    def log_message(self, formato, *args):
+        logger.info("replay: " + formato % args)
+
+
+def crea_server(risposte, host="127.0.0.1", porta=0):
+    """Crea (senza avviarlo) un server che riproduce le risposte indicate. porta=0 sceglie una porta libera."""
+    handler = type("ReplayHandler", (_ReplayHandler,), {
+        "risposte": risposte, "contatori": defaultdict(int), "lock": threading.Lock()})
+    return ThreadingHTTPServer((host, porta), handler)
+
+
+def avvia_in_background(har_path, host="127.0.0.1", porta=0):
+    """Avvia il server in un thread; restituisce (server, url di base). Chiudere con server.shutdown()."""
+    server = crea_server(carica_har(har_path), host, porta)
+    threading.Thread(target=server.serve_forever, name="ReplayServer", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Riproduce risposte registrate (HAR) del Portale Fornitori.")
+    parser.add_argument("har", help="File HAR registrato dal portale.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8765)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    risposte = carica_har(args.har)
+    server = crea_server(risposte, args.host, args.porta)
+    logger.info(f"Replay di {sum(len(r) for r in risposte.values())} risposte su http://{args.host}:{server.server_address[1]}/ (Ctrl+C per uscire)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Politiche di ripetizione dei passi dei robot (ricerca, download, spostamento...).
+
+Una PoliticaRetry dichiara quante volte ripetere un passo e quanto attendere
+tra un tentativo e l'altro: attesa esponenziale con jitter, così più browser
+non si ripresentano al portale nello stesso istante. Un BudgetRetry limita il
+tempo che un giro può spendere in ripetizioni (attese più tentativi ripetuti)
+e ne tiene le statistiche per il riepilogo. Le politiche si leggono dalla
+configurazione del robot, ad esempio:
+
+    "retry": {"budget_secondi": 600,
+              "cerca": {"tentativi": 3, "attesa_iniziale": 2, "attesa_massima": 20},
+              "download": {"tentativi": 3}}
+"""
+
+import time
+import random
+import logging
+import threading
+from dataclasses import dataclass, asdict, fields
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PoliticaRetry:
+    tentativi: int = 3
+    attesa_iniziale: float = 2.0
+    fattore: float = 2.0
+    attesa_massima: float = 30.0
+    # Variazione casuale dell'attesa (0.3 = +/-30%)
+    jitter: float = 0.3
+
+    def attesa(self, tentativo):
+        """Secondi da attendere dopo il tentativo fallito numero `tentativo` (1 = il primo)."""
+        base = min(self.attesa_massima, self.attesa_iniziale * self.fattore ** (tentativo - 1))
+        return max(0.0, base * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    @classmethod
+    def da_dizionario(cls, dati, predefinita=None):
+        """Politica dai campi di configurazione; i campi assenti vengono da `predefinita`."""
+        valori = asdict(predefinita) if predefinita is not None else {}
+        nomi = {f.name for f in fields(cls)}
+        valori.update({k: v for k, v in (dati or {}).items() if k in nomi})
+        politica = cls(**valori)
+        politica.tentativi = max(1, int(politica.tentativi))
+        return politica
+
+
+def carica_politiche(config_retry, predefinite):
+    """Restituisce ({passo: PoliticaRetry}, budget in secondi o None) dalla sezione 'retry' della configurazione."""
+    config_retry = config_retry or {}
+    politiche = {passo: PoliticaRetry.da_dizionario(config_retry.get(passo), politica)
+                 for passo, politica in predefinite.items()}
+    return politiche, config_retry.get("budget_secondi")
+
+
+class BudgetRetry:
+    """Tempo massimo speso in ripetizioni durante un giro, con statistiche per passo (thread-safe)."""
+
+    def __init__(self, secondi=None):
+        self.secondi = secondi
+        self.speso = 0.0
+        self.per_passo = {}
+        self._lock = threading.Lock()
+
+    def _voce(self, passo):
+        return self.per_passo.setdefault(passo, {"ripetizioni": 0, "secondi": 0.0, "recuperati": 0, "falliti": 0})
+
+    def residuo(self):
+        if self.secondi is None:
+            return float("inf")
+        with self._lock:
+            return max(0.0, self.secondi - self.speso)
+
+    def esaurito(self):
+        return self.residuo() <= 0
+
+    def registra(self, passo, secondi=0.0, ripetizione=False):
+        """Somma al budget il tempo di un'attesa o di un tentativo ripetuto."""
+        with self._lock:
+            voce = self._voce(passo)
+            voce["secondi"] += secondi
+            if ripetizione:
+                voce["ripetizioni"] += 1
+            self.speso += secondi
+
+    def esito(self, passo, recuperato):
+        """Conta un passo riuscito dopo almeno una ripetizione (recuperato) o fallito a tentativi esauriti."""
+        with self._lock:
+            self._voce(passo)["recuperati" if recuperato else "falliti"] += 1
+
+    @property
+    def ripetizioni(self):
+        with self._lock:
+            return sum(v["ripetizioni"] for v in self.per_passo.values())
+
+    def riepilogo(self):
+        """Righe di riepilogo per passo (vuoto se non ci sono state ripetizioni né fallimenti)."""
+        with self._lock:
+            voci = {p: dict(v) for p, v in self.per_passo.items() if v["ripetizioni"] or v["falliti"]}
+            speso = self.speso
+        if not voci:
+            return []
+        limite = f" su {self.secondi:.0f}s di budget" if self.secondi is not None else ""
+        righe = [f"  Ripetizioni: {sum(v['ripetizioni'] for v in voci.values())}, {speso:.1f}s spesi{limite}"]
+        for passo, v in sorted(voci.items()):
+            righe.append(f"    {passo:<14} ripetizioni={v['ripetizioni']:<3} recuperati={v['recuperati']:<3} "
+                         f"falliti={v['falliti']:<3} {v['secondi']:7.1f}s")
+        return righe
+
+
+def esegui_con_retry(funzione, politica, passo, budget=None, eccezioni=(Exception,), riuscito=None,
+                     annulla=None, telemetria=None):
+    """
+    Esegue funzione() fino a politica.tentativi volte. Un tentativo fallisce se solleva una delle
+    `eccezioni` o se riuscito(risultato) è falso. Tra un tentativo e l'altro attende
+    politica.attesa(n), se il budget lo consente e `annulla` (threading.Event) non viene segnalato.
+    A tentativi esauriti restituisce l'ultimo risultato o rilancia l'ultima eccezione.
+    """
+    tentativo = 1
+    while True:
+        inizio = time.perf_counter()
+        errore, risultato = None, None
+        try:
+            risultato = funzione()
+            ok = riuscito(risultato) if riuscito is not None else True
+        except eccezioni as e:
+            errore, ok = e, False
+        if tentativo > 1 and budget is not None:
+            budget.registra(passo, time.perf_counter() - inizio)
+        if ok:
+            if tentativo > 1 and budget is not None:
+                budget.esito(passo, recuperato=True)
+            return risultato
+
+        attesa = politica.attesa(tentativo)
+        esauriti = tentativo >= politica.tentativi or (budget is not None and budget.residuo() < attesa)
+        if esauriti or (annulla is not None and annulla.is_set()):
+            if budget is not None and tentativo > 1:
+                budget.esito(passo, recuperato=False)
+            if errore is not None:
+                raise errore
+            return risultato
+
+        motivo = f"{type(errore).__name__}: {errore}" if errore is not None else "esito non valido"
+        logger.warning(f"  Passo '{passo}' non riuscito ({motivo}). Nuovo tentativo tra {attesa:.1f}s ({tentativo}/{politica.tentativi})...")
+        if telemetria is not None:
+            telemetria.evento("retry", passo_ripetuto=passo, tentativo=tentativo, attesa_s=round(attesa, 2), motivo=motivo[:200])
+        if annulla is not None:
+            if annulla.wait(attesa):
+                if errore is not None:
+                    raise errore
+                return risultato
+        else:
+            time.sleep(attesa)
+        if budget is not None:
+            budget.registra(passo, attesa, ripetizione=True)
+        tentativo += 1
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""
+Sessione Selenium condivisa per il Portale Fornitori ISAB (Ext JS).
+
+Raccoglie in un unico punto i passi comuni ai robot `scaricaTScanoni.py` e
+`scaricaTimbratureIsab.py`: avvio di Chrome, login, popup "sessione attiva",
+navigazione nel menu Report, selezione del fornitore, ricerca e download
+dell'export Excel. Le attese del caricamento sono svolte nel browser da un hook
+Ext JS (vedi readiness.py), le altre sono condizioni su WebDriverWait con
+polling ravvicinato, non pause fisse; ogni passo registra la propria durata.
+"""
+
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.action_chains import ActionChains
+
+from .readiness import attendi_pronto_ext, segna_attivita
+from .downloads import DownloadWatcher, crea_cartella_download, rimuovi_cartella_download
+from .session_cache import SessionCache
+from .telemetry import ESITO_OK, ESITO_TIMEOUT, ESITO_ERRORE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOGIN_URL = "https://portalefornitori.isab.com/Ui/"
+# Frequenza di polling delle attese: abbastanza fitta da reagire subito, abbastanza rada da non saturare il driver
+POLL_SECONDI = 0.1
+
+XPATH_OVERLAY = "//div[contains(@class, 'x-mask-msg') or contains(@class, 'x-mask')][not(contains(@style,'display: none'))] | //div[text()='Caricamento...']"
+XPATH_ACCEDI = "//span[text()='Accedi' and contains(@class, 'x-btn-inner')]"
+XPATH_REPORT = "//*[normalize-space(text())='Report']"
+XPATH_SESSIONE_ATTIVA = "//div[starts-with(@id, 'messagebox-') and substring(@id, string-length(@id) - 3) = '-msg']"
+XPATH_SI = "//a[contains(@class, 'x-btn') and .//span[normalize-space(text())='Si']]"
+XPATH_OK = "//span[text()='OK' and contains(@class, 'x-btn-inner')]"
+XPATH_CERCA = "//a[contains(@class, 'x-btn') and .//span[normalize-space(text())='Cerca']]"
+XPATH_EXCEL = "//div[contains(@class, 'x-tool') and @role='button' and .//div[contains(@style, 'FontAwesome')]] | //div[contains(@class, 'x-tool')]//div[contains(@style, 'FontAwesome')]"
+# Trigger della combo fornitore (Timesheet | Timbrature) e, in mancanza, il primo trigger generico
+XPATH_TRIGGER_FORNITORE = ("//input[@name='CodiceFornitore']/ancestor::div[contains(@class, 'x-form-trigger-wrap')]//div[contains(@class, 'x-form-arrow-trigger')]"
+                           " | //div[starts-with(@id, 'generic_refresh_combo_box-') and contains(@id, '-trigger-picker')]")
+XPATH_TRIGGER_GENERICO = "//div[contains(@class, 'x-form-arrow-trigger')]"
+XPATH_IMPOSTAZIONI_UTENTE = "//span[@id='user-info-settings-btnEl' and contains(@class, 'x-btn-button')]"
+XPATH_ESCI = "//a[contains(@class, 'x-menu-item-link') and .//span[normalize-space(text())='Esci']]"
+
+# Profili del browser: "visibile" (finestra massimizzata, come sempre) e "prestazioni"
+# (headless, viewport ridotto, niente immagini/font/analytics, cache disco riutilizzata)
+PROFILO_VISIBILE = "visibile"
+PROFILO_PRESTAZIONI = "prestazioni"
+PROFILI_BROWSER = (PROFILO_VISIBILE, PROFILO_PRESTAZIONI)
+VIEWPORT_PRESTAZIONI = "1366,768"
+# Directory dei profili Chrome persistenti (cache HTTP calda tra un lancio e l'altro)
+PROFILI_CHROME_DIR = Path.home() / ".portale_isab" / "chrome"
+# Risorse non necessarie al funzionamento delle maschere Ext JS (i CSS restano: servono al layout)
+URL_BLOCCATI = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.ico", "*.webp", "*.bmp",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*hotjar*",
+]
+JS_TEMPI_PAGINA = """
+var n = performance.getEntriesByType('navigation')[0];
+var r = performance.getEntriesByType('resource');
+var byte = 0; for (var i = 0; i < r.length; i++) { byte += r[i].transferSize || 0; }
+if (!n) return null;
+return {dom: n.domContentLoadedEventEnd, load: n.loadEventEnd, risorse: r.length, byte: byte + (n.transferSize || 0)};
+"""
+
+JS_IMPOSTA_VALORE = "arguments[0].value = arguments[1]; arguments[0].dispatchEvent(new Event('change', {bubbles: true}));"
+
+
+class LoginError(Exception):
+    """Il login sul portale non è andato a buon fine."""
+
+
+class DownloadError(Exception):
+    """L'export Excel non è stato scaricato entro il tempo previsto."""
+
+
+class LatencyStats:
+    """
+    Durate per passo della sessione (login, navigazione, attese overlay, download...).
+    Con una Telemetria collegata ogni misura diventa anche un evento nel file JSONL del giro.
+    """
+
+    def __init__(self, telemetria=None):
+        self.durate = {}
+        self.telemetria = telemetria
+
+    def registra(self, passo, secondi):
+        self.durate.setdefault(passo, []).append(secondi)
+
+    @contextmanager
+    def misura(self, passo):
+        """Misura un blocco; il dizionario restituito permette di impostarne l'esito (es. 'timeout')."""
+        esito = {"esito": ESITO_OK}
+        inizio_epoch, inizio = time.time(), time.perf_counter()
+        try:
+            yield esito
+        except Exception as e:
+            esito["esito"] = ESITO_ERRORE
+            esito.setdefault("errore", type(e).__name__)
+            raise
+        finally:
+            durata = time.perf_counter() - inizio
+            self.registra(passo, durata)
+            if self.telemetria is not None:
+                self.telemetria.registra_passo(passo, inizio_epoch, durata, **esito)
+
+    def riepilogo(self):
+        """Righe di riepilogo ordinate per tempo totale decrescente."""
+        righe = []
+        for passo, valori in sorted(self.durate.items(), key=lambda kv: -sum(kv[1])):
+            righe.append(f"  {passo:<28} n={len(valori):<3} totale={sum(valori):7.2f}s  medio={sum(valori) / len(valori):6.2f}s  max={max(valori):6.2f}s")
+        return righe
+
+
+def normalizza_profilo(profilo):
+    """Converte il valore letto da configurazione (json/xlsm) in uno dei PROFILI_BROWSER."""
+    profilo = str(profilo or PROFILO_VISIBILE).strip().lower()
+    if profilo not in PROFILI_BROWSER:
+        logger.warning(f"Profilo browser '{profilo}' non riconosciuto: uso '{PROFILO_VISIBILE}'.")
+        return PROFILO_VISIBILE
+    return profilo
+
+
+def crea_opzioni_chrome(download_dir, login_url=DEFAULT_LOGIN_URL, profilo=PROFILO_VISIBILE, user_data_dir=None):
+    """Opzioni Chrome comuni ai robot: download automatico senza avvisi, certificati permissivi."""
+    chrome_options = webdriver.ChromeOptions()
+    prefs = {
+        "download.default_directory": str(Path(download_dir).absolute()),
+        "download.prompt_for_download": False,
+        "download.directory_upgrade": True,
+        "safebrowsing.enabled": True,
+        "safebrowsing.disable_download_protection": True,
+        "profile.default_content_settings.popups": 0,
+        "profile.content_settings.exceptions.automatic_downloads.*.setting": 1
+    }
+    if profilo == PROFILO_PRESTAZIONI:
+        prefs["profile.managed_default_content_settings.images"] = 2
+    chrome_options.add_experimental_option("prefs", prefs)
+
+    # Argomenti per disabilitare le nuove feature di sicurezza di Chrome (Bubble, Warnings).
+    # Un solo --disable-features: Chrome considera soltanto l'ultima occorrenza dell'opzione.
+    chrome_options.add_argument("--disable-features=InsecureDownloadWarnings,DownloadBubble,DownloadBubbleV2")
+
+    if profilo == PROFILO_PRESTAZIONI:
+        chrome_options.add_argument("--headless=new")
+        chrome_options.add_argument(f"--window-size={VIEWPORT_PRESTAZIONI}")
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+        chrome_options.add_argument("--mute-audio")
+        chrome_options.add_argument("--disable-extensions")
+        chrome_options.add_argument("--disable-background-networking")
+        chrome_options.add_argument("--disable-renderer-backgrounding")
+        chrome_options.add_argument("--disable-default-apps")
+        chrome_options.add_argument("--no-first-run")
+        if user_data_dir:
+            chrome_options.add_argument(f"--user-data-dir={user_data_dir}")
+    else:
+        chrome_options.add_argument("--start-maximized")
+
+    # Altri argomenti permissivi
+    chrome_options.add_argument("--log-level=3")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--ignore-certificate-errors")
+    chrome_options.add_argument("--allow-running-insecure-content")
+    chrome_options.add_argument("--disable-web-security")
+    chrome_options.add_argument(f"--unsafely-treat-insecure-origin-as-secure={login_url}")
+    return chrome_options
+
+
+class PortalSession:
+    """
+    Sessione autenticata sul Portale Fornitori.
+
+    Uso tipico:
+        with PortalSession(url, utente, password, download_dir) as sessione:
+            sessione.login()
+            sessione.apri_report("Timesheet")
+            sessione.seleziona_fornitore(fornitore)
+            ...
+    """
+
+    def __init__(self, login_url, username, password, download_dir=None, screenshot_dir=None, cache_sessione=True,
+                 profilo=PROFILO_VISIBILE, nome_profilo="default", telemetria=None):
+        self.login_url = login_url or DEFAULT_LOGIN_URL
+        self.username = username
+        self.password = password
+        # Ogni sessione scarica in una cartella temporanea privata (dentro download_dir se indicata)
+        self.download_dir = crea_cartella_download(download_dir)
+        self.screenshot_dir = Path(screenshot_dir) if screenshot_dir else None
+        self.driver = None
+        self.stats = LatencyStats(telemetria)
+        # Cookie e localStorage della sessione autenticata, riusati tra lanci successivi dei robot
+        self.cache = SessionCache(self.login_url, username) if cache_sessione else None
+        self.sessione_ripristinata = False
+        self.profilo = normalizza_profilo(profilo)
+        # Nome della cartella del profilo Chrome persistente: browser in parallelo devono usarne di diverse
+        self.nome_profilo = nome_profilo
+        self.tempi_pagina = []
+
+    # --- Ciclo di vita ---
+    def avvia(self):
+        # Una sessione già avviata (es. consegnata da un BrowserPool) non va rilanciata
+        if self.driver is not None:
+            return self
+        with self.stats.misura("avvio_browser"):
+            logger.info(f"Inizializzazione WebDriver Chrome (profilo '{self.profilo}')...")
+            user_data_dir = None
+            if self.profilo == PROFILO_PRESTAZIONI:
+                user_data_dir = PROFILI_CHROME_DIR / self.nome_profilo
+                user_data_dir.mkdir(parents=True, exist_ok=True)
+            self.driver = webdriver.Chrome(options=crea_opzioni_chrome(self.download_dir, self.login_url, self.profilo, user_data_dir))
+            try:
+                # Rinforza via CDP la cartella impostata nelle preferenze (ignorato sui browser non Chromium)
+                self.driver.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": str(self.download_dir)})
+                if self.profilo == PROFILO_PRESTAZIONI:
+                    self.driver.execute_cdp_cmd("Network.enable", {})
+                    self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": URL_BLOCCATI})
+            except (AttributeError, WebDriverException):
+                pass
+        logger.info(f"Cartella di download della sessione: {self.download_dir}")
+        return self
+
+    def chiudi(self):
+        if self.driver:
+            logger.info("Chiusura del browser WebDriver...")
+            try:
+                self.driver.quit()
+            except WebDriverException as e:
+                logger.warning(f"Errore durante la chiusura del browser: {e}")
+            self.driver = None
+
+    def attiva(self):
+        """Sonda leggera: vero se il browser risponde ancora."""
+        if self.driver is None:
+            return False
+        try:
+            self.driver.execute_script("return document.readyState")
+            return True
+        except WebDriverException:
+            return False
+
+    def collega_telemetria(self, telemetria):
+        """Collega la telemetria di un giro a una sessione creata prima del giro (browser pronto)."""
+        self.stats.telemetria = telemetria
+
+    def rimuovi_cartella_download(self):
+        """Elimina la cartella temporanea di download: da chiamare dopo aver spostato/letto i file."""
+        rimuovi_cartella_download(self.download_dir)
+
+    def __enter__(self):
+        return self.avvia()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.chiudi()
+        return False
+
+    # --- Attese ---
+    def wait(self, timeout=20):
+        return WebDriverWait(self.driver, timeout, poll_frequency=POLL_SECONDI)
+
+    def attendi_pronto(self, timeout_secondi=45, passo="attesa_overlay", segno=None, attesa_avvio_secondi=0):
+        """
+        Attende che l'interfaccia Ext JS sia libera: nessuna richiesta Ajax in corso e nessuna
+        maschera di caricamento visibile. Con `segno` (vedi `segna_attivita`) attende anche che il
+        caricamento innescato dall'azione sia partito, per al massimo `attesa_avvio_secondi`.
+        Se l'hook non è utilizzabile ripiega sul polling XPath degli overlay.
+        """
+        with self.stats.misura(passo) as esito_passo:
+            esito = attendi_pronto_ext(self.driver, timeout_secondi, segno, attesa_avvio_secondi)
+            if esito is None:
+                pronto = self._attendi_overlay_xpath(timeout_secondi)
+                esito_passo.update(esito=ESITO_OK if pronto else ESITO_TIMEOUT, metodo="xpath")
+                return pronto
+            if not esito.get("ok"):
+                esito_passo["esito"] = ESITO_TIMEOUT
+                logger.warning(f"Timeout ({timeout_secondi}s) durante l'attesa del caricamento Ext JS. Proseguo con cautela.")
+                return False
+            if segno is not None and not esito.get("attivita"):
+                logger.warning(f"  Nessun caricamento rilevato entro {attesa_avvio_secondi}s dall'azione ({passo}).")
+            return True
+
+    def segna_attivita(self):
+        """Contatori di richieste/maschere da passare ad `attendi_pronto` prima di un'azione."""
+        return segna_attivita(self.driver)
+
+    def _attendi_overlay_xpath(self, timeout_secondi):
+        try:
+            self.wait(timeout_secondi).until(EC.invisibility_of_element_located((By.XPATH, XPATH_OVERLAY)))
+            return True
+        except TimeoutException:
+            logger.warning(f"Timeout ({timeout_secondi}s) durante l'attesa della scomparsa dell'overlay. Proseguo con cautela.")
+            return False
+
+    def clicca(self, xpath, timeout=20, via_js=False):
+        elemento = self.wait(timeout).until(EC.element_to_be_clickable((By.XPATH, xpath)))
+        if via_js:
+            self.driver.execute_script("arguments[0].click();", elemento)
+        else:
+            elemento.click()
+        return elemento
+
+    # --- Passi del portale ---
+    def login(self):
+        """
+        Login sul portale. Se in cache c'è una sessione ancora valida la ripristina; altrimenti
+        login completo con gestione dei popup 'sessione attiva' e 'OK'. Solleva LoginError se
+        'Report' non compare.
+        """
+        if self.cache is not None and self._ripristina_sessione():
+            return
+
+        with self.stats.misura("login"):
+            logger.info(f"Navigazione a: {self.login_url}")
+            self.driver.get(self.login_url)
+            self._registra_tempi_pagina()
+
+            logger.info("Login in corso...")
+            self.wait().until(EC.presence_of_element_located((By.NAME, "Username"))).send_keys(self.username)
+            self.wait().until(EC.presence_of_element_located((By.NAME, "Password"))).send_keys(self.password)
+            self.clicca(XPATH_ACCEDI)
+            self.attendi_pronto(60, passo="attesa_login")
+
+        with self.stats.misura("popup_login"):
+            self._gestisci_sessione_attiva()
+            try:
+                self.clicca(XPATH_OK, timeout=5)
+                logger.info("Pop-up 'OK' trovato e cliccato.")
+            except TimeoutException:
+                logger.info("Nessun pop-up 'OK' rilevato (normale).")
+
+        try:
+            self.wait().until(EC.visibility_of_element_located((By.XPATH, XPATH_REPORT)))
+            logger.info("Login effettuato con successo. Elemento 'Report' visibile.")
+        except TimeoutException:
+            self._salva_screenshot("login_failure")
+            raise LoginError("L'elemento 'Report' non è stato trovato dopo il login (credenziali errate, CAPTCHA o sito lento).")
+        if self.cache is not None:
+            self.cache.salva(self.driver)
+
+    def _ripristina_sessione(self, timeout_sonda=8):
+        """Ripristina la sessione dalla cache e verifica che il portale la accetti ancora."""
+        dati = self.cache.carica()
+        if not dati:
+            return False
+        with self.stats.misura("ripristino_sessione"):
+            logger.info("Sessione in cache trovata: tentativo di ripristino...")
+            try:
+                # Cookie e localStorage si possono impostare solo stando sul dominio del portale
+                self.driver.get(self.login_url)
+                self.cache.applica(self.driver, dati)
+                self.driver.get(self.login_url)
+                self._registra_tempi_pagina()
+                # Sonda: compare il menu 'Report' (sessione valida) oppure il form di login (scaduta)
+                self.wait(timeout_sonda).until(lambda d: d.find_elements(By.XPATH, XPATH_REPORT) or d.find_elements(By.NAME, "Username"))
+                report = [e for e in self.driver.find_elements(By.XPATH, XPATH_REPORT) if e.is_displayed()]
+            except (TimeoutException, WebDriverException) as e:
+                logger.info(f"Ripristino della sessione non riuscito ({type(e).__name__}).")
+                report = []
+            if report:
+                self.attendi_pronto(passo="attesa_login")
+                self.sessione_ripristinata = True
+                logger.info("Sessione ripristinata dalla cache: login saltato.")
+                return True
+        logger.info("Sessione in cache scaduta: eseguo il login completo.")
+        self.cache.invalida()
+        return False
+
+    def _gestisci_sessione_attiva(self):
+        """Se il portale segnala una sessione già attiva, conferma con 'Si'."""
+        messaggi = [m for m in self.driver.find_elements(By.XPATH, XPATH_SESSIONE_ATTIVA) if m.is_displayed()]
+        if not messaggi:
+            return
+        logger.info("Rilevata sessione attiva. Clicco su 'Si'...")
+        try:
+            self.clicca(XPATH_SI, timeout=5)
+            self.attendi_pronto(60, passo="attesa_login")
+        except TimeoutException:
+            logger.warning("Pulsante 'Si' della sessione attiva non trovato.")
+
+    def apri_report(self, voce):
+        """Naviga Report -> voce (es. 'Timesheet', 'Timbrature')."""
+        with self.stats.misura("navigazione"):
+            logger.info(f"Navigazione menu: Report -> {voce}")
+            self.clicca(XPATH_REPORT)
+            self.attendi_pronto()
+            segno = self.segna_attivita()
+            self.clicca(f"//span[contains(@id, 'generic_menu_button')][.//span[text()='{voce}']] | //span[text()='{voce}']")
+            self.attendi_pronto(segno=segno, attesa_avvio_secondi=2)
+
+    def seleziona_fornitore(self, fornitore):
+        with self.stats.misura("selezione_fornitore"):
+            logger.info(f"  Seleziono il fornitore: '{fornitore}'...")
+            try:
+                trigger = self.wait().until(EC.element_to_be_clickable((By.XPATH, XPATH_TRIGGER_FORNITORE)))
+            except TimeoutException:
+                logger.warning(" -> Trigger specifico non trovato, provo quello generico...")
+                trigger = self.wait(5).until(EC.element_to_be_clickable((By.XPATH, XPATH_TRIGGER_GENERICO)))
+            ActionChains(self.driver).move_to_element(trigger).click().perform()
+            self.attendi_pronto()
+
+            opzione = self.wait(30).until(EC.presence_of_element_located((By.XPATH, f"//li[normalize-space(text())='{fornitore}']")))
+            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'}); arguments[0].click();", opzione)
+            self.attendi_pronto()
+
+            # Verifica che il campo sia stato effettivamente popolato
+            campo = self.driver.find_element(By.NAME, "CodiceFornitore")
+            if not campo.get_attribute("value"):
+                logger.warning("  ATTENZIONE: Il campo Fornitore risulta vuoto! Provo inserimento manuale...")
+                campo.send_keys(fornitore)
+                try:
+                    self.wait(5).until(lambda d: campo.get_attribute("value"))
+                except TimeoutException:
+                    pass
+                self.driver.execute_script("arguments[0].dispatchEvent(new Event('change', {bubbles:true}));", campo)
+            logger.info(f"  Fornitore '{fornitore}' selezionato.")
+
+    def imposta_testo(self, nome_campo, valore):
+        """Digita il valore in un campo del form (es. le date)."""
+        campo = self.wait().until(EC.visibility_of_element_located((By.NAME, nome_campo)))
+        campo.clear()
+        campo.send_keys(valore)
+
+    def imposta_valore(self, nome_campo, valore):
+        """Imposta il valore via JS e notifica Ext JS con un evento 'change'."""
+        campo = self.wait().until(EC.presence_of_element_located((By.NAME, nome_campo)))
+        self.driver.execute_script(JS_IMPOSTA_VALORE, campo, str(valore))
+
+    def cerca(self, timeout_secondi=90):
+        """Clicca 'Cerca' e attende i risultati; restituisce False se la griglia non si è liberata in tempo."""
+        with self.stats.misura("cerca"):
+            logger.info("  Click sul pulsante 'Cerca'...")
+            segno = self.segna_attivita()
+            self.clicca(XPATH_CERCA)
+            # Lo store della griglia può partire con un attimo di ritardo rispetto al click
+            return self.attendi_pronto(timeout_secondi, passo="attesa_risultati", segno=segno, attesa_avvio_secondi=5)
+
+    def scarica_excel(self, timeout_secondi=45):
+        """Clicca l'icona Excel e attende il nuovo .xlsx nella cartella della sessione. Solleva DownloadError."""
+        with self.stats.misura("download"):
+            watcher = DownloadWatcher(self.download_dir).avvia()
+            try:
+                pulsante = self.wait().until(EC.element_to_be_clickable((By.XPATH, XPATH_EXCEL)))
+                # Click via JS per evitare ElementClickInterceptedException se ci sono overlay sopra
+                self.driver.execute_script("arguments[0].click();", pulsante)
+            except Exception:
+                watcher.ferma()
+                raise
+            logger.info(f"  Click eseguito. Attendo il completamento (max {timeout_secondi}s)...")
+
+            trovato = watcher.attendi(timeout_secondi)
+            if trovato is None:
+                raise DownloadError(f"Nessun file Excel scaricato entro {timeout_secondi}s.")
+            logger.info(f"  Download COMPLETATO. File rilevato: {trovato.name}")
+            return trovato
+
+    def logout(self):
+        with self.stats.misura("logout"):
+            logger.info("Tentativo di Logout...")
+            try:
+                self.clicca(XPATH_IMPOSTAZIONI_UTENTE)
+                self.clicca(XPATH_ESCI)
+                self.clicca(XPATH_SI, via_js=True)
+                logger.info("Logout eseguito.")
+                WebDriverWait(self.driver, 10).until(EC.url_contains("Login"))
+                logger.info("Ritorno alla pagina di login confermato.")
+                # La sessione salvata non è più valida dopo il logout
+                if self.cache is not None:
+                    self.cache.invalida()
+            except Exception as e_logout:
+                logger.warning(f"ATTENZIONE: Errore o timeout durante il logout: {e_logout}")
+
+    def _registra_tempi_pagina(self):
+        """Tempi di caricamento della pagina dalla Navigation Timing API (ms dall'inizio della navigazione)."""
+        try:
+            tempi = self.driver.execute_script(JS_TEMPI_PAGINA)
+        except WebDriverException:
+            return
+        if not tempi:
+            return
+        self.tempi_pagina.append(tempi)
+        if self.stats.telemetria is not None:
+            self.stats.telemetria.evento("tempi_pagina", profilo=self.profilo, **tempi)
+        self.stats.registra("pagina_dom_pronto", tempi["dom"] / 1000)
+        self.stats.registra("pagina_caricata", tempi["load"] / 1000)
+
+    def _salva_screenshot(self, prefisso):
+        if not (self.driver and self.screenshot_dir):
+            return
+        screenshot_path = self.screenshot_dir / f"{prefisso}_{datetime.now():%Y%m%d_%H%M%S}.png"
+        try:
+            self.driver.save_screenshot(str(screenshot_path))
+            logger.info(f"Screenshot del fallimento salvato in: {screenshot_path}")
+        except Exception as e_shot:
+            logger.error(f"Impossibile salvare lo screenshot: {e_shot}")
+
+    def log_statistiche(self):
+        """Scrive sul log la tabella delle latenze per passo."""
+        if not self.stats.durate:
+            return
+        logger.info(f"TEMPI PER PASSO (profilo '{self.profilo}', ordinati per tempo totale):")
+        for riga in self.stats.riepilogo():
+            logger.info(riga)
+        for tempi in self.tempi_pagina:
+            logger.info(f"  Pagina: DOM pronto {tempi['dom']:.0f} ms, caricata {tempi['load']:.0f} ms, "
+                        f"{tempi['risorse']} risorse, {tempi['byte'] / 1024:.0f} KB trasferiti")
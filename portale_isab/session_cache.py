@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Cache della sessione autenticata sul Portale Fornitori.
+
+Dopo un login riuscito salva i cookie e il localStorage del portale; al
+lancio successivo (anche dell'altro robot) li ripristina e verifica con una
+sonda leggera che il menu 'Report' compaia, evitando credenziali, popup
+'sessione attiva' e attese di login. Se la sessione è scaduta la cache viene
+invalidata e si esegue il login completo. Su Windows, con pywin32 installato,
+il file è cifrato con DPAPI (leggibile solo dall'utente che l'ha scritto).
+"""
+
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+
+try:
+    import win32crypt
+    WIN32CRYPT_AVAILABLE = True
+except ImportError:
+    WIN32CRYPT_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path.home() / ".portale_isab"
+CACHE_VERSION = 1
+# Oltre questa età la sessione non viene nemmeno provata: il portale l'avrà già chiusa
+DURATA_MASSIMA_ORE = 8
+
+JS_LEGGI_STORAGE = "var d = {}; for (var i = 0; i < localStorage.length; i++) { var k = localStorage.key(i); d[k] = localStorage.getItem(k); } return d;"
+JS_SCRIVI_STORAGE = "var d = arguments[0]; for (var k in d) { localStorage.setItem(k, d[k]); }"
+
+
+class SessionCache:
+    """File di cache della sessione, uno per coppia (URL del portale, utente)."""
+
+    def __init__(self, login_url, username, cache_dir=None):
+        self.login_url = login_url
+        self.username = username
+        chiave = hashlib.sha256(f"{login_url}|{username}".encode("utf-8")).hexdigest()[:16]
+        self.path = Path(cache_dir or CACHE_DIR) / f"sessione_{chiave}.bin"
+
+    def _codifica(self, dati):
+        raw = json.dumps(dati, ensure_ascii=False).encode("utf-8")
+        if WIN32CRYPT_AVAILABLE:
+            return b"D" + win32crypt.CryptProtectData(raw, "portale_isab", None, None, None, 0)
+        return b"J" + raw
+
+    def _decodifica(self, blob):
+        if blob[:1] == b"D":
+            if not WIN32CRYPT_AVAILABLE:
+                return None
+            raw = win32crypt.CryptUnprotectData(blob[1:], None, None, None, 0)[1]
+        elif blob[:1] == b"J":
+            raw = blob[1:]
+        else:
+            return None
+        return json.loads(raw.decode("utf-8"))
+
+    def salva(self, driver):
+        """Salva cookie e localStorage della sessione corrente del driver."""
+        try:
+            dati = {
+                "versione": CACHE_VERSION,
+                "url": self.login_url,
+                "utente": self.username,
+                "salvata": datetime.now().isoformat(timespec="seconds"),
+                "cookies": driver.get_cookies(),
+                "local_storage": driver.execute_script(JS_LEGGI_STORAGE) or {},
+            }
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(self._codifica(dati))
+            try:
+                os.chmod(tmp_path, 0o600)
+            except OSError:
+                pass
+            os.replace(tmp_path, self.path)
+            logger.info("Sessione del portale salvata in cache.")
+        except Exception as e:
+            logger.warning(f"Impossibile salvare la sessione in cache: {e}")
+
+    def carica(self):
+        """Restituisce i dati della sessione salvata se presenti, coerenti e non troppo vecchi."""
+        if not self.path.exists():
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                dati = self._decodifica(f.read())
+        except Exception as e:
+            logger.warning(f"Cache della sessione illeggibile ({e}): verrà ignorata.")
+            return None
+        if not dati or dati.get("versione") != CACHE_VERSION or dati.get("url") != self.login_url or dati.get("utente") != self.username:
+            return None
+        if datetime.now() - datetime.fromisoformat(dati["salvata"]) > timedelta(hours=DURATA_MASSIMA_ORE):
+            self.invalida()
+            return None
+        return dati
+
+    def applica(self, driver, dati):
+        """Installa cookie e localStorage salvati. Il driver deve trovarsi già sul dominio del portale."""
+        driver.delete_all_cookies()
+        for cookie in dati.get("cookies", []):
+            cookie = {k: v for k, v in cookie.items() if k in ("name", "value", "path", "domain", "secure", "httpOnly", "expiry", "sameSite")}
+            if "expiry" in cookie:
+                cookie["expiry"] = int(cookie["expiry"])
+            try:
+                driver.add_cookie(cookie)
+            except Exception as e:
+                logger.debug(f"Cookie '{cookie.get('name')}' non ripristinabile: {e}")
+        if dati.get("local_storage"):
+            driver.execute_script(JS_SCRIVI_STORAGE, dati["local_storage"])
+
+    def invalida(self):
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
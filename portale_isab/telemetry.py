@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Telemetria strutturata dei passi dei robot.
+
+Ogni giro scrive un file JSON-lines (un evento per riga) con nome del passo,
+istanti di inizio e fine, durata ed esito (ok, timeout, errore), più il
+contesto corrente (es. OdA o finestra di date). Il comando di report aggrega
+i file di tutti i giri e confronta l'ultimo giro con lo storico:
+
+    python -m portale_isab.telemetry report --cartella controllo_canoni_ts/telemetria
+"""
+
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+ESITO_OK = "ok"
+ESITO_TIMEOUT = "timeout"
+ESITO_ERRORE = "errore"
+# Un passo è in regressione se la mediana dell'ultimo giro supera di questo fattore la mediana storica
+SOGLIA_REGRESSIONE = 1.5
+# Sotto questa durata le variazioni non sono significative (rumore di rete/driver)
+DURATA_MINIMA_REGRESSIONE = 0.5
+
+
+class Telemetria:
+    """Scrittore thread-safe degli eventi di un giro in <cartella>/<robot>_<data>_<id>.jsonl."""
+
+    def __init__(self, robot, cartella):
+        self.robot = robot
+        self.run_id = uuid.uuid4().hex[:12]
+        self.cartella = Path(cartella)
+        self.cartella.mkdir(parents=True, exist_ok=True)
+        self.path = self.cartella / f"{robot}_{datetime.now():%Y%m%d_%H%M%S}_{self.run_id}.jsonl"
+        self._lock = threading.Lock()
+        self._locale = threading.local()
+
+    def _contesto_corrente(self):
+        return getattr(self._locale, "contesto", {})
+
+    @contextmanager
+    def contesto(self, **campi):
+        """Aggiunge i campi (es. oda=...) a tutti gli eventi emessi dal thread corrente nel blocco."""
+        precedente = self._contesto_corrente()
+        self._locale.contesto = {**precedente, **campi}
+        try:
+            yield
+        finally:
+            self._locale.contesto = precedente
+
+    def evento(self, passo, **campi):
+        voce = {"run": self.run_id, "robot": self.robot, "passo": passo, **self._contesto_corrente(), **campi}
+        riga = json.dumps(voce, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(riga + "\n")
+
+    def registra_passo(self, passo, inizio_epoch, durata, esito=ESITO_OK, **campi):
+        self.evento(passo,
+                    inizio=datetime.fromtimestamp(inizio_epoch).isoformat(timespec="milliseconds"),
+                    fine=datetime.fromtimestamp(inizio_epoch + durata).isoformat(timespec="milliseconds"),
+                    durata_s=round(durata, 4), esito=esito, **campi)
+
+    @contextmanager
+    def passo(self, nome, **campi):
+        """Misura un blocco. Il dizionario restituito permette di impostare 'esito' e altri campi."""
+        esito = {"esito": ESITO_OK}
+        inizio_epoch, inizio = time.time(), time.perf_counter()
+        try:
+            yield esito
+        except Exception as e:
+            esito["esito"] = ESITO_ERRORE
+            esito.setdefault("errore", type(e).__name__)
+            raise
+        finally:
+            self.registra_passo(nome, inizio_epoch, time.perf_counter() - inizio, **{**campi, **esito})
+
+
+# --- Report ---
+
+def percentile(valori, p):
+    """Percentile con interpolazione lineare (valori non vuoti)."""
+    valori = sorted(valori)
+    if len(valori) == 1:
+        return valori[0]
+    k = (len(valori) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(valori) - 1)
+    return valori[f] + (valori[c] - valori[f]) * (k - f)
+
+
+def leggi_eventi(cartella, robot=None):
+    eventi = []
+    for path in sorted(Path(cartella).glob("*.jsonl")):
+        with open(path, "r", encoding="utf-8") as f:
+            for riga in f:
+                try:
+                    voce = json.loads(riga)
+                except json.JSONDecodeError:
+                    continue
+                if "durata_s" in voce and (robot is None or voce.get("robot") == robot):
+                    eventi.append(voce)
+    return eventi
+
+
+def genera_report(eventi, soglia=SOGLIA_REGRESSIONE):
+    """
+    Restituisce le righe del report: p50/p95 per (robot, passo) su tutti i giri, esiti non ok
+    e confronto della mediana dell'ultimo giro di ogni robot con quella dei giri precedenti.
+    """
+    per_passo = defaultdict(list)
+    per_run = defaultdict(lambda: defaultdict(list))
+    ordine_run = defaultdict(list)
+    non_ok = defaultdict(int)
+    for e in eventi:
+        chiave = (e["robot"], e["passo"])
+        per_passo[chiave].append(e["durata_s"])
+        per_run[chiave][e["run"]].append(e["durata_s"])
+        if e["run"] not in ordine_run[e["robot"]]:
+            ordine_run[e["robot"]].append(e["run"])
+        if e.get("esito", ESITO_OK) != ESITO_OK:
+            non_ok[chiave] += 1
+
+    righe = [f"{'robot':<12} {'passo':<26} {'n':>5} {'p50':>8} {'p95':>8} {'non ok':>7}  ultimo giro"]
+    regressioni = []
+    for (robot, passo), durate in sorted(per_passo.items()):
+        ultimo_run = ordine_run[robot][-1]
+        ultime = per_run[(robot, passo)].get(ultimo_run, [])
+        storiche = [d for run, valori in per_run[(robot, passo)].items() if run != ultimo_run for d in valori]
+        confronto = ""
+        if ultime and storiche:
+            p50_ultimo, p50_storico = percentile(ultime, 50), percentile(storiche, 50)
+            confronto = f"p50 {p50_ultimo:.2f}s vs {p50_storico:.2f}s"
+            if p50_ultimo >= DURATA_MINIMA_REGRESSIONE and p50_ultimo > p50_storico * soglia:
+                confronto += "  << REGRESSIONE"
+                regressioni.append((robot, passo, p50_ultimo, p50_storico))
+        righe.append(f"{robot:<12} {passo:<26} {len(durate):>5} {percentile(durate, 50):>7.2f}s {percentile(durate, 95):>7.2f}s "
+                     f"{non_ok[(robot, passo)]:>7}  {confronto}")
+    if regressioni:
+        righe.append("")
+        righe.append(f"{len(regressioni)} passi in regressione (mediana ultimo giro > {soglia:.1f}x storico):")
+        for robot, passo, ultimo, storico in regressioni:
+            righe.append(f"  - {robot}/{passo}: {ultimo:.2f}s (storico {storico:.2f}s)")
+    return righe, regressioni
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report della telemetria dei robot del Portale Fornitori.")
+    sotto = parser.add_subparsers(dest="comando", required=True)
+    report = sotto.add_parser("report", help="p50/p95 per passo e regressioni dell'ultimo giro.")
+    report.add_argument("--cartella", action="append", required=True, help="Cartella con i file .jsonl (ripetibile).")
+    report.add_argument("--robot", help="Limita il report a un robot (canoni, timbrature).")
+    report.add_argument("--soglia", type=float, default=SOGLIA_REGRESSIONE, help="Fattore oltre il quale segnalare una regressione.")
+    args = parser.parse_args(argv)
+
+    eventi = []
+    for cartella in args.cartella:
+        eventi.extend(leggi_eventi(cartella, args.robot))
+    if not eventi:
+        print("Nessun evento di telemetria trovato.")
+        return 0
+    righe, regressioni = genera_report(eventi, args.soglia)
+    print("\n".join(righe))
+    # Codice di uscita non nullo in caso di regressioni, utile in uno script pianificato
+    return 1 if regressioni else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
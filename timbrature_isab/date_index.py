@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Indice persistente dei giorni presenti nel database timbrature.
+
+Per ogni Sito registra i giorni che hanno almeno una timbratura (colonna
+'Data Timbratura'), più i giorni già interrogati sul portale e risultati vuoti
+(domeniche, festivi), per tutti i Siti o solo per alcuni. Gli ultimi giorni
+non vengono mai dati per verificati: il portale può pubblicarli in ritardo. Serve a calcolare le lacune da recuperare invece di
+scaricare sempre e solo "ieri". Viene aggiornato a ogni ingest con le sole
+righe nuove e ricostruito quando l'xlsm o il delta sono stati modificati a mano.
+"""
+
+import os
+import json
+import logging
+from pathlib import Path
+from datetime import datetime, date, timedelta
+
+import openpyxl
+
+from delta_store import DeltaStore, stato_file
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".dateidx.json"
+INDEX_VERSION = 2
+DATA_COLUMN_INDEX = 1 # Colonna B 'Data Timbratura'
+SITO_COLUMN_INDEX = 15 # Colonna P 'Sito Timbratura'
+SITO_NON_SPECIFICATO = "Non Specificato"
+# Giorno verificato vuoto per tutti i Siti
+TUTTI_I_SITI = "*"
+# Giorni (fino a oggi) che un'interrogazione vuota non rende verificati: le timbrature possono arrivare dopo
+GIORNI_ASSESTAMENTO = 3
+
+
+def giorno_riga(row):
+    """Estrae il giorno della timbratura (colonna 'Data Timbratura') da una riga."""
+    value = row[DATA_COLUMN_INDEX] if len(row) > DATA_COLUMN_INDEX else None
+    if isinstance(value, datetime): return value.date()
+    if isinstance(value, date): return value
+    if isinstance(value, str):
+        for fmt in ('%d/%m/%Y', '%d.%m.%Y', '%Y-%m-%d'):
+            try: return datetime.strptime(value.strip()[:10], fmt).date()
+            except ValueError: continue
+    return None
+
+
+def sito_riga(row):
+    value = row[SITO_COLUMN_INDEX] if len(row) > SITO_COLUMN_INDEX else None
+    value = str(value).strip() if value is not None else ""
+    return value or SITO_NON_SPECIFICATO
+
+
+def intervalli_contigui(giorni):
+    """Raggruppa un insieme di giorni in intervalli contigui [(da, a), ...]."""
+    intervalli = []
+    for giorno in sorted(giorni):
+        if intervalli and giorno == intervalli[-1][1] + timedelta(days=1):
+            intervalli[-1] = (intervalli[-1][0], giorno)
+        else:
+            intervalli.append((giorno, giorno))
+    return intervalli
+
+
+class DateIndex:
+    """Giorni con timbrature per Sito, persistiti in JSON accanto all'xlsm."""
+
+    def __init__(self, database_path, sheet_name, delta_store=None):
+        self.database_path = Path(database_path)
+        self.sheet_name = sheet_name
+        self.delta_store = delta_store or DeltaStore(self.database_path)
+        self.path = self.database_path.with_name(self.database_path.stem + INDEX_SUFFIX)
+        self.giorni = {}
+        self.verificati_vuoti = {} # giorno -> Siti senza timbrature (TUTTI_I_SITI se il giorno è vuoto)
+
+    def _stato_atteso(self):
+        return {"xlsm": list(stato_file(self.database_path)), "delta": stato_file(self.delta_store.path)[0]}
+
+    def _registra_giorno(self, giorno, sito):
+        if giorno is not None:
+            self.giorni.setdefault(sito, set()).add(giorno)
+
+    def _leggi(self):
+        if not self.path.exists():
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if payload.get("versione") != INDEX_VERSION:
+            return None
+        self.giorni = {sito: set(date.fromisoformat(g) for g in giorni) for sito, giorni in payload.get("giorni", {}).items()}
+        self.verificati_vuoti = {date.fromisoformat(g): set(siti) for g, siti in payload.get("verificati_vuoti", {}).items()}
+        return payload.get("stato")
+
+    def _scrivi(self):
+        payload = {
+            "versione": INDEX_VERSION,
+            "stato": self._stato_atteso(),
+            "giorni": {sito: sorted(g.isoformat() for g in giorni) for sito, giorni in self.giorni.items()},
+            "verificati_vuoti": {g.isoformat(): sorted(siti) for g, siti in sorted(self.verificati_vuoti.items())},
+        }
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def ricostruisci(self):
+        logger.info(f"  Ricostruzione indice date da '{self.database_path.name}'...")
+        self.giorni = {}
+        if self.database_path.exists():
+            wb = openpyxl.load_workbook(self.database_path, read_only=True)
+            try:
+                if self.sheet_name in wb.sheetnames:
+                    for row in wb[self.sheet_name].iter_rows(min_row=2, values_only=True):
+                        self._registra_giorno(giorno_riga(row), sito_riga(row))
+            finally:
+                wb.close()
+        for row in self.delta_store.righe():
+            self._registra_giorno(giorno_riga(row), sito_riga(row))
+        # I giorni verificati vuoti non sono ricavabili dal database: si conservano
+        self._scrivi()
+        logger.info(f"  Indice date ricostruito: {sum(len(g) for g in self.giorni.values())} giorni/sito.")
+
+    def carica(self):
+        """Carica l'indice; lo ricostruisce se manca o se il database è stato modificato esternamente."""
+        stato = self._leggi()
+        if stato is None:
+            logger.info("  Indice date assente o non valido.")
+            self.ricostruisci()
+        elif stato != self._stato_atteso():
+            logger.warning("  Il database o il delta risultano modificati esternamente: l'indice date va ricostruito.")
+            self.ricostruisci()
+        return self
+
+    def registra_righe(self, rows):
+        """Aggiorna l'indice con le sole righe appena accodate al delta."""
+        for row in rows:
+            self._registra_giorno(giorno_riga(row), sito_riga(row))
+        self._scrivi()
+
+    def segna_vuoti(self, giorni, siti_per_giorno):
+        """
+        Registra i giorni interrogati sul portale: un giorno senza timbrature è verificato vuoto per
+        tutti i Siti, uno con timbrature solo di alcuni Siti lo è per gli altri Siti noti.
+        `siti_per_giorno` sono i Siti presenti nelle righe scaricate. Gli ultimi GIORNI_ASSESTAMENTO
+        giorni non vengono registrati e restano lacune finché le timbrature non arrivano.
+        """
+        limite = date.today() - timedelta(days=GIORNI_ASSESTAMENTO)
+        for giorno in giorni:
+            if giorno >= limite:
+                continue
+            presenti = siti_per_giorno.get(giorno, set())
+            vuoti = set(self.giorni) - presenti if presenti else {TUTTI_I_SITI}
+            if vuoti:
+                self.verificati_vuoti.setdefault(giorno, set()).update(vuoti)
+        self._scrivi()
+
+    def _verificato_vuoto(self, giorno, sito=TUTTI_I_SITI):
+        siti = self.verificati_vuoti.get(giorno, ())
+        return TUTTI_I_SITI in siti or sito in siti
+
+    def sincronizza_stato(self):
+        """Riallinea lo stato registrato dopo una modifica del database fatta dallo script (es. compattazione)."""
+        self._scrivi()
+
+    def siti(self):
+        return sorted(self.giorni)
+
+    def lacune(self, data_da, data_a, per_sito=False):
+        """
+        Restituisce i giorni di [data_da, data_a] senza timbrature.
+        Con `per_sito` un giorno è lacuna se manca anche per un solo Sito noto;
+        altrimenti solo se non ha timbrature in nessun Sito.
+        """
+        giorni_periodo = set()
+        giorno = data_da
+        while giorno <= data_a:
+            giorni_periodo.add(giorno)
+            giorno += timedelta(days=1)
+
+        if per_sito and self.giorni:
+            # Si considerano solo i Siti attivi nel periodo o nel mese precedente,
+            # altrimenti un Sito dismesso genererebbe lacune per sempre
+            inizio_attivita = data_da - timedelta(days=31)
+            mancanti = set()
+            for sito, giorni_sito in self.giorni.items():
+                if any(inizio_attivita <= g <= data_a for g in giorni_sito):
+                    mancanti |= {g for g in giorni_periodo - giorni_sito if not self._verificato_vuoto(g, sito)}
+        else:
+            presenti = set().union(*self.giorni.values()) if self.giorni else set()
+            mancanti = {g for g in giorni_periodo - presenti if not self._verificato_vuoto(g)}
+        return sorted(mancanti)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Archivio delta append-only per il database delle timbrature.
+
+Le nuove righe scaricate dal portale vengono accodate in un file JSON-lines
+accanto a `database_timbrature_isab.xlsm` (il "delta"), senza aprire né
+riscrivere la cartella di lavoro. La compattazione riversa periodicamente il
+delta nel foglio 'Dati' con un unico caricamento/salvataggio dell'xlsm.
+"""
+
+import json
+import os
+import logging
+from pathlib import Path
+from datetime import datetime, date, time
+
+import openpyxl
+
+logger = logging.getLogger(__name__)
+
+DELTA_SUFFIX = ".delta.jsonl"
+
+
+def percorso_delta(database_path):
+    """Restituisce il percorso del file delta associato al database."""
+    database_path = Path(database_path)
+    return database_path.with_name(database_path.stem + DELTA_SUFFIX)
+
+
+def stato_file(path):
+    """(dimensione, mtime_ns) del file, (0, 0) se non esiste: indici e cache lo confrontano con quello registrato."""
+    path = Path(path)
+    if not path.exists():
+        return 0, 0
+    st = path.stat()
+    return st.st_size, st.st_mtime_ns
+
+
+def normalizza_riga(row):
+    """
+    Normalizza una riga in una tupla di stringhe per il confronto dei duplicati (le celle vuote
+    finali non contano). Unica forma usata sia dalla compattazione sia dalle impronte dello scarico.
+    """
+    normalized = [str(cell).strip() if cell is not None else "" for cell in row]
+    while normalized and normalized[-1] == "":
+        normalized.pop()
+    return tuple(normalized)
+
+
+def _codifica_cella(value):
+    # datetime prima di date: datetime è una sottoclasse di date
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, date):
+        return {"$d": value.isoformat()}
+    if isinstance(value, time):
+        return {"$t": value.isoformat()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _decodifica_cella(value):
+    if isinstance(value, dict):
+        if "$dt" in value: return datetime.fromisoformat(value["$dt"])
+        if "$d" in value: return date.fromisoformat(value["$d"])
+        if "$t" in value: return time.fromisoformat(value["$t"])
+    return value
+
+
+class DeltaStore:
+    """File delta append-only (una riga JSON per timbratura) affiancato all'xlsm."""
+
+    def __init__(self, database_path):
+        self.database_path = Path(database_path)
+        self.path = percorso_delta(self.database_path)
+
+    def esiste(self):
+        return self.path.exists() and self.path.stat().st_size > 0
+
+    def accoda(self, rows, intestazione=None):
+        """Accoda le righe al delta. Il costo dipende solo dal numero di righe nuove."""
+        rows = list(rows)
+        if not rows and intestazione is None:
+            return 0
+        with open(self.path, "a", encoding="utf-8") as f:
+            if intestazione is not None:
+                f.write(json.dumps({"intestazione": [_codifica_cella(c) for c in intestazione]}, ensure_ascii=False) + "\n")
+            for row in rows:
+                f.write(json.dumps({"riga": [_codifica_cella(c) for c in row]}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return len(rows)
+
+    def _voci(self):
+        if not self.path.exists():
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Tipicamente l'ultima riga troncata da un'interruzione durante la scrittura
+                    logger.warning(f"  Delta: riga {line_no} non leggibile, ignorata.")
+
+    def righe(self):
+        """Restituisce le righe in attesa di compattazione, con i tipi originali."""
+        return [[_decodifica_cella(c) for c in voce["riga"]] for voce in self._voci() if "riga" in voce]
+
+    def intestazione(self):
+        header = None
+        for voce in self._voci():
+            if "intestazione" in voce:
+                header = [_decodifica_cella(c) for c in voce["intestazione"]]
+        return header
+
+    def conteggio(self):
+        return sum(1 for voce in self._voci() if "riga" in voce)
+
+    def svuota(self):
+        if self.path.exists():
+            os.remove(self.path)
+
+    def compatta(self, sheet_name):
+        """
+        Riversa il delta nel foglio indicato dell'xlsm con un solo caricamento e salvataggio.
+        Le righe già presenti nel database vengono scartate, così un'interruzione tra il
+        salvataggio e lo svuotamento del delta non produce duplicati al giro successivo.
+        Restituisce il numero di righe aggiunte.
+        """
+        pending = self.righe()
+        if not pending:
+            logger.info("  Compattazione: nessuna riga in attesa nel delta.")
+            self.svuota()
+            return 0
+
+        logger.info(f"  Compattazione di {len(pending)} righe dal delta in '{self.database_path.name}'...")
+        wb_dest = openpyxl.load_workbook(self.database_path, keep_vba=True)
+        try:
+            sheet_dest = wb_dest[sheet_name] if sheet_name in wb_dest.sheetnames else wb_dest.create_sheet(sheet_name)
+
+            if sheet_dest.max_row <= 1:
+                header = self.intestazione()
+                if header and not any(c is not None for c in next(sheet_dest.iter_rows(max_row=1, values_only=True), ())):
+                    sheet_dest.append(header)
+
+            existing_rows = set(normalizza_riga(row) for row in sheet_dest.iter_rows(min_row=2, values_only=True))
+            rows_added = 0
+            for row in pending:
+                normalized = normalizza_riga(row)
+                if normalized in existing_rows:
+                    continue
+                sheet_dest.append(row)
+                existing_rows.add(normalized)
+                rows_added += 1
+
+            if rows_added > 0:
+                # Salvataggio su file temporaneo e sostituzione atomica: l'xlsm non resta mai a metà
+                tmp_path = self.database_path.with_name(self.database_path.name + ".tmp")
+                wb_dest.save(tmp_path)
+                os.replace(tmp_path, self.database_path)
+        finally:
+            wb_dest.close()
+
+        self.svuota()
+        logger.info(f"  Compattazione completata: {rows_added} righe aggiunte, {len(pending) - rows_added} già presenti.")
+        return rows_added
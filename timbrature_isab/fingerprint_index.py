@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Indice persistente delle impronte di riga per la deduplicazione delle timbrature.
+
+Ogni riga del database (foglio 'Dati' + delta in attesa) è rappresentata da un
+hash a 64 bit della sua forma normalizzata. L'indice vive in un file binario
+accanto all'xlsm: un blocco ordinato (ricerca binaria) seguito da una coda di
+impronte accodate dagli ultimi scarichi. L'intestazione registra dimensione e
+data di modifica dell'xlsm e la dimensione del delta: se non corrispondono più
+(modifica manuale del database) l'indice viene ricostruito.
+"""
+
+import os
+import sys
+import struct
+import hashlib
+import logging
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+
+import openpyxl
+
+from delta_store import DeltaStore, normalizza_riga, stato_file
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".fpidx"
+INDEX_MAGIC = b"FPIX"
+INDEX_VERSION = 1
+# magic, versione, riservato, dimensione xlsm, mtime_ns xlsm, dimensione delta, impronte ordinate
+HEADER = struct.Struct("<4sHHqqqq")
+# Oltre questa soglia la coda viene fusa nel blocco ordinato al salvataggio successivo
+MAX_CODA = 4096
+
+
+def impronta_riga(row):
+    """Hash a 64 bit della riga normalizzata con delta_store.normalizza_riga."""
+    digest = hashlib.blake2b("\x1f".join(normalizza_riga(row)).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class FingerprintIndex:
+    """Insieme persistente di impronte a larghezza fissa (8 byte per riga)."""
+
+    def __init__(self, database_path, sheet_name, delta_store=None):
+        self.database_path = Path(database_path)
+        self.sheet_name = sheet_name
+        self.delta_store = delta_store or DeltaStore(self.database_path)
+        self.path = self.database_path.with_name(self.database_path.stem + INDEX_SUFFIX)
+        self._ordinate = array("Q")
+        self._coda = set()
+
+    def __len__(self):
+        return len(self._ordinate) + len(self._coda)
+
+    def __contains__(self, fingerprint):
+        i = bisect_left(self._ordinate, fingerprint)
+        if i < len(self._ordinate) and self._ordinate[i] == fingerprint:
+            return True
+        return fingerprint in self._coda
+
+    def _stato_atteso(self):
+        xlsm_size, xlsm_mtime = stato_file(self.database_path)
+        delta_size, _ = stato_file(self.delta_store.path)
+        return xlsm_size, xlsm_mtime, delta_size
+
+    def _leggi(self):
+        """Legge l'indice dal disco. Restituisce lo stato registrato o None se illeggibile."""
+        if not self.path.exists():
+            return None
+        with open(self.path, "rb") as f:
+            raw_header = f.read(HEADER.size)
+            if len(raw_header) < HEADER.size:
+                return None
+            magic, version, _, xlsm_size, xlsm_mtime, delta_size, n_sorted = HEADER.unpack(raw_header)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                return None
+            payload = f.read()
+        if len(payload) % 8 != 0 or n_sorted * 8 > len(payload):
+            return None
+        values = array("Q")
+        values.frombytes(payload)
+        if sys.byteorder != "little":
+            values.byteswap()
+        self._ordinate = values[:n_sorted]
+        self._coda = set(values[n_sorted:])
+        return xlsm_size, xlsm_mtime, delta_size
+
+    def _scrivi(self):
+        if len(self._coda) > MAX_CODA:
+            merged = set(self._ordinate)
+            merged.update(self._coda)
+            self._ordinate = array("Q", sorted(merged))
+            self._coda = set()
+        xlsm_size, xlsm_mtime, delta_size = self._stato_atteso()
+        body = array("Q", self._ordinate)
+        body.extend(sorted(self._coda))
+        if sys.byteorder != "little":
+            body.byteswap()
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, xlsm_size, xlsm_mtime, delta_size, len(self._ordinate)))
+            f.write(body.tobytes())
+        os.replace(tmp_path, self.path)
+
+    def impronte_database(self):
+        """Calcola le impronte di tutte le righe del database (xlsm + delta). Costo lineare."""
+        fingerprints = []
+        if self.database_path.exists():
+            wb = openpyxl.load_workbook(self.database_path, read_only=True)
+            try:
+                if self.sheet_name in wb.sheetnames:
+                    for row in wb[self.sheet_name].iter_rows(min_row=2, values_only=True):
+                        if any(cell is not None for cell in row):
+                            fingerprints.append(impronta_riga(row))
+            finally:
+                wb.close()
+        fingerprints.extend(impronta_riga(row) for row in self.delta_store.righe())
+        return fingerprints
+
+    def ricostruisci(self):
+        logger.info(f"  Ricostruzione indice impronte da '{self.database_path.name}'...")
+        self._ordinate = array("Q", sorted(set(self.impronte_database())))
+        self._coda = set()
+        self._scrivi()
+        logger.info(f"  Indice ricostruito: {len(self)} impronte.")
+
+    def carica(self):
+        """Carica l'indice; lo ricostruisce se manca o se il database è stato modificato a mano."""
+        stato = self._leggi()
+        if stato is None:
+            logger.info("  Indice impronte assente o non valido.")
+            self.ricostruisci()
+        elif stato != self._stato_atteso():
+            logger.warning("  Il database o il delta risultano modificati esternamente: l'indice impronte va ricostruito.")
+            self.ricostruisci()
+        else:
+            logger.info(f"  Indice impronte caricato: {len(self)} impronte.")
+        return self
+
+    def aggiungi(self, fingerprints):
+        """Registra nuove impronte e allinea lo stato al delta appena scritto."""
+        self._coda.update(fp for fp in fingerprints if fp not in self)
+        self._scrivi()
+
+    def sincronizza_stato(self):
+        """Riallinea lo stato registrato dopo una modifica del database fatta dallo script (es. compattazione)."""
+        self._scrivi()
+
+    def verifica(self):
+        """
+        Confronta l'indice con il contenuto reale del database, senza modificarlo.
+        Restituisce un dizionario con le impronte mancanti, orfane e lo stato del timbro.
+        """
+        stato = self._leggi()
+        attese = Counter(self.impronte_database())
+        indicizzate = set(self._ordinate) | self._coda
+        return {
+            "righe_database": sum(attese.values()),
+            "impronte_indice": len(indicizzate),
+            "mancanti": len(set(attese) - indicizzate),
+            "orfane": len(indicizzate - set(attese)),
+            "duplicati_database": sum(n - 1 for n in attese.values() if n > 1),
+            "stato_allineato": stato is not None and stato == self._stato_atteso(),
+        }
@@ -5,6 +5,8 @@ import numpy as np # Importato per le operazioni vettorizzate
 from datetime import datetime, time, date, timedelta
 import calendar
 import json
+import uuid
+import openpyxl
 
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
@@ -12,10 +14,11 @@ from PyQt6.QtWidgets import (
     QLabel, QFrame, QStatusBar, QMessageBox, QFileDialog, QHeaderView,
     QStyle, QMenuBar, QCheckBox, QDialog, QListWidget, QListWidgetItem,
     QDialogButtonBox, QSpinBox, QGridLayout, QTextBrowser, QTimeEdit,
-    QGroupBox
+    QGroupBox, QProgressBar
 )
 from PyQt6.QtCore import (
-    QAbstractTableModel, Qt, QDate, QTimer, QSettings, QSortFilterProxyModel, QTime
+    QAbstractTableModel, Qt, QDate, QTimer, QSettings, QTime,
+    QThread, pyqtSignal
 )
 from PyQt6.QtGui import QIcon, QColor, QAction
 
@@ -25,6 +28,13 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib import colors
 
+from delta_store import DeltaStore
+from viewer_cache import (
+    StratoCache, percorso_strato, stato_sorgenti, leggi_righe, righe_nuove, crea_filigrana, unisci,
+    impronta_json, impronta_dataframe, STRATO_TIMBRATURE, STRATO_REPARTI, STRATO_REGOLE,
+    COLONNE_TIMBRATURE, COLONNE_REGOLE, RIGHE_BLOCCO, PYARROW_AVAILABLE
+)
+
 # --- Stile (invariato) ---
 LIGHT_STYLE = """
     QWidget {
@@ -66,11 +76,28 @@ DEFAULT_CONFIG = {
     "alert_turno_esteso": False, "max_ore_normali": 10
 }
 USER_NOTES_FILE = "user_notes.json"
+# Cache colonnare a strati (vedi viewer_cache): data_cache.timbrature.arrow, data_cache.reparti.arrow, data_cache.regole.arrow
+CACHE_FILE = "data_cache.arrow"
+# Cache delle versioni precedenti (pickle, poi un unico file Arrow), rimosse al primo caricamento riuscito
+LEGACY_CACHE_FILES = ["data_cache.pkl", "data_cache.arrow"]
+# Da aumentare quando cambia il calcolo di uno strato: le cache esistenti di quello strato vengono ricalcolate
+VERSIONE_REPARTI = 1
+VERSIONE_REGOLE = 1
+# Colonne lette dal foglio 'Dati' (B,C,D,H,I,P) e loro indici nelle righe del delta
+DATA_COLUMNS = ['Data', 'Ingresso', 'Uscita', 'Nome', 'Cognome', 'Sito']
+DATA_COLUMN_INDICES = [1, 2, 3, 7, 8, 15]
 
 class PandasModel(QAbstractTableModel):
-    def __init__(self, data, checked_set, user_notes_dict_ref, app_ref):
+    """
+    Modello della tabella costruito una volta per ogni risultato dei filtri: testi, colori di evidenziazione,
+    indici originali e chiavi di ordinamento sono array NumPy per colonna, così data() è un accesso diretto
+    all'array e l'ordinamento un solo argsort, senza passare da pandas cella per cella.
+    """
+    COLUMNS = ['Seleziona', 'Sito', 'Reparto', 'Data', 'Nome', 'Cognome', 'Ingresso', 'Uscita',
+               'Ingresso Contabile', 'Uscita Contabile', 'Ore Contabili', 'Avvisi Sistema', 'Note Utente']
+
+    def __init__(self, df, checked_set, user_notes_dict_ref, app_ref):
         super().__init__()
-        self._data = data
         self.checked_set = checked_set
         self.user_notes_dict = user_notes_dict_ref
         self.app = app_ref
@@ -87,31 +114,54 @@ class PandasModel(QAbstractTableModel):
             "Avvisi Sistema": "Avvisi automatici basati sulle regole.",
             "Note Utente": "Doppio click per aggiungere/modificare una nota."
         }
+        self.colonne = list(self.COLUMNS)
+        self.original_df_index = df.index.to_numpy(dtype=np.int64)
+        self.colori = self._mappa(df['Highlight'], self.highlight_colors.get, None)
+        ore = df['Ore Contabili'].to_numpy(dtype=float)
+        orario = lambda t: t.strftime('%H:%M')
+        testi = {
+            'Sito': self._mappa(df['Sito'], str), 'Reparto': self._mappa(df['Reparto'], str),
+            'Data': self._mappa(df['Data_dt'], lambda d: d.strftime('%d/%m/%Y')),
+            'Nome': self._mappa(df['Nome'], str), 'Cognome': self._mappa(df['Cognome'], str),
+            'Ingresso': self._mappa(df['Ingresso_t_raw'], orario), 'Uscita': self._mappa(df['Uscita_t_raw'], orario),
+            'Ingresso Contabile': self._mappa(df['Ingresso Contabile_t'], orario), 'Uscita Contabile': self._mappa(df['Uscita Contabile_t'], orario),
+            'Ore Contabili': self._mappa(df['Ore Contabili'], lambda v: f"{v:.2f}".replace('.', ',')),
+            'Avvisi Sistema': self._mappa(df['Avvisi Sistema'], str),
+        }
+        # Un array (o None per le colonne calcolate al volo) per indice di colonna
+        self.testi = [testi.get(c) for c in self.colonne]
+        self.valori = {'Ore Contabili': ore} # EditRole
+        # Chiavi per le colonne in cui l'ordine del testo non è quello dei valori
+        self.chiavi = {'Data': df['Data_dt'].to_numpy(dtype='datetime64[ns]'), 'Ore Contabili': ore}
+
+    @staticmethod
+    def _mappa(serie, funzione, vuoto=""):
+        """funzione() applicata una volta per valore distinto e distribuita sulle righe (vuoto per i valori mancanti)."""
+        codici, valori = pd.factorize(serie)
+        tabella = np.empty(len(valori) + 1, dtype=object)
+        tabella[:-1] = [funzione(v) for v in valori]; tabella[-1] = vuoto
+        return tabella[codici]
 
-    def rowCount(self, parent=None): return self._data.shape[0]
-    def columnCount(self, parent=None): return self._data.shape[1]
+    def rowCount(self, parent=None): return len(self.original_df_index)
+    def columnCount(self, parent=None): return len(self.colonne)
 
     def data(self, index, role=Qt.ItemDataRole.DisplayRole):
-        if not index.isValid() or self._data.empty: return None
-        original_df_idx = self._data.iloc[index.row()].get('original_df_index', -1)
-        col_name = self._data.columns[index.column()]
+        if not index.isValid(): return None
+        riga = index.row(); col_name = self.colonne[index.column()]
         if role == Qt.ItemDataRole.CheckStateRole and col_name == 'Seleziona':
-            return Qt.CheckState.Checked if original_df_idx in self.checked_set else Qt.CheckState.Unchecked
-        if role == Qt.ItemDataRole.BackgroundRole and 'Highlight' in self._data.columns:
-            return self.highlight_colors.get(self._data.iloc[index.row()]['Highlight'])
+            return Qt.CheckState.Checked if int(self.original_df_index[riga]) in self.checked_set else Qt.CheckState.Unchecked
+        if role == Qt.ItemDataRole.BackgroundRole: return self.colori[riga]
         if role == Qt.ItemDataRole.DisplayRole or role == Qt.ItemDataRole.EditRole:
             if col_name == 'Seleziona': return ""
-            if col_name == 'Note Utente': return self.user_notes_dict.get(original_df_idx, "")
-            value = self._data.iloc[index.row(), index.column()]
-            if isinstance(value, float): return f"{value:.2f}".replace('.', ',') if role == Qt.ItemDataRole.DisplayRole else value
-            return str(value) if pd.notna(value) else ""
+            if col_name == 'Note Utente': return self.user_notes_dict.get(int(self.original_df_index[riga]), "")
+            if role == Qt.ItemDataRole.EditRole and col_name in self.valori: return float(self.valori[col_name][riga])
+            return self.testi[index.column()][riga]
         return None
 
     def setData(self, index, value, role):
-        if not index.isValid() or self._data.empty: return False
-        original_df_idx = self._data.iloc[index.row()].get('original_df_index', -1)
-        if original_df_idx == -1: return False
-        col_name = self._data.columns[index.column()]
+        if not index.isValid(): return False
+        original_df_idx = int(self.original_df_index[index.row()])
+        col_name = self.colonne[index.column()]
         if col_name == 'Seleziona' and role == Qt.ItemDataRole.CheckStateRole:
             if value == Qt.CheckState.Checked.value: self.checked_set.add(original_df_idx)
             else: self.checked_set.discard(original_df_idx)
@@ -124,18 +174,39 @@ class PandasModel(QAbstractTableModel):
             self.dataChanged.emit(index, index, [role]); return True
         return False
 
+    def _chiave_ordinamento(self, col_name):
+        if col_name in self.chiavi: return self.chiavi[col_name]
+        if col_name == 'Seleziona': return np.isin(self.original_df_index, np.fromiter(self.checked_set, dtype=np.int64))
+        if col_name == 'Note Utente': testi = pd.Series(self.original_df_index).map(self.user_notes_dict).fillna("").to_numpy(dtype=object)
+        else: testi = self.testi[self.colonne.index(col_name)]
+        # Rango del testo tra i valori distinti: argsort su interi invece che su stringhe
+        return pd.factorize(testi, sort=True)[0]
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        if not 0 <= column < len(self.colonne) or not len(self.original_df_index): return
+        ordine = np.argsort(self._chiave_ordinamento(self.colonne[column]), kind='stable')
+        if order == Qt.SortOrder.DescendingOrder: ordine = ordine[::-1]
+        self.layoutAboutToBeChanged.emit()
+        posizione = np.empty_like(ordine); posizione[ordine] = np.arange(len(ordine))
+        self.original_df_index = self.original_df_index[ordine]; self.colori = self.colori[ordine]
+        self.testi = [t[ordine] if t is not None else None for t in self.testi]
+        self.valori = {k: v[ordine] for k, v in self.valori.items()}; self.chiavi = {k: v[ordine] for k, v in self.chiavi.items()}
+        # Le righe selezionate nella vista seguono i dati
+        vecchi = self.persistentIndexList()
+        self.changePersistentIndexList(vecchi, [self.index(int(posizione[i.row()]), i.column()) for i in vecchi])
+        self.layoutChanged.emit()
+
     def flags(self, index):
         base_flags = super().flags(index)
-        if not self._data.empty:
-            col_name = self._data.columns[index.column()]
-            if col_name == 'Seleziona': return base_flags | Qt.ItemFlag.ItemIsUserCheckable
-            if col_name == 'Note Utente': return base_flags | Qt.ItemFlag.ItemIsEditable
+        col_name = self.colonne[index.column()]
+        if col_name == 'Seleziona': return base_flags | Qt.ItemFlag.ItemIsUserCheckable
+        if col_name == 'Note Utente': return base_flags | Qt.ItemFlag.ItemIsEditable
         return base_flags
 
     def headerData(self, section, orientation, role):
         if orientation == Qt.Orientation.Horizontal:
-            if section < len(self._data.columns):
-                col_name = self._data.columns[section]
+            if section < len(self.colonne):
+                col_name = self.colonne[section]
                 if role == Qt.ItemDataRole.DisplayRole: return str(col_name)
                 if role == Qt.ItemDataRole.ToolTipRole: return self.column_tooltips.get(col_name, col_name)
         return None
@@ -253,7 +324,7 @@ class HelpGuideDialog(QDialog):
             </style></head><body>
             <h2>Guida Rapida all'Applicazione Timbrature v9.1 (Ottimizzata)</h2>
             <h3>1. Caricamento Dati e Cache</h3>
-            <p>All'avvio, carica <code>database_timbrature_isab.xlsm</code>. La prima volta processa l'intero file. Poi usa una <b>cache</b> (<code>data_cache.pkl</code>) per avvii veloci, a meno che l'Excel non sia modificato. Il file Excel deve contenere un foglio "<b>Reparto</b>" (colonne: <code>Nome, Cognome, Reparto</code>).</p>
+            <p>All'avvio, carica <code>database_timbrature_isab.xlsm</code>. La prima volta processa l'intero file. Poi usa una <b>cache</b> (<code>data_cache.*.arrow</code>) per avvii veloci: se l'Excel cambia vengono elaborate solo le righe nuove, se cambiano le impostazioni degli avvisi vengono ricalcolati solo gli avvisi. Il caricamento avviene in background: compare per primo il mese più recente e si può già filtrare mentre arriva lo storico (<i>Annulla caricamento</i> nella barra di stato lo interrompe). Il file Excel deve contenere un foglio "<b>Reparto</b>" (colonne: <code>Nome, Cognome, Reparto</code>).</p>
             <h3>2. Filtri</h3>
             <ul>
                 <li><b>Ricerca Testuale:</b> Su Nome, Cognome, Sito.</li>
@@ -283,6 +354,340 @@ class HelpGuideDialog(QDialog):
         button_box.accepted.connect(self.accept); layout.addWidget(button_box)
 
 
+# --- Caricamento in background ---
+class CaricamentoAnnullato(Exception):
+    """Caricamento interrotto dall'utente."""
+
+
+class CaricamentoDati(QThread):
+    """
+    Lettura ed elaborazione delle timbrature (Excel, cache a strati, reparti, regole) fuori dal thread
+    dell'interfaccia. Le righe da analizzare vengono elaborate per mese, dal più recente, e consegnate
+    con il segnale `blocco` man mano che sono pronte; `completato` consegna il DataFrame completo.
+    Con df_base (timbrature e reparti già in memoria) viene ricalcolato solo lo strato delle regole.
+    L'annullamento si chiede con requestInterruption().
+    """
+    avanzamento = pyqtSignal(str, int)      # messaggio, percentuale (-1 se non stimabile)
+    blocco = pyqtSignal(object)             # DataFrame parziale con le colonne del risultato
+    completato = pyqtSignal(object, object) # (timbrature, DataFrame elaborato)
+    annullato = pyqtSignal()
+    errore = pyqtSignal(str)
+
+    def __init__(self, excel_file, config_rules, df_base=None, generazione_dati=None, parent=None):
+        super().__init__(parent)
+        self.excel_file = excel_file
+        # Copia: le impostazioni possono cambiare nella finestra mentre il thread lavora
+        self.config_rules = dict(config_rules)
+        self.df_base = df_base
+        self.generazione_dati = generazione_dati
+
+    def run(self):
+        try:
+            if self.df_base is None:
+                delta_store = DeltaStore(self.excel_file)
+                # Il delta conta come parte del database: anche le righe non ancora compattate invalidano le timbrature in cache
+                stato = stato_sorgenti(self.excel_file, delta_store.path)
+                df_timbrature = self._carica_timbrature(delta_store, stato)
+                self._controlla_annullamento()
+                self._notifica("Processamento dati (reparti e avvisi)...")
+                df_base = pd.concat([df_timbrature, self._strato_reparti(df_timbrature, stato["xlsm"])], axis=1)
+                df_regole = self._strato_regole(df_base, progressivo=True)
+            else:
+                df_base = self.df_base; df_timbrature = df_base[COLONNE_TIMBRATURE]
+                self._notifica("Ricalcolo degli avvisi con le nuove impostazioni...")
+                df_regole = self._strato_regole(df_base, progressivo=False)
+            self.completato.emit(df_timbrature, pd.concat([df_base, df_regole], axis=1))
+        except CaricamentoAnnullato:
+            self.annullato.emit()
+        except Exception as e:
+            self.errore.emit(str(e))
+
+    def _notifica(self, messaggio, percentuale=-1):
+        self.avanzamento.emit(messaggio, percentuale)
+
+    def _controlla_annullamento(self):
+        if self.isInterruptionRequested(): raise CaricamentoAnnullato()
+
+    def _righe_lette(self, righe, stimate):
+        """Callback ogni_blocco delle letture dell'xlsm: avanzamento e punto di annullamento."""
+        self._controlla_annullamento()
+        self._notifica(f"Caricamento file Excel: {righe} righe lette...", min(99, righe * 100 // stimate) if stimate else -1)
+
+    def _carica_timbrature(self, delta_store, stato):
+        """Strato delle timbrature lette: dalla cache, aggiornato con le sole righe accodate o riletto dall'Excel."""
+        strato = StratoCache(percorso_strato(CACHE_FILE, STRATO_TIMBRATURE))
+        if PYARROW_AVAILABLE:
+            try:
+                self._notifica("Verifica cache...")
+                metadati = strato.metadati()
+                if metadati and metadati.get("stato") == stato:
+                    self._notifica("Caricamento dati dalla cache (veloce)...")
+                    self.generazione_dati = metadati["generazione"]
+                    return strato.leggi()
+                if metadati and metadati.get("filigrana"):
+                    # Il database è cambiato: di norma sono solo righe accodate dal downloader
+                    df = self._aggiorna_timbrature(strato, metadati, stato, delta_store)
+                    if df is not None: return df
+            except CaricamentoAnnullato:
+                raise
+            except Exception as e:
+                self._notifica(f"Errore cache: {e}. Ricarico da Excel...")
+
+        self._notifica("Caricamento file Excel (può richiedere tempo)...")
+        # Stesse righe grezze (xlsm + delta) su cui si basa la filigrana degli aggiornamenti incrementali
+        delta_righe = delta_store.righe()
+        righe_xlsm, totale, righe = leggi_righe(self.excel_file, delta_righe, ogni_blocco=self._righe_lette)
+        # Righe numerate da 0: sono le chiavi delle note utente
+        df = self._prepara_righe(righe)[COLONNE_TIMBRATURE].reset_index(drop=True)
+        self.generazione_dati = uuid.uuid4().hex
+        strato.scrivi(df, stato=stato, filigrana=crea_filigrana(self.excel_file, righe_xlsm, totale, righe, delta_righe), generazione=self.generazione_dati)
+        return df
+
+    @staticmethod
+    def _prepara_righe(righe):
+        """Righe grezze (xlsm/delta) -> DataFrame pulito con data e orari convertiti."""
+        records = [[row[i] if i < len(row) else None for i in DATA_COLUMN_INDICES] for row in righe]
+        df_raw = pd.DataFrame(records, columns=DATA_COLUMNS)
+        df_raw.dropna(how='all', inplace=True); df_raw.dropna(subset=['Nome', 'Cognome', 'Data'], inplace=True)
+        for col in ['Nome', 'Cognome', 'Sito']: df_raw[col] = df_raw[col].astype(str).str.strip()
+        df_raw['Nome'] = df_raw['Nome'].str.title(); df_raw['Cognome'] = df_raw['Cognome'].str.title()
+        df_raw['Sito'] = df_raw['Sito'].replace('', "Non Specificato")
+
+        # Conversione date/ore con gestione errori
+        df_raw['Data_dt'] = pd.to_datetime(df_raw['Data'], errors='coerce')
+        df_raw['Ingresso_t_raw'] = pd.to_datetime(df_raw['Ingresso'], format='%H:%M', errors='coerce').dt.time
+        df_raw['Uscita_t_raw'] = pd.to_datetime(df_raw['Uscita'], format='%H:%M', errors='coerce').dt.time
+        df_raw.dropna(subset=['Data_dt'], inplace=True) # Rimuove righe con date invalide
+        return df_raw
+
+    def _aggiorna_timbrature(self, strato, metadati, stato, delta_store):
+        """Timbrature in cache più le sole righe accodate dopo la filigrana. None se serve una ricostruzione completa."""
+        esito = righe_nuove(self.excel_file, delta_store.righe(), metadati["filigrana"], ogni_blocco=self._righe_lette)
+        if esito is None:
+            self._notifica("Storico delle timbrature modificato: ricostruzione completa..."); return None
+        righe, filigrana = esito
+        self._notifica(f"Aggiornamento cache: {len(righe)} nuove righe...")
+        df = strato.leggi()
+        df_nuove = self._prepara_righe(righe)[COLONNE_TIMBRATURE]
+        if not df_nuove.empty:
+            # Stessa numerazione di una ricostruzione completa: le note utente restano agganciate alle righe
+            inizio = int(df.index.max()) + 1 if len(df) else 0
+            df_nuove.index = pd.RangeIndex(inizio, inizio + len(df_nuove))
+            df = unisci(df, df_nuove)
+        # Stessa generazione: gli strati derivati calcolano solo le righe nuove
+        self.generazione_dati = metadati["generazione"]
+        strato.scrivi(df, stato=stato, filigrana=filigrana, generazione=self.generazione_dati)
+        return df
+
+    def _strato_derivato(self, strato, df_timbrature, chiave, calcola, consegna=None, **extra):
+        """
+        Colonne di uno strato calcolato riga per riga dalle timbrature (reparti, regole) per la chiave di
+        contenuto indicata: dalla cache se già calcolate, altrimenti calcola(timbrature) sulle sole righe
+        non coperte dalla cache (quelle accodate) o, se la chiave è cambiata, su tutte. Il calcolo procede
+        per mese, dal più recente; consegna(parte) riceve ogni mese appena calcolato.
+        """
+        metadati = strato.metadati(); df_cache = None
+        if metadati and metadati.get("chiave") == chiave and metadati.get("generazione") == self.generazione_dati and metadati.get("righe", 0) <= len(df_timbrature):
+            try: df_cache = strato.leggi()
+            except Exception: df_cache = None
+        if df_cache is not None and len(df_cache) == len(df_timbrature) and all(metadati.get(k) == v for k, v in extra.items()):
+            return df_cache
+        coperte = len(df_cache) if df_cache is not None else 0
+        df = df_cache
+        if df_cache is None or coperte < len(df_timbrature):
+            da_calcolare = df_timbrature.iloc[coperte:]; parti = []; fatte = 0
+            for posizioni in self._per_mese(da_calcolare):
+                self._controlla_annullamento()
+                parte = calcola(da_calcolare.iloc[posizioni]); parti.append(parte); fatte += len(parte)
+                if consegna is not None: consegna(parte)
+                self._notifica(f"Analisi timbrature: {fatte} di {len(da_calcolare)}...", fatte * 100 // max(1, len(da_calcolare)))
+            df_nuove = pd.concat(parti).sort_index()
+            df = unisci(df_cache, df_nuove) if coperte else df_nuove
+        strato.scrivi(df, chiave=chiave, generazione=self.generazione_dati, righe=len(df), **extra)
+        return df
+
+    @staticmethod
+    def _per_mese(df):
+        """Posizioni delle righe di df raggruppate per mese di Data_dt, dal mese più recente."""
+        if df.empty: return [np.arange(0)]
+        gruppi = df.groupby(df['Data_dt'].dt.to_period('M'), sort=False).indices
+        return [gruppi[mese] for mese in sorted(gruppi, reverse=True)]
+
+    def _strato_reparti(self, df_timbrature, stato_xlsm):
+        """Reparto di ogni riga, con chiave l'impronta del foglio 'Reparto' (riletto solo se l'xlsm è cambiato)."""
+        strato = StratoCache(percorso_strato(CACHE_FILE, STRATO_REPARTI))
+        metadati = strato.metadati(); df_reparti = None
+        if metadati and metadati.get("xlsm") == stato_xlsm:
+            chiave = metadati["chiave"] # xlsm non toccato: il foglio 'Reparto' è quello dell'ultima lettura
+        else:
+            try:
+                df_reparti = self._leggi_reparti(self.excel_file)
+                chiave = impronta_json([VERSIONE_REPARTI, impronta_dataframe(df_reparti)])
+            except CaricamentoAnnullato:
+                raise
+            except Exception as e:
+                self._notifica(f"Foglio 'Reparto' non trovato o errore ({e}).")
+                return pd.DataFrame({'Reparto': "Non Assegnato"}, index=df_timbrature.index)
+
+        def calcola(df):
+            nonlocal df_reparti
+            if df_reparti is None: df_reparti = self._leggi_reparti(self.excel_file)
+            return self._assegna_reparti(df, df_reparti)
+        return self._strato_derivato(strato, df_timbrature, chiave, calcola, xlsm=stato_xlsm)
+
+    def _leggi_reparti(self, excel_file):
+        """Foglio 'Reparto' (colonne A-C dopo l'intestazione), letto a blocchi per restare annullabile."""
+        self._controlla_annullamento()
+        wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+        try:
+            righe = []
+            for riga in wb["Reparto"].iter_rows(min_row=2, max_col=3, values_only=True):
+                righe.append(tuple(riga) + (None,) * (3 - len(riga)))
+                if len(righe) % RIGHE_BLOCCO == 0: self._controlla_annullamento()
+        finally:
+            wb.close()
+        df_reparti = pd.DataFrame(righe, columns=['Nome', 'Cognome', 'Reparto'], dtype=object)
+        df_reparti.dropna(subset=['Nome', 'Cognome'], inplace=True)
+        for col in ['Nome', 'Cognome', 'Reparto']: df_reparti[col] = df_reparti[col].astype(str).str.strip().str.title()
+        # Una sola riga per persona (la prima): ogni timbratura riceve un solo reparto
+        return df_reparti.drop_duplicates(subset=['Nome', 'Cognome']).reset_index(drop=True)
+
+    @staticmethod
+    def _assegna_reparti(df, df_reparti):
+        reparti = df_reparti.set_index(['Nome', 'Cognome'])['Reparto']
+        chiavi = pd.MultiIndex.from_arrays([df['Nome'].astype(str), df['Cognome'].astype(str)])
+        return pd.DataFrame({'Reparto': reparti.reindex(chiavi).fillna("Non Assegnato").to_numpy()}, index=df.index)
+
+    def _strato_regole(self, df_base, progressivo=False):
+        """
+        Orari contabili, ore e avvisi, con chiave l'impronta delle impostazioni degli avvisi. Se progressivo,
+        ogni mese calcolato viene consegnato con il segnale `blocco` insieme alle colonne di df_base.
+        """
+        strato = StratoCache(percorso_strato(CACHE_FILE, STRATO_REGOLE))
+        chiave = impronta_json([VERSIONE_REGOLE, self.config_rules])
+        calcola = lambda df: self._analyze_data_vectorized(df[COLONNE_TIMBRATURE].copy())[COLONNE_REGOLE]
+        consegna = (lambda parte: self.blocco.emit(pd.concat([df_base.loc[parte.index], parte], axis=1))) if progressivo else None
+        return self._strato_derivato(strato, df_base, chiave, calcola, consegna)
+
+    def _analyze_data_vectorized(self, df):
+        """Versione vettorizzata per l'analisi delle timbrature. Molto più veloce."""
+        # --- 1. Preparazione Dati ---
+        ingresso_raw = df['Ingresso_t_raw']
+        uscita_raw = df['Uscita_t_raw']
+
+        # Arrotondamento vettorizzato
+        df['Ingresso Contabile_t'] = self.round_time_vectorized(ingresso_raw, 'up')
+        df['Uscita Contabile_t'] = self.round_time_vectorized(uscita_raw, 'down')
+
+        # Calcolo ore contabili vettorizzato
+        start_dt = pd.to_datetime(df['Data_dt'].dt.date.astype(str) + ' ' + df['Ingresso Contabile_t'].astype(str), errors='coerce')
+        end_dt = pd.to_datetime(df['Data_dt'].dt.date.astype(str) + ' ' + df['Uscita Contabile_t'].astype(str), errors='coerce')
+        # Gestione turni notturni (uscita il giorno dopo)
+        end_dt = np.where(end_dt < start_dt, end_dt + pd.Timedelta(days=1), end_dt)
+        df['Ore Contabili'] = (end_dt - start_dt).dt.total_seconds() / 3600
+        df['Ore Contabili'].fillna(0, inplace=True)
+
+        # --- 2. Creazione Maschere Booleane per Avvisi ---
+        # Maschere di base
+        has_both_times = ingresso_raw.notna() & uscita_raw.notna()
+        has_error = pd.Series(False, index=df.index)
+
+        # Avviso: Mancanze (priorità alta)
+        m_ing_mancante = ingresso_raw.isna() & uscita_raw.notna()
+        m_usc_mancante = ingresso_raw.notna() & uscita_raw.isna()
+        m_entrambi_mancanti = ingresso_raw.isna() & uscita_raw.isna()
+        m_mancanze = (m_ing_mancante | m_usc_mancante | m_entrambi_mancanti) if self.config_rules.get("alert_mancanze") else pd.Series(False, index=df.index)
+
+        # Avviso: Invertiti (priorità massima, errore logico)
+        m_invertiti = pd.Series(False, index=df.index)
+        if self.config_rules.get("alert_invertiti"):
+             m_invertiti = has_both_times & (df['Ore Contabili'] < 0)
+             has_error |= m_invertiti
+             df.loc[m_invertiti, 'Ore Contabili'] = 0 # Invalida ore se invertito
+
+        # Avviso: Timbratura Ravvicinata
+        min_ravv_h = self.config_rules.get("minuti_ravvicinata") / 60.0
+        m_ravvicinata = has_both_times & ~has_error & (df['Ore Contabili'] >= 0) & (df['Ore Contabili'] < min_ravv_h)
+
+        # Avviso: Turno Breve
+        m_turno_breve = pd.Series(False, index=df.index)
+        if self.config_rules.get("alert_turno_breve"):
+             min_ore = self.config_rules.get("min_ore_valide")
+             m_turno_breve = has_both_times & ~has_error & ~m_ravvicinata & (df['Ore Contabili'] < min_ore)
+
+        # Avviso: Turno Esteso
+        m_turno_esteso = pd.Series(False, index=df.index)
+        if self.config_rules.get("alert_turno_esteso"):
+             max_ore = self.config_rules.get("max_ore_normali")
+             m_turno_esteso = has_both_times & ~has_error & (df['Ore Contabili'] > max_ore)
+
+        # Avviso: Fuori Orario
+        m_fuori_orario_ing = pd.Series(False, index=df.index)
+        m_fuori_orario_usc = pd.Series(False, index=df.index)
+        if self.config_rules.get("alert_fuori_orario"):
+            inizio_std = pd.to_datetime(self.config_rules.get("orario_inizio_std")).time()
+            fine_std = pd.to_datetime(self.config_rules.get("orario_fine_std")).time()
+            m_fuori_orario_ing = df['Ingresso Contabile_t'].notna() & (df['Ingresso Contabile_t'] < inizio_std)
+            m_fuori_orario_usc = df['Uscita Contabile_t'].notna() & (df['Uscita Contabile_t'] > fine_std)
+
+        # --- 3. Assemblaggio Stringhe Avvisi ---
+        # Crea colonne temporanee per ogni avviso, poi le concatena
+        alerts = []
+        if self.config_rules.get("alert_mancanze"):
+            alerts.append(np.select([m_ing_mancante, m_usc_mancante, m_entrambi_mancanti],
+                                    ["Ingresso Mancante", "Uscita Mancante", "Ingr./Usc. Mancanti"], default=""))
+        if self.config_rules.get("alert_invertiti"):
+             alerts.append(np.where(m_invertiti, "Uscita prima di Ingresso", ""))
+        alerts.append(np.where(m_ravvicinata, f"Timbr. Ravvicinata (<{self.config_rules.get('minuti_ravvicinata')}min)", ""))
+        if self.config_rules.get("alert_turno_breve"):
+            alerts.append(np.where(m_turno_breve, f"Turno Troppo Breve (<{self.config_rules.get('min_ore_valide')}h)", ""))
+        if self.config_rules.get("alert_turno_esteso"):
+            alerts.append(np.where(m_turno_esteso, f"Turno Esteso (>{self.config_rules.get('max_ore_normali')}h)", ""))
+        if self.config_rules.get("alert_fuori_orario"):
+            alerts.append(np.where(m_fuori_orario_ing, "Ingr. Fuori Orario", ""))
+            alerts.append(np.where(m_fuori_orario_usc, "Usc. Fuori Orario", ""))
+
+        # Concatena tutti i messaggi di avviso
+        df['Avvisi Sistema'] = pd.DataFrame(alerts, columns=df.index).T.apply(lambda x: ', '.join(x[x != '']), axis=1)
+
+        # --- 4. Assegnazione Highlight con np.select (molto veloce) ---
+        conditions = [
+            m_invertiti,
+            m_mancanze,
+            m_ravvicinata,
+            m_turno_breve,
+            m_turno_esteso,
+            m_fuori_orario_ing | m_fuori_orario_usc
+        ]
+        choices = [ "ERRORE", "AVVISO", "AVVISO", "ATTENZIONE", "ATTENZIONE", "ATTENZIONE" ]
+        df['Highlight'] = np.select(conditions, choices, default='NONE')
+
+        return df
+
+
+    @staticmethod
+    def round_time_vectorized(series, direction='up'):
+        """Arrotonda una Series di 'time' al quarto d'ora più vicino."""
+        # Converte in minuti totali dal giorno per il calcolo
+        minutes = series.apply(lambda t: t.hour * 60 + t.minute if pd.notna(t) else np.nan)
+        minutes.dropna(inplace=True)
+
+        if direction == 'up':
+            rounded_minutes = (minutes // 15 + (minutes % 15 > 0)) * 15
+        else: # down
+            rounded_minutes = (minutes // 15) * 15
+
+        # Riconverte in 'time'
+        new_hour = (rounded_minutes // 60) % 24
+        new_minute = rounded_minutes % 60
+        
+        # Crea una series di time objects
+        time_series = pd.Series([time(int(h), int(m)) if pd.notna(h) else pd.NaT for h, m in zip(new_hour, new_minute)], index=new_hour.index)
+        
+        # Riunisce i valori NaT originali
+        return time_series.reindex(series.index)
+
+
 # --- Classe Principale dell'Applicazione ---
 class TimbratureApp(QMainWindow):
     def __init__(self):
@@ -292,6 +697,10 @@ class TimbratureApp(QMainWindow):
 
         self.df_raw_data = None
         self.df_original = None
+        # Generazione dello strato delle timbrature: cambia a ogni ricostruzione completa
+        self.generazione_dati = None
+        self.caricamento = None # CaricamentoDati in corso
+        self.ordinamento = None # (colonna, verso) della tabella
         self.checked_indices = set()
         self.user_notes = {}
         self.config_rules = {}
@@ -303,6 +712,11 @@ class TimbratureApp(QMainWindow):
         self.search_timer = QTimer(self)
         self.search_timer.setSingleShot(True); self.search_timer.setInterval(300)
         self.search_timer.timeout.connect(self.apply_filters)
+        # Blocchi mensili arrivati durante il caricamento: la tabella si aggiorna al più ogni 400 ms
+        self.blocchi_in_attesa = []
+        self.blocchi_timer = QTimer(self)
+        self.blocchi_timer.setSingleShot(True); self.blocchi_timer.setInterval(400)
+        self.blocchi_timer.timeout.connect(self._mostra_blocchi)
 
         self.init_ui()
         self.load_window_settings()
@@ -331,11 +745,14 @@ class TimbratureApp(QMainWindow):
         dialog = SettingsDialog(self)
         if dialog.exec():
             self.load_app_config()
-            if self.df_raw_data is not None:
-                # Usa una copia per la ri-elaborazione
-                self.df_original = self._process_loaded_data(self.df_raw_data.copy())
-                self.apply_filters()
-            QMessageBox.information(self, "Impostazioni", "Impostazioni salvate. La vista dati è stata aggiornata.")
+            # Con un caricamento in corso le nuove regole vengono applicate al suo termine
+            if self.df_raw_data is not None and self.caricamento is None: self.ricalcola_regole()
+            QMessageBox.information(self, "Impostazioni", "Impostazioni salvate. Gli avvisi vengono ricalcolati in background.")
+
+    def ricalcola_regole(self):
+        # Cambiano solo le regole: timbrature e reparti restano quelli già calcolati
+        df_base = self.df_original.drop(columns=COLONNE_REGOLE)
+        self._avvia_caricamento(CaricamentoDati("database_timbrature_isab.xlsm", self.config_rules, df_base, self.generazione_dati, self))
 
     def load_app_config(self):
         self.config_rules = {}
@@ -385,6 +802,8 @@ class TimbratureApp(QMainWindow):
         main_layout.addWidget(anomaly_filter_group)
 
         self.table_view = QTableView(); self.table_view.setSortingEnabled(True)
+        # Colonna e verso scelti cliccando le intestazioni (collegato dopo setSortingEnabled: nessun ordinamento iniziale)
+        self.table_view.horizontalHeader().sortIndicatorChanged.connect(self.on_sort_changed)
         self.table_view.doubleClicked.connect(self.handle_double_click) # Gestione doppio click
         main_layout.addWidget(self.table_view)
 
@@ -398,6 +817,11 @@ class TimbratureApp(QMainWindow):
         export_layout.addWidget(self.export_csv_button); export_layout.addWidget(self.export_pdf_button)
         main_layout.addLayout(export_layout)
         self.status_bar = QStatusBar(); self.setStatusBar(self.status_bar); self.status_bar.showMessage("Pronto.")
+        self.progress_bar = QProgressBar(); self.progress_bar.setMaximumWidth(220); self.progress_bar.setVisible(False)
+        self.cancel_load_button = QPushButton("Annulla caricamento"); self.cancel_load_button.setObjectName("quick_filter"); self.cancel_load_button.setVisible(False)
+        self.cancel_load_button.setToolTip("Interrompe la lettura: restano visibili le timbrature già caricate.")
+        self.cancel_load_button.clicked.connect(self.annulla_caricamento)
+        self.status_bar.addPermanentWidget(self.progress_bar); self.status_bar.addPermanentWidget(self.cancel_load_button)
 
     def setup_controls_and_dashboard(self, parent_layout):
         top_frame = QWidget(); top_layout = QVBoxLayout(top_frame)
@@ -442,177 +866,102 @@ class TimbratureApp(QMainWindow):
 
     def handle_double_click(self, index):
         """Apre l'editor sulla colonna 'Note Utente' con doppio click."""
-        proxy_model = self.table_view.model()
-        source_model = proxy_model.sourceModel()
-        col_name = source_model._data.columns[index.column()]
+        col_name = self.table_view.model().colonne[index.column()]
         if col_name == 'Note Utente':
             self.table_view.edit(index)
 
     def on_search_text_changed(self): self.search_timer.start()
+    def on_sort_changed(self, colonna, verso): self.ordinamento = (colonna, verso)
 
     def load_data_and_process(self):
-        excel_file = "database_timbrature_isab.xlsm"; cache_file = "data_cache.pkl"
-        if not os.path.exists(excel_file): QMessageBox.critical(self, "Errore", f"File timbrature non trovato: {excel_file}"); return
-
-        use_cache = False
-        if os.path.exists(cache_file):
-            excel_mod_time = os.path.getmtime(excel_file); cache_mod_time = os.path.getmtime(cache_file)
-            if cache_mod_time > excel_mod_time:
-                try:
-                    self.status_bar.showMessage("Verifica cache...");
-                    # La cache ora contiene sempre il df processato, quindi non serve controllare le colonne
-                    self.df_original = pd.read_pickle(cache_file)
-                    use_cache = True
-                    self.status_bar.showMessage("Caricamento dati dalla cache (veloce)...")
-                    # Ricostruisci una versione approssimativa di df_raw_data se necessario
-                    cols_to_drop = ['Avvisi Sistema', 'Highlight', 'Ingresso Contabile_t', 'Uscita Contabile_t', 'Ore Contabili', 'Reparto']
-                    self.df_raw_data = self.df_original.drop(columns=cols_to_drop, errors='ignore')
-                except Exception as e:
-                    self.status_bar.showMessage(f"Errore cache: {e}. Ricarico da Excel...")
-
-        try:
-            if not use_cache:
-                self.status_bar.showMessage("Caricamento file Excel (può richiedere tempo)...")
-                QApplication.processEvents() # Forza aggiornamento UI
-                df_raw = pd.read_excel(excel_file, engine='openpyxl', usecols='B,C,D,H,I,P', sheet_name=0)
-                df_raw.columns = ['Data', 'Ingresso', 'Uscita', 'Nome', 'Cognome', 'Sito']
-                df_raw.dropna(how='all', inplace=True); df_raw.dropna(subset=['Nome', 'Cognome', 'Data'], inplace=True)
-                for col in ['Nome', 'Cognome', 'Sito']: df_raw[col] = df_raw[col].astype(str).str.strip()
-                df_raw['Nome'] = df_raw['Nome'].str.title(); df_raw['Cognome'] = df_raw['Cognome'].str.title()
-                df_raw['Sito'].replace('', "Non Specificato", inplace=True)
-
-                # Conversione date/ore con gestione errori
-                df_raw['Data_dt'] = pd.to_datetime(df_raw['Data'], errors='coerce')
-                df_raw['Ingresso_t_raw'] = pd.to_datetime(df_raw['Ingresso'], format='%H:%M', errors='coerce').dt.time
-                df_raw['Uscita_t_raw'] = pd.to_datetime(df_raw['Uscita'], format='%H:%M', errors='coerce').dt.time
-                df_raw.dropna(subset=['Data_dt'], inplace=True) # Rimuove righe con date invalide
-
-                self.df_raw_data = df_raw.copy()
-                self.df_original = self._process_loaded_data(df_raw.copy()) # Usa una copia
-                self.df_original.to_pickle(cache_file)
-
-            self.status_bar.showMessage(f"Caricate {len(self.df_original)} timbrature.", 5000)
-            self.setup_filters(); self.apply_filters()
-        except Exception as e:
-            QMessageBox.critical(self, "Errore Lettura Dati", f"Impossibile leggere il file.\nErrore: {e}\n\nAssicurarsi che il file non sia corrotto e che le colonne siano corrette.")
-
-    def _process_loaded_data(self, df_to_process):
-        self.status_bar.showMessage("Processamento dati (reparti e avvisi)...")
-        QApplication.processEvents()
         excel_file = "database_timbrature_isab.xlsm"
-        try:
-            df_reparti = pd.read_excel(excel_file, sheet_name="Reparto", usecols="A,B,C", engine='openpyxl')
-            df_reparti.columns = ['Nome', 'Cognome', 'Reparto']
-            for col in ['Nome', 'Cognome', 'Reparto']: df_reparti[col] = df_reparti[col].astype(str).str.strip().str.title()
-            df_reparti.dropna(subset=['Nome', 'Cognome'], inplace=True)
-            df_to_process = pd.merge(df_to_process, df_reparti, on=['Nome', 'Cognome'], how='left')
-            df_to_process['Reparto'].fillna("Non Assegnato", inplace=True)
-        except Exception as e:
-            df_to_process['Reparto'] = "Non Assegnato"
-            self.status_bar.showMessage(f"Foglio 'Reparto' non trovato o errore ({e}).", 7000)
-
-        # >>> OTTIMIZZAZIONE: Chiama la funzione vettorizzata
-        df_processed = self._analyze_data_vectorized(df_to_process)
-        return df_processed
-
-    def _analyze_data_vectorized(self, df):
-        """Versione vettorizzata per l'analisi delle timbrature. Molto più veloce."""
-        self.status_bar.showMessage("Analisi vettorizzata in corso...")
-        QApplication.processEvents()
-
-        # --- 1. Preparazione Dati ---
-        ingresso_raw = df['Ingresso_t_raw']
-        uscita_raw = df['Uscita_t_raw']
-
-        # Arrotondamento vettorizzato
-        df['Ingresso Contabile_t'] = self.round_time_vectorized(ingresso_raw, 'up')
-        df['Uscita Contabile_t'] = self.round_time_vectorized(uscita_raw, 'down')
-
-        # Calcolo ore contabili vettorizzato
-        start_dt = pd.to_datetime(df['Data_dt'].dt.date.astype(str) + ' ' + df['Ingresso Contabile_t'].astype(str), errors='coerce')
-        end_dt = pd.to_datetime(df['Data_dt'].dt.date.astype(str) + ' ' + df['Uscita Contabile_t'].astype(str), errors='coerce')
-        # Gestione turni notturni (uscita il giorno dopo)
-        end_dt = np.where(end_dt < start_dt, end_dt + pd.Timedelta(days=1), end_dt)
-        df['Ore Contabili'] = (end_dt - start_dt).dt.total_seconds() / 3600
-        df['Ore Contabili'].fillna(0, inplace=True)
-
-        # --- 2. Creazione Maschere Booleane per Avvisi ---
-        # Maschere di base
-        has_both_times = ingresso_raw.notna() & uscita_raw.notna()
-        has_error = pd.Series(False, index=df.index)
-
-        # Avviso: Mancanze (priorità alta)
-        m_ing_mancante = ingresso_raw.isna() & uscita_raw.notna()
-        m_usc_mancante = ingresso_raw.notna() & uscita_raw.isna()
-        m_entrambi_mancanti = ingresso_raw.isna() & uscita_raw.isna()
-        m_mancanze = (m_ing_mancante | m_usc_mancante | m_entrambi_mancanti) if self.config_rules.get("alert_mancanze") else pd.Series(False, index=df.index)
-
-        # Avviso: Invertiti (priorità massima, errore logico)
-        m_invertiti = pd.Series(False, index=df.index)
-        if self.config_rules.get("alert_invertiti"):
-             m_invertiti = has_both_times & (df['Ore Contabili'] < 0)
-             has_error |= m_invertiti
-             df.loc[m_invertiti, 'Ore Contabili'] = 0 # Invalida ore se invertito
-
-        # Avviso: Timbratura Ravvicinata
-        min_ravv_h = self.config_rules.get("minuti_ravvicinata") / 60.0
-        m_ravvicinata = has_both_times & ~has_error & (df['Ore Contabili'] >= 0) & (df['Ore Contabili'] < min_ravv_h)
-
-        # Avviso: Turno Breve
-        m_turno_breve = pd.Series(False, index=df.index)
-        if self.config_rules.get("alert_turno_breve"):
-             min_ore = self.config_rules.get("min_ore_valide")
-             m_turno_breve = has_both_times & ~has_error & ~m_ravvicinata & (df['Ore Contabili'] < min_ore)
-
-        # Avviso: Turno Esteso
-        m_turno_esteso = pd.Series(False, index=df.index)
-        if self.config_rules.get("alert_turno_esteso"):
-             max_ore = self.config_rules.get("max_ore_normali")
-             m_turno_esteso = has_both_times & ~has_error & (df['Ore Contabili'] > max_ore)
-
-        # Avviso: Fuori Orario
-        m_fuori_orario_ing = pd.Series(False, index=df.index)
-        m_fuori_orario_usc = pd.Series(False, index=df.index)
-        if self.config_rules.get("alert_fuori_orario"):
-            inizio_std = pd.to_datetime(self.config_rules.get("orario_inizio_std")).time()
-            fine_std = pd.to_datetime(self.config_rules.get("orario_fine_std")).time()
-            m_fuori_orario_ing = df['Ingresso Contabile_t'].notna() & (df['Ingresso Contabile_t'] < inizio_std)
-            m_fuori_orario_usc = df['Uscita Contabile_t'].notna() & (df['Uscita Contabile_t'] > fine_std)
-
-        # --- 3. Assemblaggio Stringhe Avvisi ---
-        # Crea colonne temporanee per ogni avviso, poi le concatena
-        alerts = []
-        if self.config_rules.get("alert_mancanze"):
-            alerts.append(np.select([m_ing_mancante, m_usc_mancante, m_entrambi_mancanti],
-                                    ["Ingresso Mancante", "Uscita Mancante", "Ingr./Usc. Mancanti"], default=""))
-        if self.config_rules.get("alert_invertiti"):
-             alerts.append(np.where(m_invertiti, "Uscita prima di Ingresso", ""))
-        alerts.append(np.where(m_ravvicinata, f"Timbr. Ravvicinata (<{self.config_rules.get('minuti_ravvicinata')}min)", ""))
-        if self.config_rules.get("alert_turno_breve"):
-            alerts.append(np.where(m_turno_breve, f"Turno Troppo Breve (<{self.config_rules.get('min_ore_valide')}h)", ""))
-        if self.config_rules.get("alert_turno_esteso"):
-            alerts.append(np.where(m_turno_esteso, f"Turno Esteso (>{self.config_rules.get('max_ore_normali')}h)", ""))
-        if self.config_rules.get("alert_fuori_orario"):
-            alerts.append(np.where(m_fuori_orario_ing, "Ingr. Fuori Orario", ""))
-            alerts.append(np.where(m_fuori_orario_usc, "Usc. Fuori Orario", ""))
-
-        # Concatena tutti i messaggi di avviso
-        df['Avvisi Sistema'] = pd.DataFrame(alerts).T.apply(lambda x: ', '.join(x[x != '']), axis=1)
-
-        # --- 4. Assegnazione Highlight con np.select (molto veloce) ---
-        conditions = [
-            m_invertiti,
-            m_mancanze,
-            m_ravvicinata,
-            m_turno_breve,
-            m_turno_esteso,
-            m_fuori_orario_ing | m_fuori_orario_usc
-        ]
-        choices = [ "ERRORE", "AVVISO", "AVVISO", "ATTENZIONE", "ATTENZIONE", "ATTENZIONE" ]
-        df['Highlight'] = np.select(conditions, choices, default='NONE')
-
-        return df
-
+        if not os.path.exists(excel_file): QMessageBox.critical(self, "Errore", f"File timbrature non trovato: {excel_file}"); return
+        self._avvia_caricamento(CaricamentoDati(excel_file, self.config_rules, parent=self))
+
+    def _avvia_caricamento(self, caricamento):
+        """Collega i segnali del thread di caricamento alla finestra e lo avvia."""
+        self.caricamento = caricamento
+        caricamento.avanzamento.connect(self.on_caricamento_avanzamento)
+        caricamento.blocco.connect(self.on_caricamento_blocco)
+        caricamento.completato.connect(self.on_caricamento_completato)
+        caricamento.annullato.connect(self.on_caricamento_annullato)
+        caricamento.errore.connect(self.on_caricamento_errore)
+        caricamento.finished.connect(self.on_caricamento_terminato)
+        self.progress_bar.setRange(0, 0); self.progress_bar.setVisible(True); self.cancel_load_button.setVisible(True)
+        caricamento.start()
+
+    def annulla_caricamento(self):
+        if self.caricamento is not None:
+            self.caricamento.requestInterruption(); self.status_bar.showMessage("Annullamento del caricamento...")
+
+    def on_caricamento_avanzamento(self, messaggio, percentuale):
+        self.status_bar.showMessage(messaggio)
+        if percentuale < 0: self.progress_bar.setRange(0, 0)
+        else: self.progress_bar.setRange(0, 100); self.progress_bar.setValue(percentuale)
+
+    def on_caricamento_blocco(self, df):
+        """Un mese appena elaborato: il primo viene mostrato subito, i successivi a gruppi (filtri sempre utilizzabili)."""
+        if self.df_original is None:
+            self.df_original = df; self.setup_filters()
+        else:
+            self.blocchi_in_attesa.append(df)
+            if not self.blocchi_timer.isActive(): self.blocchi_timer.start()
+
+    def _mostra_blocchi(self):
+        """Accoda alla tabella i blocchi arrivati dall'ultimo aggiornamento con un solo concat e un solo filtraggio."""
+        self.blocchi_timer.stop()
+        if not self.blocchi_in_attesa: return
+        nuovi = pd.concat(self.blocchi_in_attesa); self.blocchi_in_attesa = []
+        self.df_original = pd.concat([self.df_original, nuovi]); self._estendi_filtri(nuovi); self.apply_filters()
+
+    def on_caricamento_completato(self, df_timbrature, df):
+        # Il DataFrame completo sostituisce i blocchi parziali, compresi quelli non ancora mostrati
+        self.blocchi_timer.stop(); self.blocchi_in_attesa = []
+        primo = self.df_original is None
+        self.df_raw_data = df_timbrature; self.df_original = df; self.generazione_dati = self.caricamento.generazione_dati
+        if PYARROW_AVAILABLE:
+            for vecchia in LEGACY_CACHE_FILES:
+                if os.path.exists(vecchia): os.remove(vecchia)
+        cache_info = "" if PYARROW_AVAILABLE else " (pyarrow non installato: cache disattivata, l'Excel viene riletto a ogni avvio)"
+        esito = "Avvisi ricalcolati con le nuove impostazioni" if self.caricamento.df_base is not None else f"Caricate {len(self.df_original)} timbrature"
+        self.status_bar.showMessage(f"{esito}.{cache_info}", 5000)
+        if primo: self.setup_filters()
+        else: self._estendi_filtri(df); self.apply_filters()
+
+    def on_caricamento_annullato(self):
+        self._mostra_blocchi()
+        parziale = f": mostrate {len(self.df_original)} timbrature (dati parziali)" if self.df_original is not None and self.df_raw_data is None else ""
+        self.status_bar.showMessage(f"Caricamento annullato{parziale}.", 7000)
+
+    def on_caricamento_errore(self, errore):
+        QMessageBox.critical(self, "Errore Lettura Dati", f"Impossibile leggere il file.\nErrore: {errore}\n\nAssicurarsi che il file non sia corrotto e che le colonne siano corrette.")
+
+    def on_caricamento_terminato(self):
+        caricamento, self.caricamento = self.caricamento, None
+        self._mostra_blocchi() # blocchi arrivati prima di un errore
+        self.progress_bar.setVisible(False); self.cancel_load_button.setVisible(False)
+        # Impostazioni degli avvisi cambiate durante il caricamento: ricalcola con quelle correnti
+        annullato = caricamento.isInterruptionRequested()
+        if not annullato and self.df_raw_data is not None and caricamento.config_rules != self.config_rules: self.ricalcola_regole()
+        caricamento.deleteLater()
+
+    def _estendi_filtri(self, df):
+        """Aggiunge a siti, reparti e periodo i valori di un blocco appena arrivato senza cambiare le scelte dell'utente."""
+        for combo, col in ((self.sito_combo, 'Sito'), (self.reparto_combo, 'Reparto')):
+            valori = {combo.itemText(i) for i in range(1, combo.count())} | set(df[col].dropna().astype(str).unique())
+            corrente = combo.currentText(); tutti = combo.itemText(0)
+            combo.blockSignals(True); combo.clear(); combo.addItems([tutti] + sorted(valori)); combo.setCurrentText(corrente); combo.blockSignals(False)
+        if df.empty or df['Data_dt'].isna().all(): return
+        inizio, fine = df['Data_dt'].min().date(), df['Data_dt'].max().date()
+        vecchio_min, vecchio_max = self.date_from.minimumDate(), self.date_to.maximumDate()
+        nuovo_min = min(vecchio_min, QDate(inizio.year, inizio.month, inizio.day)); nuovo_max = max(vecchio_max, QDate(fine.year, fine.month, fine.day))
+        # Un periodo lasciato ai limiti dei dati si allarga con i dati; uno scelto dall'utente resta com'è
+        segui_inizio = self.date_from.date() == vecchio_min; segui_fine = self.date_to.date() == vecchio_max
+        self.date_from.blockSignals(True); self.date_to.blockSignals(True)
+        for edit in (self.date_from, self.date_to): edit.setMinimumDate(nuovo_min); edit.setMaximumDate(nuovo_max)
+        if segui_inizio: self.date_from.setDate(nuovo_min)
+        if segui_fine: self.date_to.setDate(nuovo_max)
+        self.date_from.blockSignals(False); self.date_to.blockSignals(False)
 
     def apply_filters(self):
         if self.df_original is None: return
@@ -652,39 +1001,16 @@ class TimbratureApp(QMainWindow):
 
 
     def update_table_view(self, df):
-        df_display = pd.DataFrame()
-        display_columns_ordered = ['Sito', 'Reparto', 'Data', 'Nome', 'Cognome', 'Ingresso', 'Uscita',
-                                   'Ingresso Contabile', 'Uscita Contabile', 'Ore Contabili',
-                                   'Avvisi Sistema', 'Note Utente', 'Highlight', 'original_df_index']
-
-        if not df.empty:
-            df_display = df[['Sito', 'Reparto', 'Nome', 'Cognome', 'Ore Contabili', 'Avvisi Sistema', 'Highlight']].copy()
-            df_display['Data'] = df['Data_dt'].dt.strftime('%d/%m/%Y')
-            df_display['Ingresso'] = df['Ingresso_t_raw'].apply(lambda x: x.strftime('%H:%M') if pd.notna(x) else '')
-            df_display['Uscita'] = df['Uscita_t_raw'].apply(lambda x: x.strftime('%H:%M') if pd.notna(x) else '')
-            df_display['Ingresso Contabile'] = df['Ingresso Contabile_t'].apply(lambda x: x.strftime('%H:%M') if pd.notna(x) else '')
-            df_display['Uscita Contabile'] = df['Uscita Contabile_t'].apply(lambda x: x.strftime('%H:%M') if pd.notna(x) else '')
-            df_display['Note Utente'] = '' # Sarà riempito dal modello
-            df_display['original_df_index'] = df.index
-            df_display = df_display.reindex(columns=[c for c in display_columns_ordered if c in df_display.columns])
-        else:
-            df_display = pd.DataFrame(columns=[c for c in display_columns_ordered if c != 'original_df_index'])
-
-        df_display.insert(0, 'Seleziona', False)
-
-        pandas_model = PandasModel(df_display, self.checked_indices, self.user_notes, self)
-        proxy_model = QSortFilterProxyModel(); proxy_model.setSourceModel(pandas_model)
-        self.table_view.setModel(proxy_model)
+        # Il modello ordina da sé (niente proxy): l'ordinamento scelto dall'utente si riapplica a ogni aggiornamento
+        model = PandasModel(df, self.checked_indices, self.user_notes, self)
+        if self.ordinamento is not None: model.sort(*self.ordinamento)
+        self.table_view.setModel(model)
 
         header = self.table_view.horizontalHeader()
-        # Nascondi colonne tecniche
-        for i, col_name in enumerate(df_display.columns):
-            if col_name in ['Highlight', 'original_df_index']:
-                self.table_view.setColumnHidden(i, True)
-            # Adatta larghezza colonne in modo intelligente
-            header.setSectionResizeMode(i, QHeaderView.ResizeMode.ResizeToContents)
-        header.setSectionResizeMode(df_display.columns.get_loc('Avvisi Sistema'), QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(df_display.columns.get_loc('Note Utente'), QHeaderView.ResizeMode.Stretch)
+        # Adatta larghezza colonne in modo intelligente
+        for i in range(model.columnCount()): header.setSectionResizeMode(i, QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(model.colonne.index('Avvisi Sistema'), QHeaderView.ResizeMode.Stretch)
+        header.setSectionResizeMode(model.colonne.index('Note Utente'), QHeaderView.ResizeMode.Stretch)
 
 
     def open_report_dialog(self):
@@ -778,29 +1104,6 @@ class TimbratureApp(QMainWindow):
         except Exception as e:
             QMessageBox.critical(self, "Errore Esportazione", f"Impossibile salvare il file.\nErrore: {e}")
 
-    @staticmethod
-    def round_time_vectorized(series, direction='up'):
-        """Arrotonda una Series di 'time' al quarto d'ora più vicino."""
-        # Converte in minuti totali dal giorno per il calcolo
-        minutes = series.apply(lambda t: t.hour * 60 + t.minute if pd.notna(t) else np.nan)
-        minutes.dropna(inplace=True)
-
-        if direction == 'up':
-            rounded_minutes = (minutes // 15 + (minutes % 15 > 0)) * 15
-        else: # down
-            rounded_minutes = (minutes // 15) * 15
-
-        # Riconverte in 'time'
-        new_hour = (rounded_minutes // 60) % 24
-        new_minute = rounded_minutes % 60
-        
-        # Crea una series di time objects
-        time_series = pd.Series([time(int(h), int(m)) if pd.notna(h) else pd.NaT for h, m in zip(new_hour, new_minute)], index=new_hour.index)
-        
-        # Riunisce i valori NaT originali
-        return time_series.reindex(series.index)
-
-
     def setup_filters(self):
         if self.df_original is None: return
         siti = sorted(self.df_original['Sito'].dropna().unique())
@@ -844,7 +1147,9 @@ class TimbratureApp(QMainWindow):
         state = settings.value("windowState")
         if state: self.restoreState(state)
         else: self.resize(1600, 900)
-    def closeEvent(self, event): self.save_window_settings(); self.save_user_notes(); event.accept()
+    def closeEvent(self, event):
+        if self.caricamento is not None: self.caricamento.requestInterruption(); self.caricamento.wait()
+        self.save_window_settings(); self.save_user_notes(); event.accept()
 
 # Classe MonthlyReportDialog (invariata)
 class MonthlyReportDialog(QDialog):
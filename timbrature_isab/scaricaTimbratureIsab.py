@@ -1,11 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.common.action_chains import ActionChains
 import openpyxl
 import time
 import traceback
@@ -13,32 +7,54 @@ import sys
 import os
 from pathlib import Path
 import shutil
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
+from collections import defaultdict
 import logging # <-- MODIFICA: Aggiunto modulo logging
+import argparse
+
+# La libreria condivisa dei robot (portale_isab) si trova nella cartella principale del progetto
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from portale_isab import PortalSession, LoginError, DownloadError
+from portale_isab.http_export import HttpExportClient, ExportError
+from portale_isab.telemetry import Telemetria, ESITO_OK, ESITO_ERRORE
+
+from delta_store import DeltaStore
+from fingerprint_index import FingerprintIndex, impronta_riga
+from date_index import DateIndex, giorno_riga, sito_riga, intervalli_contigui
 
 # --- CONFIGURAZIONE LOGGING (AGGIUNTO) ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)-8s - %(message)s", handlers=[logging.StreamHandler()])
 logger = logging.getLogger(__name__)
 
-# --- FUNZIONE DI ATTESA ROBUSTA (AGGIUNTA) ---
-def attendi_scomparsa_overlay(driver, timeout_secondi=45):
-    """
-    Attende in modo robusto che gli overlay di caricamento tipici dei siti Ext JS scompaiano.
-    Rileva maschere di caricamento o messaggi specifici come 'Caricamento...'.
-    """
+def leggi_data_portale(testo):
+    """Converte una data nel formato del portale (GG.MM.AAAA) in `date`."""
+    return datetime.strptime(testo.strip(), '%d.%m.%Y').date()
+
+def finestre_date(data_da, data_a, giorni_finestra=0):
+    """Suddivide l'intervallo [data_da, data_a] in finestre di al più `giorni_finestra` giorni (0 = una sola)."""
+    if giorni_finestra <= 0:
+        return [(data_da, data_a)]
+    finestre = []
+    inizio = data_da
+    while inizio <= data_a:
+        fine = min(inizio + timedelta(days=giorni_finestra - 1), data_a)
+        finestre.append((inizio, fine))
+        inizio = fine + timedelta(days=1)
+    return finestre
+
+def scarica_report_finestra(sessione, data_da, data_a):
+    """Imposta il periodo, esegue 'Cerca' e scarica l'export Excel. Restituisce il percorso del file o None."""
+    testo_da, testo_a = data_da.strftime('%d.%m.%Y'), data_a.strftime('%d.%m.%Y')
+    logger.info(f"  Inserimento data Da: '{testo_da}' A: '{testo_a}'...")
+    sessione.imposta_testo("DataTsDa", testo_da)
+    sessione.imposta_testo("DataTsA", testo_a)
+    sessione.cerca(90)
+    logger.info("  Tentativo di download del file Excel...")
     try:
-        overlay_wait = WebDriverWait(driver, timeout_secondi)
-        # XPath combinato per maschere di caricamento comuni in Ext JS o testo di caricamento
-        xpath_overlay = "//div[contains(@class, 'x-mask-msg') or contains(@class, 'x-mask')][not(contains(@style,'display: none'))] | //div[text()='Caricamento...']"
-        
-        # Attende che gli elementi di cui sopra diventino invisibili
-        overlay_wait.until(EC.invisibility_of_element_located((By.XPATH, xpath_overlay)))
-        logger.info(" -> Overlay di caricamento scomparso.")
-        time.sleep(0.3) # Piccola pausa per stabilizzare l'interfaccia
-        return True
-    except TimeoutException:
-        logger.warning(f"Timeout ({timeout_secondi}s) durante l'attesa della scomparsa dell'overlay. Proseguo con cautela.")
-        return False
+        return sessione.scarica_excel(45)
+    except DownloadError as e_download:
+        logger.error(f"  {e_download}")
+        return None
 
 # --- Variabili Globali Configurabili ---
 LOGIN_URL = "https://portalefornitori.isab.com/Ui/"
@@ -53,16 +69,99 @@ DATABASE_FILENAME = "database_timbrature_isab.xlsm"
 DATABASE_FILE_PATH = SCRIPT_DIRECTORY / DATABASE_FILENAME
 DATABASE_SHEET_NAME = "Dati"
 
+# --- Archivio Delta (ingest incrementale) ---
+# Le nuove righe vengono accodate nel file delta accanto all'xlsm; la compattazione
+# le riversa nel database quando il delta supera questa soglia o su richiesta (--compatta).
+DELTA_SOGLIA_COMPATTAZIONE = 5000
+
+# --- Telemetria: un file JSONL per giro con durata ed esito di ogni passo ---
+TELEMETRIA_DIR = SCRIPT_DIRECTORY / "telemetria"
+
 # --- Celle per la Configurazione ---
 SHEET_NAME_CONFIG = "parametri"
 USERNAME_CELL = "A3"
 PASSWORD_CELL = "B3"
 DOWNLOAD_DIR_CELL = "E2"
+BROWSER_PROFILE_CELL = "E6" # Facoltativa: "visibile" (default) o "prestazioni" (headless, risorse ridotte)
 
 # --- Inizializzazione Variabili di Configurazione ---
 USERNAME = None
 PASSWORD = None
 DOWNLOAD_DIR = None
+BROWSER_PROFILE = None
+
+# --- Argomenti da riga di comando ---
+parser = argparse.ArgumentParser(description="Scarico timbrature ISAB e aggiornamento del database.")
+parser.add_argument("--compatta", action="store_true", help="Riversa il delta nel database xlsm ed esce, senza scaricare.")
+parser.add_argument("--compatta-subito", action="store_true", help="Compatta il delta subito dopo lo scarico, indipendentemente dalla soglia.")
+parser.add_argument("--verifica-indice", action="store_true", help="Confronta l'indice impronte con il database e riporta le discrepanze, senza scaricare.")
+parser.add_argument("--ricostruisci-indice", action="store_true", help="Ricostruisce da zero l'indice impronte ed esce.")
+parser.add_argument("--dal", help="Recupero multi-giorno: data iniziale (GG.MM.AAAA). Default: ieri.")
+parser.add_argument("--al", help="Recupero multi-giorno: data finale (GG.MM.AAAA). Default: ieri.")
+parser.add_argument("--finestra", type=int, default=0, help="Giorni per singola ricerca sul portale se il periodo va spezzato (0 = unica ricerca).")
+parser.add_argument("--lacune-giorni", type=int, default=14, help="Senza --dal/--al: giorni (fino a ieri) in cui cercare lacune da recuperare. 0 = solo ieri.")
+parser.add_argument("--lacune-per-sito", action="store_true", help="Considera lacuna anche un giorno mancante per un solo Sito.")
+parser.add_argument("--mostra-lacune", action="store_true", help="Elenca le lacune del database ed esce, senza scaricare.")
+parser.add_argument("--solo-browser", action="store_true", help="Non usa l'export HTTP diretto anche se configurato (portale_isab/endpoints_export.json).")
+parser.add_argument("--profilo-browser", choices=["visibile", "prestazioni"], help=f"Profilo del browser; prevale sulla cella {BROWSER_PROFILE_CELL} del file parametri.")
+parser.add_argument("--senza-cache-sessione", action="store_true", help="Esegue sempre il login completo e il logout finale, senza riusare la sessione salvata.")
+parser.add_argument("--login-url", help="URL del portale (prove e benchmark, es. il portale simulato di portale_isab.mock_portal).")
+parser.add_argument("--parametri", help="File dei parametri alternativo a parametriScaricoTS.xlsm.")
+parser.add_argument("--database", help="Database alternativo a database_timbrature_isab.xlsm (indici, delta e telemetria stanno nella sua cartella).")
+ARGS = parser.parse_args()
+
+if ARGS.login_url:
+    LOGIN_URL = ARGS.login_url
+if ARGS.parametri:
+    CONFIG_EXCEL_PATH = Path(ARGS.parametri).resolve()
+if ARGS.database:
+    DATABASE_FILE_PATH = Path(ARGS.database).resolve()
+    TELEMETRIA_DIR = DATABASE_FILE_PATH.parent / "telemetria"
+
+delta_store = DeltaStore(DATABASE_FILE_PATH)
+fingerprint_index = FingerprintIndex(DATABASE_FILE_PATH, DATABASE_SHEET_NAME, delta_store)
+date_index = DateIndex(DATABASE_FILE_PATH, DATABASE_SHEET_NAME, delta_store)
+
+if ARGS.verifica_indice:
+    logger.info(f"Verifica indice impronte: {fingerprint_index.path.name}")
+    report = fingerprint_index.verifica()
+    logger.info(f"  - Righe nel database (xlsm + delta): {report['righe_database']}")
+    logger.info(f"  - Impronte nell'indice: {report['impronte_indice']}")
+    logger.info(f"  - Righe del database non indicizzate: {report['mancanti']}")
+    logger.info(f"  - Impronte orfane (righe rimosse dal database): {report['orfane']}")
+    logger.info(f"  - Righe duplicate nel database: {report['duplicati_database']}")
+    logger.info(f"  - Timbro xlsm/delta allineato: {'SI' if report['stato_allineato'] else 'NO'}")
+    drift = report['mancanti'] or report['orfane'] or not report['stato_allineato']
+    if drift:
+        logger.warning("  L'indice NON è allineato al database. Usare --ricostruisci-indice per rigenerarlo.")
+    sys.exit(1 if drift else 0)
+
+if ARGS.ricostruisci_indice:
+    fingerprint_index.ricostruisci()
+    sys.exit(0)
+
+if ARGS.mostra_lacune:
+    yesterday = (datetime.now() - timedelta(days=1)).date()
+    lacune_da = yesterday - timedelta(days=max(ARGS.lacune_giorni, 1) - 1)
+    date_index.carica()
+    giorni_mancanti = date_index.lacune(lacune_da, yesterday, per_sito=ARGS.lacune_per_sito)
+    logger.info(f"Lacune nel database dal {lacune_da:%d.%m.%Y} al {yesterday:%d.%m.%Y}: {len(giorni_mancanti)} giorni.")
+    for lacuna_da, lacuna_a in intervalli_contigui(giorni_mancanti):
+        logger.info(f"  - {lacuna_da:%d.%m.%Y} - {lacuna_a:%d.%m.%Y}")
+    sys.exit(0)
+
+if ARGS.compatta:
+    logger.info(f"Compattazione su richiesta del delta: {delta_store.path.name}")
+    try:
+        fingerprint_index.carica()
+        date_index.carica()
+        delta_store.compatta(DATABASE_SHEET_NAME)
+        fingerprint_index.sincronizza_stato()
+        date_index.sincronizza_stato()
+    except Exception as e_compact:
+        logger.critical(f"ERRORE CRITICO durante la compattazione: {e_compact}\n{traceback.format_exc()}")
+        sys.exit("Compattazione non riuscita.")
+    sys.exit(0)
 
 # --- Sezione 1: Lettura della Configurazione ---
 logger.info(f"Tentativo di leggere i dati di configurazione dal file: {CONFIG_EXCEL_PATH}")
@@ -82,6 +181,7 @@ try:
         else:
             logger.critical(f"Errore FATALE: Percorso DOWNLOAD_DIR non valido o vuoto nella cella {DOWNLOAD_DIR_CELL}.")
             sys.exit("Percorso download mancante.")
+        BROWSER_PROFILE = ARGS.profilo_browser or sheet_config[BROWSER_PROFILE_CELL].value or "visibile"
         if not (USERNAME and PASSWORD):
             logger.critical("Errore FATALE: Username o Password non trovati nel file Excel.")
             sys.exit("Credenziali mancanti.")
@@ -99,277 +199,232 @@ except Exception as e_excel_config:
 
 # --- Sezione 2: Automazione Web con Selenium ---
 logger.info("\nAvvio script automatico per operazioni web...")
-driver = None
-final_downloaded_path = None
-
-try:
-    yesterday = datetime.now() - timedelta(days=1)
-    data_da_usare = yesterday.strftime('%d.%m.%Y')
-    logger.info(f"Data calcolata per la ricerca (ieri): {data_da_usare}")
-
-    chrome_options = webdriver.ChromeOptions()
-    prefs = {
-        "download.default_directory": str(Path(DOWNLOAD_DIR).absolute()),
-        "download.prompt_for_download": False,
-        "download.directory_upgrade": True,
-        "safebrowsing.enabled": True, 
-        "safebrowsing.disable_download_protection": True,
-        "profile.default_content_settings.popups": 0,
-        "profile.content_settings.exceptions.automatic_downloads.*.setting": 1
-    }
-    chrome_options.add_experimental_option("prefs", prefs)
-
-    # Argomenti per disabilitare le nuove feature di sicurezza di Chrome (Bubble, Warnings)
-    chrome_options.add_argument("--disable-features=InsecureDownloadWarnings")
-    chrome_options.add_argument("--disable-features=DownloadBubble,DownloadBubbleV2")
-
-    # Altri argomenti permissivi
-    chrome_options.add_argument("--start-maximized")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--ignore-certificate-errors")
-    chrome_options.add_argument("--allow-running-insecure-content")
-    chrome_options.add_argument("--disable-web-security")
-    chrome_options.add_argument(f"--unsafely-treat-insecure-origin-as-secure={LOGIN_URL}")
-
-    logger.info("Inizializzazione WebDriver Chrome...")
-    driver = webdriver.Chrome(options=chrome_options)
-    wait = WebDriverWait(driver, 20)
-    long_wait = WebDriverWait(driver, 30)
-    popup_wait = WebDriverWait(driver, 7)
-
-    logger.info(f"Navigazione a: {LOGIN_URL}")
-    driver.get(LOGIN_URL)
-
-    logger.info("Tentativo di login...")
-    wait.until(EC.presence_of_element_located((By.NAME, "Username"))).send_keys(USERNAME)
-    wait.until(EC.presence_of_element_located((By.NAME, "Password"))).send_keys(PASSWORD)
-    
-    logger.info("Click sul pulsante 'Accedi'...")
-    accedi_button_xpath = "//span[text()='Accedi' and contains(@class, 'x-btn-inner')]"
-    wait.until(EC.element_to_be_clickable((By.XPATH, accedi_button_xpath))).click()
-    
-    logger.info("Verifica del successo del login in corso...")
-    attendi_scomparsa_overlay(driver, 60) # <-- MODIFICA: attesa robusta post-login
+downloaded_files = []
+downloaded_windows = []
 
-    # La verifica post-login rimane un'ottima pratica
+yesterday = (datetime.now() - timedelta(days=1)).date()
+if ARGS.dal or ARGS.al:
+    # Recupero esplicito di un periodo
     try:
-        report_button_xpath_verification = "//*[normalize-space(text())='Report']"
-        wait.until(EC.visibility_of_element_located((By.XPATH, report_button_xpath_verification)))
-        logger.info("Login effettuato con successo. Elemento 'Report' visibile.")
-    except TimeoutException:
-        logger.critical("\n" + "="*60)
-        logger.critical("ERRORE FATALE: LOGIN FALLITO.")
-        logger.critical("L'elemento 'Report' non è stato trovato dopo il login.")
-        logger.critical("Possibili cause: credenziali errate, CAPTCHA, lentezza del sito.")
-        logger.critical("="*60)
-        # Salva screenshot in caso di fallimento
-        screenshot_path = SCRIPT_DIRECTORY / f"login_failure_{datetime.now():%Y%m%d_%H%M%S}.png"
+        periodo_da = leggi_data_portale(ARGS.dal) if ARGS.dal else yesterday
+        periodo_a = leggi_data_portale(ARGS.al) if ARGS.al else max(periodo_da, yesterday)
+    except ValueError as e_date:
+        logger.critical(f"Errore FATALE: data non valida ({e_date}). Formato atteso GG.MM.AAAA.")
+        sys.exit("Periodo non valido.")
+    if periodo_a < periodo_da:
+        logger.critical(f"Errore FATALE: periodo non valido {periodo_da:%d.%m.%Y} > {periodo_a:%d.%m.%Y}.")
+        sys.exit("Periodo non valido.")
+    finestre = finestre_date(periodo_da, periodo_a, ARGS.finestra)
+    if periodo_da == periodo_a:
+        logger.info(f"Data calcolata per la ricerca: {periodo_da:%d.%m.%Y}")
+    else:
+        logger.info(f"Recupero multi-giorno: {periodo_da:%d.%m.%Y} - {periodo_a:%d.%m.%Y} ({len(finestre)} ricerche sul portale).")
+elif ARGS.lacune_giorni <= 0:
+    finestre = [(yesterday, yesterday)]
+    logger.info(f"Data calcolata per la ricerca (ieri): {yesterday:%d.%m.%Y}")
+else:
+    # Recupero mirato: solo i giorni senza timbrature negli ultimi N giorni
+    lacune_da = yesterday - timedelta(days=ARGS.lacune_giorni - 1)
+    logger.info(f"Ricerca lacune nel database dal {lacune_da:%d.%m.%Y} al {yesterday:%d.%m.%Y}...")
+    date_index.carica()
+    giorni_mancanti = date_index.lacune(lacune_da, yesterday, per_sito=ARGS.lacune_per_sito)
+    finestre = []
+    for lacuna_da, lacuna_a in intervalli_contigui(giorni_mancanti):
+        logger.info(f"  - Lacuna: {lacuna_da:%d.%m.%Y} - {lacuna_a:%d.%m.%Y}")
+        finestre.extend(finestre_date(lacuna_da, lacuna_a, ARGS.finestra))
+    if not finestre:
+        logger.info("Nessuna lacuna da recuperare: il database è completo. Nessuno scarico necessario.")
+        sys.exit(0)
+    logger.info(f"Giorni da recuperare: {len(giorni_mancanti)} ({len(finestre)} ricerche sul portale).")
+
+telemetria = Telemetria("timbrature", TELEMETRIA_DIR)
+inizio_giro, t_giro = time.time(), time.perf_counter()
+sessione = PortalSession(LOGIN_URL, USERNAME, PASSWORD, DOWNLOAD_DIR, screenshot_dir=SCRIPT_DIRECTORY,
+                         cache_sessione=not ARGS.senza_cache_sessione, profilo=BROWSER_PROFILE, nome_profilo="timbrature",
+                         telemetria=telemetria)
+
+finestre_richieste = list(finestre)
+
+# Export HTTP diretto, se configurato: le finestre che non riescono passano al browser
+client_http = None if ARGS.solo_browser else HttpExportClient.da_configurazione(LOGIN_URL, USERNAME, PASSWORD)
+if client_http:
+    finestre_browser = []
+    for finestra_da, finestra_a in finestre:
+        if finestre_browser:
+            # Dopo il primo errore l'export diretto viene abbandonato per il giro
+            finestre_browser.append((finestra_da, finestra_a))
+            continue
         try:
-            driver.save_screenshot(str(screenshot_path))
-            logger.info(f"Screenshot del fallimento salvato in: {screenshot_path}")
-        except Exception as e_shot:
-            logger.error(f"Impossibile salvare lo screenshot: {e_shot}")
-        sys.exit("Login non riuscito. Script interrotto.")
-
+            with telemetria.passo("export_http", finestra=f"{finestra_da:%d.%m.%Y}-{finestra_a:%d.%m.%Y}"):
+                downloaded_path = client_http.esporta("Timbrature", {
+                    "fornitore": FORNITORE_DA_SELEZIONARE,
+                    "data_da": finestra_da.strftime('%d.%m.%Y'), "data_a": finestra_a.strftime('%d.%m.%Y')}, sessione.download_dir)
+            downloaded_files.append(downloaded_path)
+            downloaded_windows.append((finestra_da, finestra_a))
+        except ExportError as e_http:
+            logger.warning(f"Export HTTP non riuscito ({e_http}): si prosegue con il browser.")
+            finestre_browser.append((finestra_da, finestra_a))
+    client_http.chiudi()
+    finestre = finestre_browser
+
+if finestre:
     try:
-        ok_button_popup = popup_wait.until(EC.element_to_be_clickable((By.XPATH, "//span[text()='OK' and contains(@class, 'x-btn-inner')]")))
-        ok_button_popup.click()
-        logger.info("Pop-up 'OK' trovato e cliccato.")
-    except TimeoutException:
-        logger.info("Nessun pop-up 'OK' rilevato (normale).")
-
-    logger.info("Navigazione menu: Report -> Timbrature")
-    wait.until(EC.element_to_be_clickable((By.XPATH, "//*[normalize-space(text())='Report']"))).click()
-    attendi_scomparsa_overlay(driver) # <-- MODIFICA
-    
-    wait.until(EC.element_to_be_clickable((By.XPATH, "//span[text()='Timbrature']"))).click()
-    logger.info("'Timbrature' cliccato.")
-    attendi_scomparsa_overlay(driver) # <-- MODIFICA
-
-    logger.info("Impostazione filtri per il report Timbrature...")
-    fornitore_arrow_xpath = "//div[starts-with(@id, 'generic_refresh_combo_box-') and contains(@id, '-trigger-picker')]"
-    wait.until(EC.visibility_of_element_located((By.XPATH, fornitore_arrow_xpath)))
-
-    logger.info(f"  Seleziono il fornitore: '{FORNITORE_DA_SELEZIONARE}'...")
-    ActionChains(driver).move_to_element(wait.until(EC.element_to_be_clickable((By.XPATH, fornitore_arrow_xpath)))).click().perform()
-    attendi_scomparsa_overlay(driver) # <-- MODIFICA: attende il caricamento del dropdown
-    
-    fornitore_option_xpath = f"//li[normalize-space(text())='{FORNITORE_DA_SELEZIONARE}']"
-    fornitore_option = long_wait.until(EC.presence_of_element_located((By.XPATH, fornitore_option_xpath)))
-    driver.execute_script("arguments[0].scrollIntoView({block: 'center'}); arguments[0].click();", fornitore_option)
-    logger.info(f"  Fornitore '{FORNITORE_DA_SELEZIONARE}' selezionato.")
-    attendi_scomparsa_overlay(driver) # <-- MODIFICA: attende l'aggiornamento post-selezione
-
-    # Verifica se il campo è stato effettivamente popolato
-    try:
-        valore_input = driver.find_element(By.NAME, "CodiceFornitore").get_attribute("value")
-        if not valore_input:
-            logger.warning("  ATTENZIONE: Il campo Fornitore risulta vuoto! Provo inserimento manuale...")
-            campo_f = driver.find_element(By.NAME, "CodiceFornitore")
-            campo_f.send_keys(FORNITORE_DA_SELEZIONARE)
-            time.sleep(1)
-            driver.execute_script("arguments[0].dispatchEvent(new Event('change', {bubbles:true}));", campo_f)
-    except Exception as e_verify:
-        logger.debug(f"  Errore durante la verifica del campo fornitore: {e_verify}")
-
-    logger.info(f"  Inserimento data Da/A: '{data_da_usare}'...")
-    wait.until(EC.visibility_of_element_located((By.NAME, "DataTsDa"))).clear()
-    driver.find_element(By.NAME, "DataTsDa").send_keys(data_da_usare)
-    wait.until(EC.visibility_of_element_located((By.NAME, "DataTsA"))).clear()
-    driver.find_element(By.NAME, "DataTsA").send_keys(data_da_usare)
-    logger.info("  Date inserite.")
-    
-    logger.info("  Click sul pulsante 'Cerca'...")
-    cerca_button_xpath = "//a[contains(@class, 'x-btn') and .//span[normalize-space(text())='Cerca']]"
-    wait.until(EC.element_to_be_clickable((By.XPATH, cerca_button_xpath))).click()
-    logger.info("  Pulsante 'Cerca' cliccato. Attesa risultati...")
-    attendi_scomparsa_overlay(driver, 90) # <-- MODIFICA: attesa lunga per i risultati della ricerca
-
-    logger.info("  Tentativo di download del file Excel...")
-    path_to_downloads_obj = Path(DOWNLOAD_DIR)
-    files_before_download = set(path_to_downloads_obj.iterdir())
-    
-    excel_button_xpath = "//div[contains(@class, 'x-tool') and @role='button' and .//div[contains(@style, 'FontAwesome')]]"
-    excel_button = wait.until(EC.element_to_be_clickable((By.XPATH, excel_button_xpath)))
-    
-    logger.info("  Icona Excel per download trovata. Clicco via JS...")
-    driver.execute_script("arguments[0].click();", excel_button)
-    logger.info("  Click eseguito. Attendo il completamento (max 45s)...")
-    
-    download_start_time = time.time()
-    while time.time() - download_start_time < 45:
-        current_files = set(path_to_downloads_obj.iterdir())
-        new_files = current_files - files_before_download
-        completed_files = [f for f in new_files if f.suffix.lower() == '.xlsx' and not f.name.endswith(('.crdownload', '.tmp'))]
-        if completed_files:
-            final_downloaded_path = max(completed_files, key=lambda f: f.stat().st_mtime)
-            time.sleep(1) # Pausa per il flush del file system
-            if final_downloaded_path.exists() and final_downloaded_path.stat().st_size > 0:
-                logger.info(f"  Download COMPLETATO. File rilevato: {final_downloaded_path.name}")
-                break
+        sessione.avvia()
+        try:
+            sessione.login()
+        except LoginError as e_login:
+            logger.critical("\n" + "="*60)
+            logger.critical("ERRORE FATALE: LOGIN FALLITO.")
+            logger.critical(str(e_login))
+            logger.critical("="*60)
+            sys.exit("Login non riuscito. Script interrotto.")
+
+        sessione.apri_report("Timbrature")
+        logger.info("Impostazione filtri per il report Timbrature...")
+        sessione.seleziona_fornitore(FORNITORE_DA_SELEZIONARE)
+
+        # Un solo login per tutto il periodo: ogni finestra riusa la maschera di ricerca già impostata
+        for indice_finestra, (finestra_da, finestra_a) in enumerate(finestre, 1):
+            logger.info(f"Finestra {indice_finestra}/{len(finestre)}: {finestra_da:%d.%m.%Y} - {finestra_a:%d.%m.%Y}")
+            with telemetria.contesto(finestra=f"{finestra_da:%d.%m.%Y}-{finestra_a:%d.%m.%Y}"):
+                downloaded_path = scarica_report_finestra(sessione, finestra_da, finestra_a)
+            if downloaded_path:
+                downloaded_files.append(downloaded_path)
+                downloaded_windows.append((finestra_da, finestra_a))
             else:
-                final_downloaded_path = None # Resetta se il file non è valido
-        time.sleep(1) 
-    
-    if not final_downloaded_path:
-        logger.critical("ERRORE CRITICO: Download del report timbrature fallito o file non valido.")
+                logger.critical(f"ERRORE CRITICO: Download del report timbrature fallito per {finestra_da:%d.%m.%Y} - {finestra_a:%d.%m.%Y}.")
     
-    logger.info("-" * 40)
-    logger.info("Tentativo di Logout...")
-    try:
-        settings_button_xpath = "//span[@id='user-info-settings-btnEl' and contains(@class, 'x-btn-button')]"
-        settings_button = wait.until(EC.element_to_be_clickable((By.XPATH, settings_button_xpath)))
-        settings_button.click()
-        
-        logout_option_xpath = "//a[contains(@class, 'x-menu-item-link') and .//span[normalize-space(text())='Esci']]"
-        logout_option = wait.until(EC.element_to_be_clickable((By.XPATH, logout_option_xpath)))
-        logout_option.click()
-        
-        time.sleep(1) 
-        
-        yes_button_xpath = "//a[contains(@class, 'x-btn') and .//span[normalize-space(text())='Si']]"
-        yes_button = wait.until(EC.element_to_be_clickable((By.XPATH, yes_button_xpath)))
-        driver.execute_script("arguments[0].click();", yes_button)
-        logger.info("Logout eseguito.")
-        
-        WebDriverWait(driver, 10).until(EC.url_contains("Login"))
-        logger.info("Ritorno alla pagina di login confermato.")
-    except Exception as e_logout:
-        logger.warning(f"ATTENZIONE: Errore o timeout durante il logout: {e_logout}")
-
-except Exception as e_selenium_general:
-    logger.critical(f"ERRORE GENERALE durante le operazioni Selenium: {e_selenium_general}\n{traceback.format_exc()}")
-finally:
-    if driver:
         logger.info("-" * 40)
-        logger.info("Chiusura del browser WebDriver...")
-        driver.quit()
-        logger.info("Browser chiuso.")
+        if sessione.cache is None:
+            sessione.logout()
+        else:
+            # Niente logout: la sessione resta valida per il prossimo lancio (es. il robot canoni subito dopo)
+            logger.info("Logout saltato: la sessione resta in cache per i lanci successivi.")
+
+    except Exception as e_selenium_general:
+        logger.critical(f"ERRORE GENERALE durante le operazioni Selenium: {e_selenium_general}\n{traceback.format_exc()}")
+    finally:
+        logger.info("-" * 40)
+        sessione.chiudi()
+        sessione.log_statistiche()
 
-# --- Sezione 3: Elaborazione File Excel (Invariata) ---
-if final_downloaded_path and final_downloaded_path.exists():
+# --- Sezione 3: Elaborazione File Excel (ingest incrementale nel delta) ---
+downloaded_files = [f for f in downloaded_files if f.exists()]
+if downloaded_files:
     logger.info("\n" + "-" * 50)
     logger.info("INIZIO ELABORAZIONE FILE EXCEL")
     logger.info("-" * 50)
     
+    inizio_ingest, t_ingest = time.time(), time.perf_counter()
     try:
         if not DATABASE_FILE_PATH.exists():
             raise FileNotFoundError(f"File database non trovato: {DATABASE_FILE_PATH}")
 
-        logger.info(f"Apertura file scaricato: {final_downloaded_path.name}")
-        wb_source = openpyxl.load_workbook(final_downloaded_path)
-        sheet_source = wb_source.active
-
-        logger.info(f"Apertura file database: {DATABASE_FILE_PATH.name}")
-        wb_dest = openpyxl.load_workbook(DATABASE_FILE_PATH, keep_vba=True)
-        sheet_dest = wb_dest[DATABASE_SHEET_NAME] if DATABASE_SHEET_NAME in wb_dest.sheetnames else wb_dest.create_sheet(DATABASE_SHEET_NAME)
-
-        logger.info("  Indicizzazione righe esistenti nel database (con normalizzazione)...")
-        existing_rows = set()
-        for row in sheet_dest.iter_rows(min_row=2, values_only=True):
-            normalized_row = tuple(str(cell).strip() if cell is not None else "" for cell in row)
-            existing_rows.add(normalized_row)
-        logger.info(f"  Trovate {len(existing_rows)} righe uniche normalizzate esistenti.")
-
-        start_row = 2
-        if sheet_dest.max_row <= 1:
-            logger.info("  Il database è vuoto o contiene solo l'header. L'intestazione del nuovo file verrà copiata.")
-            start_row = 1
-        else:
-            logger.info("  Il database contiene dati. Verrà saltata l'intestazione del file scaricato.")
+        # Il database non viene aperto: si calcolano solo le impronte delle righe scaricate
+        # e si confrontano con l'indice persistente (storico xlsm + delta in attesa).
+        logger.info(f"  Caricamento indice impronte: {fingerprint_index.path.name}")
+        fingerprint_index.carica()
+        date_index.carica()
 
-        rows_added = 0
+        header_row = None
+        rows_by_day = defaultdict(list)
+        new_fingerprints = set()
+        sites_by_day = defaultdict(set)
         rows_skipped = 0
         
-        for row_index, row_values in enumerate(sheet_source.iter_rows(values_only=True), 1):
-            if row_index < start_row:
-                continue 
-            if not any(cell is not None for cell in row_values):
-                continue
-            normalized_new_row = tuple(str(cell).strip() if cell is not None else "" for cell in row_values)
-            if normalized_new_row not in existing_rows:
-                sheet_dest.append(row_values)
-                existing_rows.add(normalized_new_row)
-                rows_added += 1
-            else:
-                rows_skipped += 1
+        for downloaded_path in downloaded_files:
+            logger.info(f"Apertura file scaricato: {downloaded_path.name}")
+            wb_source = openpyxl.load_workbook(downloaded_path)
+            sheet_source = wb_source.active
+            for row_index, row_values in enumerate(sheet_source.iter_rows(values_only=True), 1):
+                if row_index == 1:
+                    header_row = header_row or row_values
+                    continue 
+                if not any(cell is not None for cell in row_values):
+                    continue
+                sites_by_day[giorno_riga(row_values)].add(sito_riga(row_values))
+                fingerprint = impronta_riga(row_values)
+                if fingerprint not in fingerprint_index and fingerprint not in new_fingerprints:
+                    rows_by_day[giorno_riga(row_values)].append(row_values)
+                    new_fingerprints.add(fingerprint)
+                else:
+                    rows_skipped += 1
+            wb_source.close()
+
+        # Le righe vengono accodate in ordine di giorno, in un unico passaggio per tutto il periodo
+        days_sorted = sorted(rows_by_day, key=lambda d: (d is None, d or date.min))
+        new_rows = [row for day in days_sorted for row in rows_by_day[day]]
+        for day in days_sorted:
+            logger.info(f"  - {day:%d.%m.%Y}: {len(rows_by_day[day])} righe nuove" if day else f"  - data non riconosciuta: {len(rows_by_day[day])} righe nuove")
+
+        rows_added = delta_store.accoda(new_rows, intestazione=header_row if new_rows else None)
+        fingerprint_index.aggiungi(new_fingerprints)
+        date_index.registra_righe(new_rows)
+
+        # I giorni (o i Siti di un giorno) interrogati senza risultati non vanno richiesti di nuovo, salvo i più recenti
+        queried_days = set()
+        for finestra_da, finestra_a in downloaded_windows:
+            giorno = finestra_da
+            while giorno <= finestra_a:
+                queried_days.add(giorno)
+                giorno += timedelta(days=1)
+        empty_days = queried_days - set(sites_by_day)
+        if empty_days:
+            logger.info(f"  Giorni interrogati senza timbrature: {', '.join(f'{g:%d.%m.%Y}' for g in sorted(empty_days))}")
+        if queried_days:
+            date_index.segna_vuoti(queried_days, sites_by_day)
         
         logger.info("-" * 20)
         logger.info("  RIEPILOGO PROCESSO:")
-        logger.info(f"  - Righe Nuove Aggiunte: {rows_added}")
+        logger.info(f"  - Righe Nuove Accodate al Delta: {rows_added}")
         logger.info(f"  - Righe Duplicate Saltate: {rows_skipped}")
         logger.info("-" * 20)
+        telemetria.registra_passo("ingest_excel", inizio_ingest, time.perf_counter() - t_ingest,
+                                  file=len(downloaded_files), righe_nuove=rows_added, righe_duplicate=rows_skipped)
 
-        if rows_added > 0:
-            logger.info("  Salvataggio delle modifiche sul file database...")
-            wb_dest.save(DATABASE_FILE_PATH)
-            logger.info("  Salvataggio completato.")
+        pending_rows = delta_store.conteggio()
+        if pending_rows > 0 and (ARGS.compatta_subito or pending_rows >= DELTA_SOGLIA_COMPATTAZIONE):
+            logger.info(f"  Righe in attesa nel delta: {pending_rows}. Avvio compattazione nel database...")
+            try:
+                with telemetria.passo("compattazione", righe=pending_rows):
+                    delta_store.compatta(DATABASE_SHEET_NAME)
+                    fingerprint_index.sincronizza_stato()
+                    date_index.sincronizza_stato()
+            except Exception as e_compact:
+                # Il delta resta intatto: la compattazione verrà ritentata al prossimo giro
+                logger.error(f"  ERRORE durante la compattazione (il delta è conservato): {e_compact}")
         else:
-            logger.info("  Nessuna nuova riga da aggiungere. Il database non è stato modificato.")
-
-        wb_source.close()
-        wb_dest.close()
+            logger.info(f"  Righe in attesa nel delta: {pending_rows} (compattazione a {DELTA_SOGLIA_COMPATTAZIONE}).")
 
         # Retry logic per eliminazione file temporaneo
-        removed = False
-        for attempt in range(5):
-            try:
-                time.sleep(1) # Pausa preventiva
-                os.remove(final_downloaded_path)
-                logger.info(f"  File temporaneo '{final_downloaded_path.name}' eliminato con successo.")
-                removed = True
-                break
-            except OSError as e_remove:
-                logger.warning(f"  ATTENZIONE: File bloccato ({e_remove}). Riprovo eliminazione ({attempt+1}/5)...")
-        
-        if not removed:
-             logger.error(f"  ERRORE: Impossibile eliminare il file scaricato '{final_downloaded_path.name}' dopo vari tentativi.")
+        for downloaded_path in downloaded_files:
+            removed = False
+            for attempt in range(5):
+                try:
+                    os.remove(downloaded_path)
+                    logger.info(f"  File temporaneo '{downloaded_path.name}' eliminato con successo.")
+                    removed = True
+                    break
+                except OSError as e_remove:
+                    logger.warning(f"  ATTENZIONE: File bloccato ({e_remove}). Riprovo eliminazione ({attempt+1}/5)...")
+                    time.sleep(0.5 * (attempt + 1)) # Pausa solo se il file è ancora bloccato
+            
+            if not removed:
+                 logger.error(f"  ERRORE: Impossibile eliminare il file scaricato '{downloaded_path.name}' dopo vari tentativi.")
             
     except Exception as e_excel_processing:
         logger.critical(f"ERRORE CRITICO durante l'elaborazione dei file Excel: {e_excel_processing}\n{traceback.format_exc()}")
+        telemetria.evento("errore_ingest", errore=type(e_excel_processing).__name__)
 else:
     logger.info("\nNessun file scaricato da processare o download fallito. Lo script termina.")
 
+# La cartella temporanea della sessione si elimina solo se non contiene più file (es. elaborazione fallita)
+if not any(sessione.download_dir.iterdir()):
+    sessione.rimuovi_cartella_download()
+else:
+    logger.warning(f"File scaricati lasciati in: {sessione.download_dir}")
+
+telemetria.registra_passo("giro", inizio_giro, time.perf_counter() - t_giro,
+                          esito=ESITO_OK if len(downloaded_windows) == len(finestre_richieste) else ESITO_ERRORE,
+                          finestre=len(finestre_richieste), scaricate=len(downloaded_windows))
 logger.info("\nScript Python terminato.")
\ No newline at end of file
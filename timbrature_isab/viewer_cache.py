@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Cache colonnare dei dati elaborati dall'interfaccia grafica delle timbrature.
+
+Sostituisce data_cache.pkl: i dati sono salvati in file Arrow IPC (Feather
+v2) letti in memory-map, con una versione di schema nei metadati. Nomi,
+cognomi, siti, reparti e avvisi sono colonne dizionario (categoriche), gli
+orari minuti interi dalla mezzanotte. A differenza del pickle il formato non
+dipende dalla versione di Python o di pandas. Senza pyarrow la cache è
+disattivata e i dati vengono riletti dall'Excel a ogni avvio.
+
+La cache è divisa in strati (StratoCache), ognuno con la propria chiave di
+contenuto: le timbrature lette (stato di xlsm e delta), il reparto di ogni
+riga (impronta del foglio 'Reparto') e l'esito delle regole (impronta della
+configurazione degli avvisi). Si ricalcola solo lo strato i cui dati di
+partenza sono cambiati.
+
+Il downloader accoda soltanto righe (nel delta, poi compattate nell'xlsm): la
+cache registra quindi una filigrana (righe lette, ultime righe normalizzate,
+impronta del delta) e al riavvio vengono lette ed elaborate solo le righe
+successive. Se la coda registrata non corrisponde più, lo storico è stato
+modificato e la vista va ricostruita da zero.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from datetime import datetime, date, time
+
+import numpy as np
+import pandas as pd
+import openpyxl
+
+from delta_store import stato_file
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+CACHE_VERSION = 3
+CHIAVE_METADATI = b"timbrature_cache"
+
+COLONNA_INDICE = "indice"
+COLONNE_CATEGORICHE = ['Nome', 'Cognome', 'Sito', 'Reparto', 'Avvisi Sistema', 'Highlight']
+COLONNE_ORARIO = ['Ingresso_t_raw', 'Uscita_t_raw', 'Ingresso Contabile_t', 'Uscita Contabile_t']
+
+# Strati della cache e colonne di ciascuno
+STRATO_TIMBRATURE = "timbrature"
+STRATO_REPARTI = "reparti"
+STRATO_REGOLE = "regole"
+COLONNE_TIMBRATURE = ['Data_dt', 'Nome', 'Cognome', 'Sito', 'Ingresso_t_raw', 'Uscita_t_raw']
+COLONNE_REPARTI = ['Reparto']
+COLONNE_REGOLE = ['Ingresso Contabile_t', 'Uscita Contabile_t', 'Ore Contabili', 'Avvisi Sistema', 'Highlight']
+
+ORARIO_ASSENTE = -1
+# Un oggetto time per minuto del giorno (più NaT per l'orario assente): la decodifica è un solo take()
+_ORARI = np.array([time(m // 60, m % 60) for m in range(24 * 60)] + [pd.NaT], dtype=object)
+_MINUTI = {t: m for m, t in enumerate(_ORARI[:-1])}
+
+# Righe finali conservate nella filigrana per riconoscere uno storico modificato
+RIGHE_CODA = 32
+# Ogni quante righe lette dall'xlsm leggi_righe() richiama ogni_blocco (avanzamento, annullamento)
+RIGHE_BLOCCO = 10000
+
+
+def stato_sorgenti(database_path, delta_path):
+    """Stato di xlsm e delta: la cache vale solo se coincide con quello registrato alla scrittura."""
+    return {"xlsm": list(stato_file(database_path)), "delta": list(stato_file(delta_path))}
+
+
+def orari_in_minuti(serie):
+    """Series di datetime.time (o NaT/None) -> array int16 di minuti dalla mezzanotte (ORARIO_ASSENTE se manca)."""
+    minuti = pd.Series(serie).map(_MINUTI)
+    # Orari con i secondi (non presenti nella tabella): conversione puntuale
+    resto = minuti.isna() & pd.Series(serie).map(lambda v: isinstance(v, time))
+    if resto.any():
+        minuti[resto] = [v.hour * 60 + v.minute for v in pd.Series(serie)[resto]]
+    return minuti.fillna(ORARIO_ASSENTE).to_numpy(dtype=np.int16)
+
+
+def minuti_in_orari(minuti):
+    """Inverso di orari_in_minuti: array object di datetime.time condivisi (NaT per ORARIO_ASSENTE)."""
+    return _ORARI[np.where(minuti < 0, len(_ORARI) - 1, minuti)]
+
+
+def _cella_confronto(valore):
+    # Una data scritta nell'xlsm dalla compattazione torna indietro come datetime a mezzanotte
+    if isinstance(valore, date) and not isinstance(valore, datetime):
+        valore = datetime.combine(valore, time())
+    if isinstance(valore, (datetime, time)):
+        return valore.isoformat()
+    return "" if valore is None else str(valore).strip()
+
+
+def celle_filigrana(riga):
+    """
+    Riga grezza -> lista di stringhe confrontabili tra xlsm e delta (celle vuote finali escluse), salvata
+    nella coda della filigrana. Diversa da delta_store.normalizza_riga, chiave della deduplicazione: qui
+    una riga deve restare uguale a sé stessa anche dopo il giro delta -> xlsm della compattazione, che
+    restituisce le date come datetime; la lista è la forma che la coda riprende dopo il JSON.
+    """
+    celle = [_cella_confronto(v) for v in riga]
+    while celle and not celle[-1]:
+        celle.pop()
+    return celle
+
+
+def impronta_righe(righe):
+    h = hashlib.blake2b(digest_size=16)
+    for riga in righe:
+        h.update(("\x1f".join(celle_filigrana(riga)) + "\n").encode("utf-8"))
+    return h.hexdigest()
+
+
+def leggi_righe(database_path, delta_righe, dal=0, ogni_blocco=None):
+    """
+    Righe grezze nell'ordine in cui il downloader le ha scritte: primo foglio dell'xlsm
+    (senza intestazione), poi le righe del delta. Restituisce (righe dell'xlsm, totale, righe[dal:]).
+    ogni_blocco(righe lette, righe stimate) viene chiamata ogni RIGHE_BLOCCO righe dell'xlsm.
+    """
+    wb = openpyxl.load_workbook(database_path, read_only=True, data_only=True)
+    try:
+        righe_xlsm, selezionate = 0, []
+        foglio = wb.worksheets[0]
+        stimate = max(0, (foglio.max_row or 1) - 1)
+        for riga in foglio.iter_rows(min_row=2, values_only=True):
+            if righe_xlsm >= dal:
+                selezionate.append(riga)
+            righe_xlsm += 1
+            if ogni_blocco is not None and righe_xlsm % RIGHE_BLOCCO == 0:
+                ogni_blocco(righe_xlsm, stimate)
+    finally:
+        wb.close()
+    selezionate.extend(delta_righe[max(0, dal - righe_xlsm):])
+    return righe_xlsm, righe_xlsm + len(delta_righe), selezionate
+
+
+def crea_filigrana(database_path, righe_xlsm, totale, coda, delta_righe):
+    """Filigrana di una lettura completa o incrementale (`coda`: ultime righe lette, grezze o già normalizzate)."""
+    return {"xlsm": list(stato_file(database_path)), "righe_xlsm": righe_xlsm, "righe": totale,
+            "coda": [celle_filigrana(r) for r in coda[-RIGHE_CODA:]],
+            "righe_delta": len(delta_righe), "impronta_delta": impronta_righe(delta_righe)}
+
+
+def righe_nuove(database_path, delta_righe, filigrana, ogni_blocco=None):
+    """
+    Righe accodate dopo la filigrana e la nuova filigrana: (righe, filigrana), oppure None se lo
+    storico è stato modificato (righe sparite, coda diversa) e serve una ricostruzione completa.
+    Se l'xlsm non è cambiato basta il delta; altrimenti (tipicamente dopo una compattazione)
+    l'xlsm viene riletto e la coda registrata verificata prima di prendere le righe successive.
+    ogni_blocco viene passata a leggi_righe durante la rilettura.
+    """
+    coda = filigrana["coda"]
+    if filigrana["xlsm"] == list(stato_file(database_path)):
+        n_delta = filigrana["righe_delta"]
+        if len(delta_righe) < n_delta or impronta_righe(delta_righe[:n_delta]) != filigrana["impronta_delta"]:
+            return None
+        nuove = delta_righe[n_delta:]
+        totale = filigrana["righe_xlsm"] + len(delta_righe)
+        return nuove, crea_filigrana(database_path, filigrana["righe_xlsm"], totale, coda + [celle_filigrana(r) for r in nuove], delta_righe)
+
+    inizio = filigrana["righe"] - len(coda)
+    righe_xlsm, totale, righe = leggi_righe(database_path, delta_righe, dal=inizio, ogni_blocco=ogni_blocco)
+    if totale < filigrana["righe"] or [celle_filigrana(r) for r in righe[:len(coda)]] != coda:
+        return None
+    return righe[len(coda):], crea_filigrana(database_path, righe_xlsm, totale, righe, delta_righe)
+
+
+def unisci(df, nuove):
+    """Accoda righe elaborate mantenendo categoriche le colonne che lo erano."""
+    unito = pd.concat([df, nuove])
+    for col in COLONNE_CATEGORICHE:
+        if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype) and not isinstance(unito[col].dtype, pd.CategoricalDtype):
+            unito[col] = unito[col].astype("category")
+    return unito
+
+
+def impronta_json(valore):
+    """Chiave di contenuto di un oggetto JSON (es. la configurazione delle regole)."""
+    return hashlib.blake2b(json.dumps(valore, sort_keys=True, default=str).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def impronta_dataframe(df):
+    """Chiave di contenuto di un DataFrame (valori e nomi delle colonne, indice escluso)."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update("\x1f".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def percorso_strato(base_path, nome):
+    """data_cache.arrow + 'regole' -> data_cache.regole.arrow"""
+    base_path = Path(base_path)
+    return base_path.with_name(f"{base_path.stem}.{nome}{base_path.suffix}")
+
+
+class StratoCache:
+    """
+    Uno strato della cache della vista: un file Arrow con alcune colonne del DataFrame (indice
+    compreso) e i metadati con cui sono state calcolate (chiave di contenuto, filigrana...).
+    Chi usa lo strato decide, dai metadati, se è ancora valido.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def scrivi(self, df, **metadati):
+        """Salva le colonne di df (indice compreso) con i metadati indicati."""
+        if not PYARROW_AVAILABLE:
+            return False
+        colonne = {COLONNA_INDICE: df.index.to_numpy(dtype=np.int64)}
+        for col in df.columns:
+            if col in COLONNE_CATEGORICHE:
+                colonne[col] = df[col].astype(str).astype("category").array
+            elif col in COLONNE_ORARIO:
+                colonne[col] = orari_in_minuti(df[col])
+            else:
+                colonne[col] = df[col].to_numpy()
+        tabella = pa.Table.from_pandas(pd.DataFrame(colonne), preserve_index=False)
+        metadati = {"versione": CACHE_VERSION, **metadati}
+        tabella = tabella.replace_schema_metadata({**(tabella.schema.metadata or {}), CHIAVE_METADATI: json.dumps(metadati).encode("utf-8")})
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        # Non compresso: il file si legge in memory-map senza decompressione
+        feather.write_feather(tabella, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, self.path)
+        return True
+
+    def _schema(self):
+        if not PYARROW_AVAILABLE or not self.path.exists():
+            return None
+        try:
+            with pa.memory_map(str(self.path), "r") as sorgente:
+                return pa.ipc.open_file(sorgente).schema
+        except (OSError, pa.ArrowInvalid):
+            return None
+
+    def metadati(self):
+        """Metadati dello strato, o None se assente, illeggibile o di un'altra versione dello schema."""
+        schema = self._schema()
+        grezzi = (schema.metadata or {}).get(CHIAVE_METADATI) if schema is not None else None
+        metadati = json.loads(grezzi) if grezzi else None
+        return metadati if metadati and metadati.get("versione") == CACHE_VERSION else None
+
+    def leggi(self, colonne=None):
+        """DataFrame dello strato; `colonne` limita la lettura (proiezione) a un sottoinsieme."""
+        schema = self._schema()
+        nomi = [c for c in schema.names if c != COLONNA_INDICE]
+        richieste = [COLONNA_INDICE] + [c for c in (colonne or nomi) if c in nomi]
+        df = feather.read_table(str(self.path), columns=richieste, memory_map=True).to_pandas()
+        df.index = pd.Index(df.pop(COLONNA_INDICE).to_numpy())
+        for col in COLONNE_ORARIO:
+            if col in df.columns:
+                df[col] = minuti_in_orari(df[col].to_numpy())
+        return df